@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+"""
+Бенчмарк памяти активных практик: 100k одновременных пользователей
+
+Сравнивает прежнее представление практики (словарь в bot_data['user_sessions']
+плюс current_session в user_data) с PracticeSession на __slots__. Память
+считается через tracemalloc, отдельно замеряется проверка состояния, на которой
+отбрасываются голосовые не в том состоянии.
+
+Пример:
+    python benchmarks/session_memory.py --users 100000
+"""
+
+import os
+import sys
+import time
+import uuid
+import argparse
+import tracemalloc
+from datetime import datetime
+
+# Подключаем модуль бота из корня репозитория
+CURRENT_DIR = os.path.dirname(os.path.abspath(__file__))
+PARENT_DIR = os.path.dirname(CURRENT_DIR)
+if PARENT_DIR not in sys.path:
+    sys.path.insert(0, PARENT_DIR)
+
+from simple_listening_bot import PracticeSession, PracticeState
+
+
+def legacy_practice(session_id: str, chat_id: int) -> tuple:
+    """Практика в старом виде: запись в user_sessions и user_data['current_session']"""
+    user_session = {
+        'should_be_recording': True,
+        'session_id': session_id,
+        'chat_id': chat_id,
+        'start_time': datetime.now(),
+        'timer_message_id': chat_id % 100_000,
+        'instruction_message_id': None,
+        'mode': None,
+    }
+    user_session.update({
+        'received_environment_audio': True,
+        'should_be_recording': False,
+        'waiting_for_answer': True,
+        'answer_requested_at': datetime.now(),
+    })
+    return user_session, {'current_session': session_id}
+
+
+def compact_practice(session_id: str, chat_id: int) -> PracticeSession:
+    practice = PracticeSession(session_id, chat_id, None, chat_id % 100_000)
+    practice.advance(PracticeState.ANSWERING)
+    return practice
+
+
+def measure(build, session_ids: list) -> tuple:
+    """Байт на практику (без самих строк session_id) и сами объекты, чтобы их не собрал GC"""
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    practices = {chat_id: build(session_id, chat_id) for chat_id, session_id in enumerate(session_ids)}
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return (after - before) / len(session_ids), practices
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Бенчмарк памяти активных практик")
+    parser.add_argument('--users', type=int, default=100_000)
+    args = parser.parse_args()
+
+    session_ids = [str(uuid.uuid4()) for _ in range(args.users)]
+
+    legacy_bytes, legacy = measure(legacy_practice, session_ids)
+    compact_bytes, compact = measure(compact_practice, session_ids)
+
+    print(f"👥 Пользователей: {args.users:,}")
+    print(f"📦 dict + user_data:   {legacy_bytes:7.0f} байт на практику, {legacy_bytes * args.users / 2**20:7.1f} МБ всего")
+    print(f"📦 PracticeSession:    {compact_bytes:7.0f} байт на практику, {compact_bytes * args.users / 2**20:7.1f} МБ всего")
+    print(f"📉 Экономия: {1 - compact_bytes / legacy_bytes:.0%}")
+
+    # Голосовое во время ожидания ответа не должно считаться записью окружения:
+    # тот же путь, что в handle_voice — поиск практики пользователя и проверка состояния
+    bot_data = {'user_sessions': {chat_id: s for chat_id, (s, _) in legacy.items()}}
+    started = time.perf_counter()
+    legacy_rejected = 0
+    for user_id in range(args.users):
+        s = bot_data.get('user_sessions', {}).get(user_id, {})
+        if not (s.get('should_be_recording') and not s.get('waiting_for_answer')):
+            legacy_rejected += 1
+    legacy_check = time.perf_counter() - started
+
+    started = time.perf_counter()
+    rejected = 0
+    for user_id in range(args.users):
+        practice = compact.get(user_id)
+        if practice is None or practice.state is not PracticeState.LISTENING:
+            rejected += 1
+    compact_check = time.perf_counter() - started
+
+    assert rejected == legacy_rejected == args.users
+    print(f"⚡ Отклонение голосового не в том состоянии: dict {legacy_check / args.users * 1e9:5.0f} нс, "
+          f"PracticeSession {compact_check / args.users * 1e9:5.0f} нс")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+"""
+Бенчмарк индекса похожих записей: top-k запросы на 1M векторов
+
+Создает во временном каталоге индекс из случайных нормированных векторов
+(по умолчанию 1 000 000 строк, 10 000 пользователей), открывает его заново
+через memmap и измеряет задержку запросов: по записям одного пользователя
+и по всему индексу.
+
+Пример:
+    python benchmarks/similarity_index.py --vectors 1000000 --queries 200
+"""
+
+import os
+import sys
+import time
+import argparse
+import tempfile
+
+import numpy as np
+
+# Подключаем модуль бота из корня репозитория
+CURRENT_DIR = os.path.dirname(os.path.abspath(__file__))
+PARENT_DIR = os.path.dirname(CURRENT_DIR)
+if PARENT_DIR not in sys.path:
+    sys.path.insert(0, PARENT_DIR)
+
+from simple_listening_bot import AUDIO_EMBEDDING_DIM, AudioSimilarityIndex
+
+
+def percentiles(samples: list) -> str:
+    ms = np.array(samples) * 1000
+    return f"p50 {np.percentile(ms, 50):7.2f} ms · p95 {np.percentile(ms, 95):7.2f} ms · max {ms.max():7.2f} ms"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Бенчмарк индекса похожих записей")
+    parser.add_argument('--vectors', type=int, default=1_000_000)
+    parser.add_argument('--users', type=int, default=10_000)
+    parser.add_argument('--queries', type=int, default=200)
+    parser.add_argument('--k', type=int, default=5)
+    parser.add_argument('--chunk', type=int, default=100_000, help="Строк за одну дозапись")
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(42)
+    with tempfile.TemporaryDirectory() as directory:
+        index = AudioSimilarityIndex(directory)
+        started = time.perf_counter()
+        for start in range(0, args.vectors, args.chunk):
+            n = min(args.chunk, args.vectors - start)
+            vectors = rng.standard_normal((n, AUDIO_EMBEDDING_DIM)).astype(np.float32)
+            vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+            index.add_many(
+                [f"{i:036d}" for i in range(start, start + n)],
+                rng.integers(0, args.users, n).tolist(),
+                vectors
+            )
+        print(f"📦 Построение: {time.perf_counter() - started:.1f} с")
+
+        started = time.perf_counter()
+        index = AudioSimilarityIndex(directory)
+        print(f"📂 Открытие (memmap + группировка по пользователям): {(time.perf_counter() - started) * 1000:.0f} ms")
+
+        user_latency, global_latency = [], []
+        for _ in range(args.queries):
+            row = int(rng.integers(0, len(index)))
+            user_id = int(index.rows['user_id'][row])
+            session_id = index.rows['session_id'][row].decode()
+
+            started = time.perf_counter()
+            index.similar_sessions(user_id, session_id, k=args.k)
+            user_latency.append(time.perf_counter() - started)
+
+            started = time.perf_counter()
+            index.query_vector(np.asarray(index.vectors[row]), k=args.k)
+            global_latency.append(time.perf_counter() - started)
+
+        print(f"👤 Записи пользователя: {percentiles(user_latency)}")
+        print(f"🌍 Весь индекс:         {percentiles(global_latency)}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,4 +1,4 @@
--- 🗄️ SQL скрипт для создания таблиц DeepListening Bot
+-- 🗄️ Миграция 001: исходные таблицы DeepListening Bot
 
 -- 1. Таблица пользователей
 CREATE TABLE IF NOT EXISTS listening_users (
@@ -0,0 +1,26 @@
+-- 🗄️ Миграция 002: схема совпадает с тем, что бот реально пишет и читает
+
+-- 1. Сессии прослушивания: поля практики, ответа и аудио окружения
+ALTER TABLE listening_sessions
+    ADD COLUMN IF NOT EXISTS session_date DATE DEFAULT CURRENT_DATE,
+    ADD COLUMN IF NOT EXISTS session_time TIME DEFAULT CURRENT_TIME,
+    ADD COLUMN IF NOT EXISTS status TEXT NOT NULL DEFAULT 'started',
+    ADD COLUMN IF NOT EXISTS what_heard_text TEXT,
+    ADD COLUMN IF NOT EXISTS what_heard_audio_file_id TEXT,
+    ADD COLUMN IF NOT EXISTS photo_file_id TEXT,
+    ADD COLUMN IF NOT EXISTS session_duration_seconds INTEGER,
+    ADD COLUMN IF NOT EXISTS environment_audio_file_id TEXT,
+    ADD COLUMN IF NOT EXISTS environment_audio_message_id BIGINT;
+
+-- 2. Аудио файлы: бот пишет telegram_file_id / file_type / duration_seconds
+ALTER TABLE audio_files
+    ADD COLUMN IF NOT EXISTS telegram_file_id TEXT,
+    ADD COLUMN IF NOT EXISTS file_type TEXT,
+    ADD COLUMN IF NOT EXISTS duration_seconds INTEGER;
+
+-- Старое поле file_id бот не заполняет — переносим значения и снимаем NOT NULL
+UPDATE audio_files SET telegram_file_id = file_id WHERE telegram_file_id IS NULL;
+ALTER TABLE audio_files ALTER COLUMN file_id DROP NOT NULL;
+
+COMMENT ON COLUMN listening_sessions.status IS 'started / completed / skipped';
+COMMENT ON COLUMN audio_files.file_type IS 'environment — звук окружения, reflection — голосовой ответ';
@@ -0,0 +1,22 @@
+-- 🗄️ Миграция 003: индексы под реальные запросы бота
+
+-- Библиотека, статистика и экспорт: сессии пользователя по времени
+CREATE INDEX IF NOT EXISTS idx_listening_sessions_user_created
+    ON listening_sessions (user_id, created_at DESC, id DESC);
+
+-- Поиск аудио сессии по типу (environment / reflection)
+CREATE INDEX IF NOT EXISTS idx_audio_files_session_type
+    ON audio_files (session_id, file_type);
+
+-- Дозаполнение транскрипций: только строки с заглушкой вместо текста
+CREATE INDEX IF NOT EXISTS idx_listening_sessions_transcription_placeholder
+    ON listening_sessions (created_at, id)
+    WHERE what_heard_text IN (
+        '[Голосовое сообщение — транскрипция недоступна]',
+        '[Не удалось распознать аудио]'
+    );
+
+-- Эти индексы покрываются составными (или UNIQUE-ограничением)
+DROP INDEX IF EXISTS idx_listening_sessions_user_id;
+DROP INDEX IF EXISTS idx_audio_files_session_id;
+DROP INDEX IF EXISTS idx_listening_users_telegram_user_id;
@@ -0,0 +1,58 @@
+-- 🗄️ Миграция 004: агрегаты практик по дням и неделям
+
+-- Формат ответа на "Что ты услышал?": text / voice / photo
+ALTER TABLE listening_sessions ADD COLUMN IF NOT EXISTS answer_type TEXT;
+
+-- Инкрементальная агрегация читает завершенные сессии по (completed_at, id)
+CREATE INDEX IF NOT EXISTS idx_listening_sessions_completed
+    ON listening_sessions (completed_at, id)
+    WHERE completed_at IS NOT NULL;
+
+-- 1. Дневные агрегаты
+CREATE TABLE IF NOT EXISTS practice_daily_stats (
+    user_id BIGINT NOT NULL,
+    day DATE NOT NULL,
+    sessions_count INTEGER NOT NULL DEFAULT 0,
+    listening_seconds INTEGER NOT NULL DEFAULT 0,
+    text_answers INTEGER NOT NULL DEFAULT 0,
+    voice_answers INTEGER NOT NULL DEFAULT 0,
+    photo_answers INTEGER NOT NULL DEFAULT 0,
+    keyword_counts JSONB NOT NULL DEFAULT '{}',
+    -- последняя учтенная сессия: повторная обработка пачки не задваивает данные
+    last_completed_at TIMESTAMP WITH TIME ZONE,
+    last_session_id UUID,
+    updated_at TIMESTAMP WITH TIME ZONE DEFAULT NOW(),
+    PRIMARY KEY (user_id, day)
+);
+
+-- 2. Недельные агрегаты (week_start — понедельник)
+CREATE TABLE IF NOT EXISTS practice_weekly_stats (
+    user_id BIGINT NOT NULL,
+    week_start DATE NOT NULL,
+    sessions_count INTEGER NOT NULL DEFAULT 0,
+    listening_seconds INTEGER NOT NULL DEFAULT 0,
+    text_answers INTEGER NOT NULL DEFAULT 0,
+    voice_answers INTEGER NOT NULL DEFAULT 0,
+    photo_answers INTEGER NOT NULL DEFAULT 0,
+    keyword_counts JSONB NOT NULL DEFAULT '{}',
+    last_completed_at TIMESTAMP WITH TIME ZONE,
+    last_session_id UUID,
+    updated_at TIMESTAMP WITH TIME ZONE DEFAULT NOW(),
+    PRIMARY KEY (user_id, week_start)
+);
+
+-- 3. Водяные знаки инкрементальных задач
+CREATE TABLE IF NOT EXISTS aggregation_watermarks (
+    name TEXT PRIMARY KEY,
+    last_completed_at TIMESTAMP WITH TIME ZONE,
+    last_session_id UUID,
+    updated_at TIMESTAMP WITH TIME ZONE DEFAULT NOW()
+);
+
+ALTER TABLE practice_daily_stats DISABLE ROW LEVEL SECURITY;
+ALTER TABLE practice_weekly_stats DISABLE ROW LEVEL SECURITY;
+ALTER TABLE aggregation_watermarks DISABLE ROW LEVEL SECURITY;
+
+COMMENT ON TABLE practice_daily_stats IS 'Агрегаты завершенных практик по дням (UTC)';
+COMMENT ON TABLE practice_weekly_stats IS 'Агрегаты завершенных практик по неделям (UTC)';
+COMMENT ON TABLE aggregation_watermarks IS 'До какой сессии обработаны инкрементальные агрегаты';
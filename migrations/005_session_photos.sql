@@ -0,0 +1,16 @@
+-- 🗄️ Миграция 005: все фото ответа (альбомы), а не только первое
+
+CREATE TABLE IF NOT EXISTS session_photos (
+    id UUID DEFAULT gen_random_uuid() PRIMARY KEY,
+    session_id UUID REFERENCES listening_sessions(id),
+    telegram_file_id TEXT NOT NULL,
+    file_size INTEGER,
+    position INTEGER NOT NULL DEFAULT 0,
+    created_at TIMESTAMP WITH TIME ZONE DEFAULT NOW()
+);
+
+CREATE INDEX IF NOT EXISTS idx_session_photos_session ON session_photos (session_id, position);
+
+ALTER TABLE session_photos DISABLE ROW LEVEL SECURITY;
+
+COMMENT ON TABLE session_photos IS 'Фото, приложенные к ответу на "Что ты услышал?"';
@@ -0,0 +1,8 @@
+-- 🗄️ Миграция 006: брошенные практики
+
+-- Периодическая очистка ищет незавершенные сессии по времени создания
+CREATE INDEX IF NOT EXISTS idx_listening_sessions_started
+    ON listening_sessions (created_at)
+    WHERE status = 'started';
+
+COMMENT ON COLUMN listening_sessions.status IS 'started / completed / skipped / abandoned';
@@ -0,0 +1,5 @@
+-- 🗄️ Миграция 007: практики с сопровождением (природа, город)
+
+ALTER TABLE listening_sessions ADD COLUMN IF NOT EXISTS practice_mode TEXT;
+
+COMMENT ON COLUMN listening_sessions.practice_mode IS 'nature / urban; NULL — свободная практика';
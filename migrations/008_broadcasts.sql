@@ -0,0 +1,34 @@
+-- 🗄️ Миграция 008: рассылки всем пользователям
+
+CREATE TABLE IF NOT EXISTS broadcasts (
+    id UUID DEFAULT gen_random_uuid() PRIMARY KEY,
+    text TEXT NOT NULL,
+    created_by BIGINT,
+    status TEXT NOT NULL DEFAULT 'draft',
+    last_user_id BIGINT,
+    sent_count INTEGER NOT NULL DEFAULT 0,
+    failed_count INTEGER NOT NULL DEFAULT 0,
+    created_at TIMESTAMP WITH TIME ZONE DEFAULT NOW(),
+    started_at TIMESTAMP WITH TIME ZONE,
+    finished_at TIMESTAMP WITH TIME ZONE
+);
+
+-- Статус доставки каждому получателю; первичный ключ не дает отправить дважды после перезапуска
+CREATE TABLE IF NOT EXISTS broadcast_deliveries (
+    broadcast_id UUID NOT NULL REFERENCES broadcasts(id),
+    telegram_user_id BIGINT NOT NULL,
+    status TEXT NOT NULL,
+    error TEXT,
+    delivered_at TIMESTAMP WITH TIME ZONE DEFAULT NOW(),
+    PRIMARY KEY (broadcast_id, telegram_user_id)
+);
+
+-- При старте бот ищет незавершенные рассылки
+CREATE INDEX IF NOT EXISTS idx_broadcasts_running ON broadcasts (created_at) WHERE status = 'running';
+
+ALTER TABLE broadcasts DISABLE ROW LEVEL SECURITY;
+ALTER TABLE broadcast_deliveries DISABLE ROW LEVEL SECURITY;
+
+COMMENT ON TABLE broadcasts IS 'Рассылки администратора; last_user_id — контрольная точка keyset-обхода listening_users';
+COMMENT ON COLUMN broadcasts.status IS 'draft / running / completed / cancelled';
+COMMENT ON COLUMN broadcast_deliveries.status IS 'sent / blocked / failed';
@@ -0,0 +1,18 @@
+-- 🗄️ Миграция 009: еженедельный дайджест
+
+-- Кому дайджест за неделю уже отправлен; первичный ключ не дает отправить дважды после перезапуска
+CREATE TABLE IF NOT EXISTS weekly_digest_deliveries (
+    user_id BIGINT NOT NULL,
+    week_start DATE NOT NULL,
+    status TEXT NOT NULL,
+    error TEXT,
+    delivered_at TIMESTAMP WITH TIME ZONE DEFAULT NOW(),
+    PRIMARY KEY (user_id, week_start)
+);
+
+-- Дайджест читает дневные агрегаты всех пользователей за неделю по (user_id, day) — это первичный ключ;
+-- записи окружения за неделю — по idx_listening_sessions_completed (completed_at, id)
+
+ALTER TABLE weekly_digest_deliveries DISABLE ROW LEVEL SECURITY;
+
+COMMENT ON TABLE weekly_digest_deliveries IS 'Доставка еженедельного дайджеста: sent / blocked / failed';
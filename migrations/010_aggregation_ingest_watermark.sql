@@ -0,0 +1,42 @@
+-- 🗄️ Миграция 010: водяной знак агрегатов по серверному времени записи
+
+-- completed_at приходит от клиента: записи из локальной очереди бота (outbox) доезжают позже
+-- со старым completed_at и оказывались бы позади водяного знака. completed_ingested_at ставит
+-- сама база, когда сессия впервые получает completed_at.
+ALTER TABLE listening_sessions ADD COLUMN IF NOT EXISTS completed_ingested_at TIMESTAMP WITH TIME ZONE;
+
+CREATE OR REPLACE FUNCTION set_completed_ingested_at() RETURNS trigger AS $$
+BEGIN
+    IF NEW.completed_at IS NOT NULL AND (TG_OP = 'INSERT' OR OLD.completed_at IS NULL) THEN
+        NEW.completed_ingested_at := clock_timestamp();
+    ELSIF TG_OP = 'UPDATE' THEN
+        NEW.completed_ingested_at := OLD.completed_ingested_at;
+    END IF;
+    RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS trg_listening_sessions_completed_ingested_at ON listening_sessions;
+CREATE TRIGGER trg_listening_sessions_completed_ingested_at
+    BEFORE INSERT OR UPDATE ON listening_sessions
+    FOR EACH ROW EXECUTE FUNCTION set_completed_ingested_at();
+
+-- Уже завершенные сессии: порядок совпадает со старым водяным знаком
+UPDATE listening_sessions SET completed_ingested_at = completed_at
+    WHERE completed_at IS NOT NULL AND completed_ingested_at IS NULL;
+
+CREATE INDEX IF NOT EXISTS idx_listening_sessions_completed_ingested
+    ON listening_sessions (completed_ingested_at, id)
+    WHERE completed_ingested_at IS NOT NULL;
+
+-- Позиция последней учтенной сессии в агрегатах и водяном знаке — тоже по времени записи
+ALTER TABLE practice_daily_stats ADD COLUMN IF NOT EXISTS last_ingested_at TIMESTAMP WITH TIME ZONE;
+ALTER TABLE practice_weekly_stats ADD COLUMN IF NOT EXISTS last_ingested_at TIMESTAMP WITH TIME ZONE;
+ALTER TABLE aggregation_watermarks ADD COLUMN IF NOT EXISTS last_ingested_at TIMESTAMP WITH TIME ZONE;
+
+UPDATE practice_daily_stats SET last_ingested_at = last_completed_at WHERE last_ingested_at IS NULL;
+UPDATE practice_weekly_stats SET last_ingested_at = last_completed_at WHERE last_ingested_at IS NULL;
+UPDATE aggregation_watermarks SET last_ingested_at = last_completed_at
+    WHERE name = 'practice_stats' AND last_ingested_at IS NULL;
+
+COMMENT ON COLUMN listening_sessions.completed_ingested_at IS 'Когда база получила completed_at (водяной знак агрегатов)';
@@ -0,0 +1,13 @@
+-- 🗄️ Миграция 011: частичный индекс дозаполнения транскрипций с заглушкой фоновой транскрипции
+
+-- scripts/backfill_transcriptions.py ищет три заглушки, включая незавершенную фоновую
+-- транскрипцию длинной записи. Индекс из 003 покрывал только две: IN из трех значений
+-- не следует из его условия, и запрос читал listening_sessions целиком.
+DROP INDEX IF EXISTS idx_listening_sessions_transcription_placeholder;
+CREATE INDEX idx_listening_sessions_transcription_placeholder
+    ON listening_sessions (created_at, id)
+    WHERE what_heard_text IN (
+        '[Голосовое сообщение — транскрипция недоступна]',
+        '[Не удалось распознать аудио]',
+        '[Длинная запись — транскрипция в процессе]'
+    );
@@ -0,0 +1,44 @@
+-- 🗄️ Миграция 012: ключевые слова из транскрипций, пришедших после завершения сессии
+
+-- Голосовой ответ завершает сессию с заглушкой, текст приходит позже (фоновая или
+-- кусочная транскрипция, scripts/backfill_transcriptions.py). text_ingested_at ставит
+-- база, когда заглушка впервые заменяется текстом у завершенной сессии: такие сессии
+-- агрегаты учитывают дважды — счетчики по completed_ingested_at, ключевые слова по
+-- text_ingested_at.
+ALTER TABLE listening_sessions ADD COLUMN IF NOT EXISTS text_ingested_at TIMESTAMP WITH TIME ZONE;
+
+CREATE OR REPLACE FUNCTION set_text_ingested_at() RETURNS trigger AS $$
+DECLARE
+    placeholders TEXT[] := ARRAY[
+        '[Голосовое сообщение — транскрипция недоступна]',
+        '[Не удалось распознать аудио]',
+        '[Длинная запись — транскрипция в процессе]'
+    ];
+BEGIN
+    IF NEW.completed_at IS NOT NULL AND OLD.text_ingested_at IS NULL
+            AND OLD.what_heard_text = ANY(placeholders)
+            AND NEW.what_heard_text IS NOT NULL AND NOT NEW.what_heard_text = ANY(placeholders) THEN
+        NEW.text_ingested_at := clock_timestamp();
+    ELSE
+        NEW.text_ingested_at := OLD.text_ingested_at;
+    END IF;
+    RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS trg_listening_sessions_text_ingested_at ON listening_sessions;
+CREATE TRIGGER trg_listening_sessions_text_ingested_at
+    BEFORE UPDATE ON listening_sessions
+    FOR EACH ROW EXECUTE FUNCTION set_text_ingested_at();
+
+CREATE INDEX IF NOT EXISTS idx_listening_sessions_text_ingested
+    ON listening_sessions (text_ingested_at, id)
+    WHERE text_ingested_at IS NOT NULL;
+
+-- Последняя учтенная поздняя транскрипция в строке агрегата: повтор пачки не задваивает слова
+ALTER TABLE practice_daily_stats ADD COLUMN IF NOT EXISTS last_text_ingested_at TIMESTAMP WITH TIME ZONE;
+ALTER TABLE practice_daily_stats ADD COLUMN IF NOT EXISTS last_text_session_id UUID;
+ALTER TABLE practice_weekly_stats ADD COLUMN IF NOT EXISTS last_text_ingested_at TIMESTAMP WITH TIME ZONE;
+ALTER TABLE practice_weekly_stats ADD COLUMN IF NOT EXISTS last_text_session_id UUID;
+
+COMMENT ON COLUMN listening_sessions.text_ingested_at IS 'Когда заглушка транскрипции заменена текстом (водяной знак ключевых слов)';
@@ -0,0 +1,7 @@
+-- 🗄️ Миграция 013: индекс дневных агрегатов по дню для еженедельного дайджеста
+
+-- Дайджест читает дневные агрегаты всех пользователей за одну неделю. Первичный ключ
+-- (user_id, day) такой диапазон не отсекает — пришлось бы пройти его целиком, поэтому
+-- страницы идут по (day, user_id) с этим индексом.
+CREATE INDEX IF NOT EXISTS idx_practice_daily_stats_day_user
+    ON practice_daily_stats (day, user_id);
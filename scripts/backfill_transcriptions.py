@@ -0,0 +1,245 @@
+#!/usr/bin/env python3
+"""
+Дозаполнение транскрипций голосовых рефлексий
+
+Находит сессии, где вместо текста сохранена заглушка
+("транскрипция недоступна" / "не удалось распознать" / незавершенная
+фоновая транскрипция длинной записи), скачивает
+голосовые ответы из Telegram с ограниченным параллелизмом и распознает
+их пачками. Каждый запуск читает выборку с начала: дозаполненные
+сессии из нее выпадают, поэтому скрипт можно прервать и запустить
+снова, а сессии, получившие заглушку уже после прошлого запуска, не
+пропускаются. Сессии, которые не удалось скачать, распознать или
+сохранить, запоминаются в checkpoint-файле и повторяются в начале
+следующего запуска.
+
+Примеры:
+    python scripts/backfill_transcriptions.py
+    python scripts/backfill_transcriptions.py --backend mypackage.stt:LocalBackend --batch-size 10
+"""
+
+import os
+import sys
+import json
+import asyncio
+import argparse
+from urllib.parse import quote
+
+import requests
+from dotenv import load_dotenv
+
+# Подключаем модуль бота из корня репозитория
+CURRENT_DIR = os.path.dirname(os.path.abspath(__file__))
+PARENT_DIR = os.path.dirname(CURRENT_DIR)
+if PARENT_DIR not in sys.path:
+    sys.path.insert(0, PARENT_DIR)
+
+from simple_listening_bot import (
+    TRANSCRIPTION_UNAVAILABLE,
+    TRANSCRIPTION_FAILED,
+    TRANSCRIPTION_EMPTY,
+    TRANSCRIPTION_PENDING,
+    RateLimiter,
+    download_telegram_file,
+    load_transcription_backend,
+)
+
+# Загружаем переменные окружения
+load_dotenv()
+
+TELEGRAM_BOT_TOKEN = os.getenv('TELEGRAM_BOT_TOKEN')
+SUPABASE_URL = os.getenv('SUPABASE_URL')
+SUPABASE_KEY = os.getenv('SUPABASE_ANON_KEY')
+TIMEOUT = float(os.getenv('SUPABASE_TIMEOUT', '5'))
+
+HEADERS = {
+    'apikey': SUPABASE_KEY,
+    'Authorization': f'Bearer {SUPABASE_KEY}',
+    'Content-Type': 'application/json',
+    'Prefer': 'return=minimal'
+}
+
+# TRANSCRIPTION_PENDING остается, если бот перезапустился, не дорасшифровав длинную запись из фоновой очереди
+PLACEHOLDERS = [TRANSCRIPTION_UNAVAILABLE, TRANSCRIPTION_FAILED, TRANSCRIPTION_PENDING]
+
+
+def load_failed(path: str) -> set:
+    """Читаем id сессий, которые не удалось обработать в прошлые запуски"""
+    if not os.path.exists(path):
+        return set()
+    with open(path, encoding='utf-8') as f:
+        return set(json.load(f).get('failed', []))
+
+
+def save_failed(path: str, failed: set):
+    """Атомарно сохраняем неудавшиеся сессии, чтобы не потерять их при падении"""
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump({'failed': sorted(failed)}, f)
+    os.replace(tmp_path, path)
+
+
+def fetch_page(after, page_size: int) -> list:
+    """Страница сессий с заглушкой вместо транскрипции (keyset по created_at, id в пределах одного запуска)"""
+    values = ",".join(quote(f'"{p}"', safe='') for p in PLACEHOLDERS)
+    url = (
+        f"{SUPABASE_URL}/rest/v1/listening_sessions"
+        f"?what_heard_text=in.({values})&select=id,created_at"
+        f"&order=created_at.asc,id.asc&limit={page_size}"
+    )
+    if after:
+        ts = quote(f'"{after["created_at"]}"', safe='')
+        url += f"&or=(created_at.gt.{ts},and(created_at.eq.{ts},id.gt.{after['id']}))"
+    r = requests.get(url, headers=HEADERS, timeout=TIMEOUT)
+    r.raise_for_status()
+    return r.json() or []
+
+
+def fetch_sessions(session_ids: list) -> list:
+    """Сессии из списка, у которых все еще заглушка вместо текста (повтор неудавшихся)"""
+    values = ",".join(quote(f'"{p}"', safe='') for p in PLACEHOLDERS)
+    url = (
+        f"{SUPABASE_URL}/rest/v1/listening_sessions"
+        f"?id=in.({','.join(session_ids)})&what_heard_text=in.({values})&select=id,created_at"
+        f"&order=created_at.asc,id.asc"
+    )
+    r = requests.get(url, headers=HEADERS, timeout=TIMEOUT)
+    r.raise_for_status()
+    return r.json() or []
+
+
+def fetch_reflection_files(session_ids: list) -> dict:
+    """Одним запросом получаем file_id голосовых ответов для пачки сессий"""
+    ids = ",".join(session_ids)
+    url = (
+        f"{SUPABASE_URL}/rest/v1/audio_files"
+        f"?session_id=in.({ids})&file_type=eq.reflection&select=session_id,telegram_file_id"
+    )
+    r = requests.get(url, headers=HEADERS, timeout=TIMEOUT)
+    r.raise_for_status()
+    return {row['session_id']: row['telegram_file_id'] for row in r.json() or []}
+
+
+def save_transcription(session_id: str, text: str):
+    """Обновляем текст рефлексии"""
+    url = f"{SUPABASE_URL}/rest/v1/listening_sessions?id=eq.{session_id}"
+    r = requests.patch(url, headers=HEADERS, data=json.dumps({'what_heard_text': text}), timeout=TIMEOUT)
+    r.raise_for_status()
+
+
+async def download_batch(file_ids: dict, concurrency: int) -> dict:
+    """Скачиваем аудио параллельно, но не больше concurrency одновременно"""
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def download(session_id: str, file_id: str):
+        async with semaphore:
+            try:
+                return session_id, await asyncio.to_thread(download_telegram_file, TELEGRAM_BOT_TOKEN, file_id)
+            except Exception as e:
+                print(f"⚠️ Не удалось скачать аудио для сессии {session_id}: {e}")
+                return session_id, None
+
+    results = await asyncio.gather(*(download(sid, fid) for sid, fid in file_ids.items()))
+    return {sid: audio for sid, audio in results if audio is not None}
+
+
+async def process_rows(rows: list, backend, limiter: RateLimiter, args) -> tuple:
+    """Скачиваем и распознаем пачку сессий. Возвращаем (обновлено, id неудавшихся сессий)"""
+    file_ids = await asyncio.to_thread(fetch_reflection_files, [row['id'] for row in rows])
+    downloaded = await download_batch(file_ids, args.concurrency)
+
+    session_ids = list(downloaded)
+    # Без голосового ответа или не скачалось — повторим при следующем запуске
+    failed = {row['id'] for row in rows if row['id'] not in downloaded}
+    for _ in session_ids:
+        await limiter.acquire()
+    try:
+        texts = await asyncio.to_thread(backend.transcribe_batch, [downloaded[sid] for sid in session_ids])
+    except Exception as e:
+        print(f"❌ Ошибка распознавания пачки: {e}")
+        return 0, failed | set(session_ids)
+
+    updated = 0
+    for session_id, text in zip(session_ids, texts):
+        text = (text or "").strip() or TRANSCRIPTION_EMPTY
+        if args.dry_run:
+            print(f"📝 {session_id}: {text[:80]}")
+            continue
+        try:
+            await asyncio.to_thread(save_transcription, session_id, text)
+            updated += 1
+        except Exception as e:
+            print(f"⚠️ Не удалось сохранить транскрипцию сессии {session_id}: {e}")
+            failed.add(session_id)
+    return updated, failed
+
+
+async def backfill(args):
+    backend = load_transcription_backend(args.backend)
+    limiter = RateLimiter(rate=args.rate, burst=args.batch_size)
+    failed = load_failed(args.checkpoint)
+    if failed:
+        print(f"↩️ К повтору с прошлых запусков: {len(failed)}")
+
+    processed = updated = 0
+
+    # Сначала повторяем сессии, которые не получилось обработать в прошлые запуски
+    retried = sorted(failed)
+    for offset in range(0, len(retried), args.batch_size):
+        chunk = retried[offset:offset + args.batch_size]
+        rows = await asyncio.to_thread(fetch_sessions, chunk)
+        failed -= set(chunk)
+        if rows:
+            chunk_updated, chunk_failed = await process_rows(rows, backend, limiter, args)
+            updated += chunk_updated
+            failed |= chunk_failed
+            processed += len(rows)
+
+    # Позиция живет только в памяти: заглушка может появиться у сессии с любым created_at
+    # (упавшая транскрипция, перезапуск бота), поэтому каждый запуск идет с начала выборки
+    after, retried = None, set(retried)
+    while args.limit is None or processed < args.limit:
+        page = await asyncio.to_thread(fetch_page, after, args.batch_size)
+        if not page:
+            break
+        after = page[-1]
+
+        # Уже повторенные в этом запуске сессии второй раз не трогаем
+        rows = [row for row in page if row['id'] not in retried]
+        if rows:
+            page_updated, page_failed = await process_rows(rows, backend, limiter, args)
+            updated += page_updated
+            failed |= page_failed
+            processed += len(rows)
+
+        if not args.dry_run:
+            save_failed(args.checkpoint, failed)
+        print(f"✅ Обработано: {processed}, обновлено: {updated}, к повтору: {len(failed)}")
+
+    if not args.dry_run:
+        save_failed(args.checkpoint, failed)
+    print(f"🎉 Готово! Обработано сессий: {processed}, обновлено: {updated}, к повтору: {len(failed)}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Дозаполнение транскрипций голосовых рефлексий")
+    parser.add_argument('--backend', default=os.getenv('TRANSCRIPTION_BACKEND', 'openai'),
+                        help="'openai' или 'package.module:ClassName'")
+    parser.add_argument('--batch-size', type=int, default=20, help="Размер пачки сессий")
+    parser.add_argument('--concurrency', type=int, default=4, help="Одновременных загрузок из Telegram")
+    parser.add_argument('--rate', type=float, default=1.0, help="Распознаваний в секунду")
+    parser.add_argument('--checkpoint', default='backfill_transcriptions.checkpoint.json',
+                        help="Файл с id сессий, которые не удалось обработать")
+    parser.add_argument('--limit', type=int, default=None, help="Максимум сессий за запуск")
+    parser.add_argument('--dry-run', action='store_true', help="Только показать результат, не сохранять")
+    args = parser.parse_args()
+
+    if not all([TELEGRAM_BOT_TOKEN, SUPABASE_URL, SUPABASE_KEY]):
+        print("❌ Не все переменные окружения установлены!")
+        sys.exit(1)
+
+    asyncio.run(backfill(args))
+
+
+if __name__ == "__main__":
+    main()
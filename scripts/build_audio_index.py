@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+"""
+Построение индекса похожих звуковых ландшафтов по уже сохраненным записям
+
+Проходит по audio_files с file_type='environment' (keyset-пагинация),
+пропускает записи, которые уже есть в индексе, скачивает остальные из
+Telegram с ограниченным параллелизмом, считает эмбеддинги в пуле
+процессов и дописывает их в индекс пачками. Повторный запуск продолжает
+с того места, где остановился предыдущий. Можно запускать, не останавливая
+бота: дозапись в индекс идет под блокировкой index.lock.
+
+Пример:
+    python scripts/build_audio_index.py --concurrency 4 --workers 2
+"""
+
+import os
+import sys
+import asyncio
+import argparse
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from urllib.parse import quote
+
+import numpy as np
+import requests
+from dotenv import load_dotenv
+
+# Подключаем модуль бота из корня репозитория
+CURRENT_DIR = os.path.dirname(os.path.abspath(__file__))
+PARENT_DIR = os.path.dirname(CURRENT_DIR)
+if PARENT_DIR not in sys.path:
+    sys.path.insert(0, PARENT_DIR)
+
+from simple_listening_bot import AudioSimilarityIndex, compute_audio_embedding, download_telegram_file
+
+# Загружаем переменные окружения
+load_dotenv()
+
+TELEGRAM_BOT_TOKEN = os.getenv('TELEGRAM_BOT_TOKEN')
+SUPABASE_URL = os.getenv('SUPABASE_URL')
+SUPABASE_KEY = os.getenv('SUPABASE_ANON_KEY')
+TIMEOUT = float(os.getenv('SUPABASE_TIMEOUT', '5'))
+
+HEADERS = {
+    'apikey': SUPABASE_KEY,
+    'Authorization': f'Bearer {SUPABASE_KEY}',
+}
+
+
+def fetch_page(after, page_size: int) -> list:
+    """Страница записей окружения с user_id сессии (keyset по created_at, id)"""
+    url = (
+        f"{SUPABASE_URL}/rest/v1/audio_files"
+        f"?file_type=eq.environment"
+        f"&select=id,created_at,session_id,telegram_file_id,listening_sessions!inner(user_id)"
+        f"&order=created_at.asc,id.asc&limit={page_size}"
+    )
+    if after:
+        ts = quote(f'"{after["created_at"]}"', safe='')
+        url += f"&or=(created_at.gt.{ts},and(created_at.eq.{ts},id.gt.{after['id']}))"
+    r = requests.get(url, headers=HEADERS, timeout=TIMEOUT)
+    r.raise_for_status()
+    return r.json() or []
+
+
+async def embed_page(rows: list, pool: ProcessPoolExecutor, concurrency: int) -> list:
+    """Скачиваем и считаем эмбеддинги параллельно: [(row, vector), ...] для удачных"""
+    semaphore = asyncio.Semaphore(concurrency)
+    loop = asyncio.get_running_loop()
+
+    async def embed(row: dict):
+        async with semaphore:
+            try:
+                audio, _ = await asyncio.to_thread(download_telegram_file, TELEGRAM_BOT_TOKEN, row['telegram_file_id'])
+                return row, await loop.run_in_executor(pool, compute_audio_embedding, audio)
+            except Exception as e:
+                print(f"⚠️ Пропускаем запись сессии {row['session_id']}: {e}")
+                return row, None
+
+    results = await asyncio.gather(*(embed(row) for row in rows))
+    return [(row, vector) for row, vector in results if vector is not None]
+
+
+async def build(args):
+    index = AudioSimilarityIndex(args.index_dir)
+    print(f"📂 В индексе уже {len(index)} записей")
+
+    pool = ProcessPoolExecutor(max_workers=args.workers, mp_context=multiprocessing.get_context('spawn'))
+    added = 0
+    after = None
+    try:
+        while True:
+            page = await asyncio.to_thread(fetch_page, after, args.page_size)
+            if not page:
+                break
+            after = page[-1]
+
+            todo = [
+                row for row in page
+                if row.get('telegram_file_id')
+                and not index.contains(row['listening_sessions']['user_id'], row['session_id'])
+            ]
+            embedded = await embed_page(todo, pool, args.concurrency)
+            if embedded:
+                index.add_many(
+                    [row['session_id'] for row, _ in embedded],
+                    [row['listening_sessions']['user_id'] for row, _ in embedded],
+                    np.stack([vector for _, vector in embedded])
+                )
+                added += len(embedded)
+                print(f"✅ Добавлено: {added}")
+    finally:
+        pool.shutdown()
+
+    print(f"🎉 Готово! В индексе {len(index)} записей (добавлено {added})")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Построение индекса похожих записей окружения")
+    parser.add_argument('--index-dir', default=os.getenv('AUDIO_INDEX_DIR', 'audio_index'))
+    parser.add_argument('--page-size', type=int, default=200)
+    parser.add_argument('--concurrency', type=int, default=4, help="Одновременных загрузок из Telegram")
+    parser.add_argument('--workers', type=int, default=max(1, (os.cpu_count() or 2) - 1), help="Процессов для эмбеддингов")
+    args = parser.parse_args()
+
+    if not all([TELEGRAM_BOT_TOKEN, SUPABASE_URL, SUPABASE_KEY]):
+        print("❌ Не все переменные окружения установлены!")
+        sys.exit(1)
+
+    asyncio.run(build(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,247 @@
+#!/usr/bin/env python3
+"""
+Воспроизведение записанного трафика апдейтов против локальных заглушек
+
+Читает журнал, записанный ботом при UPDATE_LOG_PATH (gzip JSON Lines с
+анонимизированными апдейтами), и подает апдейты в обработчики
+SimpleListeningBot с исходными интервалами, ускоренными в --speed раз.
+Bot API и Supabase заменены локальными заглушками с настраиваемой
+задержкой, распознавание и индекс похожих записей отключены, поэтому
+прогон ничего не отправляет наружу. Так можно повторить, например,
+всплеск после утреннего напоминания и посмотреть задержку обработки,
+пропускную способность и пик памяти.
+
+Примеры:
+    python scripts/replay_updates.py updates.jsonl.gz --speed 10
+    python scripts/replay_updates.py updates.jsonl.gz --since 06:55 --until 07:30 --speed 60 --trace-memory
+    python scripts/replay_updates.py updates.jsonl.gz --speed 0 --supabase-latency 40 --telegram-latency 80
+"""
+
+import os
+import sys
+import json
+import asyncio
+import argparse
+import tempfile
+import tracemalloc
+from itertools import count
+from datetime import datetime, timezone
+from time import monotonic
+
+import numpy as np
+import requests
+
+# Подключаем модуль бота из корня репозитория
+CURRENT_DIR = os.path.dirname(os.path.abspath(__file__))
+PARENT_DIR = os.path.dirname(CURRENT_DIR)
+if PARENT_DIR not in sys.path:
+    sys.path.insert(0, PARENT_DIR)
+
+# Окружение прогона задаем до импорта бота: load_dotenv не перезаписывает уже
+# установленные переменные, поэтому настоящие токены из .env не используются
+REPLAY_DIR = tempfile.mkdtemp(prefix='replay_')
+REPLAY_ENV = {
+    'TELEGRAM_BOT_TOKEN': '1:replay',
+    'SUPABASE_URL': 'http://supabase.replay',
+    'SUPABASE_ANON_KEY': 'replay',
+    'OPENAI_API_KEY': '',
+    'TRANSCRIPTION_BACKEND': 'openai',
+    'UPDATE_LOG_PATH': '',
+    'PRACTICE_ASSETS_CHAT_ID': '',
+    'SUPABASE_OUTBOX_PATH': os.path.join(REPLAY_DIR, 'outbox.sqlite3'),
+    'KNOWN_USERS_PATH': os.path.join(REPLAY_DIR, 'known_users.sqlite3'),
+    'PRACTICE_ASSETS_CACHE_PATH': os.path.join(REPLAY_DIR, 'audio_assets.sqlite3'),
+    'AUDIO_INDEX_DIR': os.path.join(REPLAY_DIR, 'audio_index'),
+    'LOG_LEVEL': 'WARNING',
+}
+os.environ.update(REPLAY_ENV)
+
+from telegram import Update
+from telegram.ext import TypeHandler
+from telegram.request import BaseRequest
+
+from simple_listening_bot import SimpleListeningBot, configure_logging, read_update_log
+
+
+class StandInTelegramRequest(BaseRequest):
+    """HTTP-слой Bot API без сети: на каждый метод отвечает правдоподобным результатом"""
+
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+        self.message_ids = count(1)
+        self.calls: dict = {}
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    def _message(self, params: dict, **extra) -> dict:
+        chat_id = int(params.get('chat_id') or 1)
+        return {
+            'message_id': int(params.get('message_id') or next(self.message_ids)),
+            'date': int(datetime.now(timezone.utc).timestamp()),
+            'chat': {'id': chat_id, 'type': 'private'},
+            **extra,
+        }
+
+    def _result(self, endpoint: str, params: dict):
+        if endpoint == 'getMe':
+            return {'id': 1, 'is_bot': True, 'first_name': 'Replay', 'username': 'replay_bot'}
+        if endpoint in ('sendMessage', 'editMessageText'):
+            return self._message(params, text=str(params.get('text', '')))
+        if endpoint == 'sendVoice':
+            n = next(self.message_ids)
+            return self._message(params, voice={'file_id': f'replay-voice-{n}', 'file_unique_id': f'rv{n}', 'duration': 1})
+        if endpoint == 'sendPhoto':
+            n = next(self.message_ids)
+            return self._message(params, photo=[{'file_id': f'replay-photo-{n}', 'file_unique_id': f'rp{n}', 'width': 1, 'height': 1}])
+        if endpoint == 'sendDocument':
+            n = next(self.message_ids)
+            return self._message(params, document={'file_id': f'replay-doc-{n}', 'file_unique_id': f'rd{n}'})
+        if endpoint == 'getFile':
+            return {'file_id': params.get('file_id'), 'file_unique_id': 'replay', 'file_size': 0, 'file_path': 'replay/file'}
+        return True
+
+    async def do_request(self, url, method, request_data=None, read_timeout=None, write_timeout=None,
+                         connect_timeout=None, pool_timeout=None):
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        endpoint = url.rsplit('/', 1)[-1]
+        self.calls[endpoint] = self.calls.get(endpoint, 0) + 1
+        params = request_data.parameters if request_data else {}
+        body = {'ok': True, 'result': self._result(endpoint, params)}
+        return 200, json.dumps(body).encode()
+
+
+class StandInSupabase:
+    """Заглушка PostgREST: чтения пустые, записи успешны (representation — эхо тела)"""
+
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+        self.calls: dict = {}
+
+    async def request(self, method: str, url: str, headers=None, data=None, fail_fast: bool = False):
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        table = url.split('/rest/v1/', 1)[-1].split('?', 1)[0]
+        self.calls[(method, table)] = self.calls.get((method, table), 0) + 1
+
+        response = requests.Response()
+        response.url = url
+        if method == 'GET':
+            response.status_code, payload = 200, []
+        elif 'return=representation' in (headers or {}).get('Prefer', ''):
+            rows = json.loads(data) if data else {}
+            response.status_code, payload = 201, rows if isinstance(rows, list) else [rows]
+        else:
+            response.status_code, payload = 201, None
+        response._content = b'' if payload is None else json.dumps(payload).encode()
+        return response
+
+
+def parse_clock(value: str):
+    """'06:55' → секунды от полуночи UTC"""
+    hours, minutes = value.split(':')
+    return int(hours) * 3600 + int(minutes) * 60
+
+
+def select_updates(path: str, since, until, limit) -> list:
+    """Апдейты журнала, попавшие в окно времени суток (UTC) [since, until)"""
+    selected = []
+    for ts, update in read_update_log(path):
+        clock = ts % 86400
+        if since is not None and clock < since:
+            continue
+        if until is not None and clock >= until:
+            continue
+        selected.append((ts, update))
+        if limit and len(selected) >= limit:
+            break
+    return selected
+
+
+async def replay(args):
+    updates = select_updates(args.log, args.since, args.until, args.limit)
+    if not updates:
+        print("🤷 В журнале нет апдейтов для воспроизведения")
+        return
+
+    telegram = StandInTelegramRequest(args.telegram_latency / 1000)
+    supabase = StandInSupabase(args.supabase_latency / 1000)
+    bot = SimpleListeningBot(telegram_request=telegram)
+    bot._supabase_request = supabase.request
+    bot.transcriber = None
+    bot.audio_index = None
+
+    # Время ожидания апдейта в очереди: от подачи до начала обработки (самая первая группа обработчиков)
+    arrivals: dict = {}
+    waits: list = []
+
+    async def mark_started(update: Update, context):
+        waits.append(monotonic() - arrivals.pop(update.update_id, monotonic()))
+
+    application = bot.application
+    application.add_handler(TypeHandler(Update, mark_started), group=-10)
+    await application.initialize()
+    await application.start()
+
+    if args.trace_memory:
+        tracemalloc.start()
+
+    # Апдейты кладутся в update_queue, как при polling/webhook: обработка идет
+    # тем же циклом Application, что и в production (по одному, по порядку)
+    first_ts = updates[0][0]
+    started = monotonic()
+    for ts, data in updates:
+        if args.speed > 0:
+            delay = (ts - first_ts) / args.speed - (monotonic() - started)
+            if delay > 0:
+                await asyncio.sleep(delay)
+        update = Update.de_json(data, application.bot)
+        arrivals[update.update_id] = monotonic()
+        await application.update_queue.put(update)
+    fed = monotonic() - started
+
+    await application.update_queue.join()
+    elapsed = monotonic() - started
+    peak = tracemalloc.get_traced_memory()[1] if args.trace_memory else None
+
+    await application.stop()
+    await application.shutdown()
+
+    span = updates[-1][0] - first_ts
+    print(f"📼 Апдейтов: {len(updates)} за {span:.0f} с исходного времени (ускорение x{args.speed:g})")
+    print(f"⏱️ Подача: {fed:.2f} с, обработка всего: {elapsed:.2f} с, {len(updates) / elapsed:.1f} апдейтов/с")
+    waits = np.array(waits)
+    print(f"📈 Ожидание в очереди: p50 {np.percentile(waits, 50) * 1000:.0f} мс, "
+          f"p99 {np.percentile(waits, 99) * 1000:.0f} мс, max {waits.max() * 1000:.0f} мс")
+    if peak is not None:
+        print(f"🧠 Пик памяти (tracemalloc): {peak / 2**20:.1f} МБ")
+    print("📨 Bot API: " + ", ".join(f"{name}={n}" for name, n in sorted(telegram.calls.items())))
+    print("🗄️ Supabase: " + ", ".join(f"{method} {table}={n}" for (method, table), n in sorted(supabase.calls.items())))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Воспроизведение журнала апдейтов против локальных заглушек")
+    parser.add_argument('log', help="Журнал, записанный при UPDATE_LOG_PATH (.jsonl.gz)")
+    parser.add_argument('--speed', type=float, default=1.0, help="Ускорение относительно записи; 0 — без пауз")
+    parser.add_argument('--since', type=parse_clock, default=None, help="Начало окна времени суток UTC, ЧЧ:ММ")
+    parser.add_argument('--until', type=parse_clock, default=None, help="Конец окна времени суток UTC, ЧЧ:ММ")
+    parser.add_argument('--limit', type=int, default=None, help="Максимум апдейтов")
+    parser.add_argument('--telegram-latency', type=float, default=0.0, help="Задержка ответа Bot API, мс")
+    parser.add_argument('--supabase-latency', type=float, default=0.0, help="Задержка ответа Supabase, мс")
+    parser.add_argument('--trace-memory', action='store_true', help="Замерить пик памяти через tracemalloc")
+    args = parser.parse_args()
+
+    if not os.path.exists(args.log):
+        print(f"❌ Журнал не найден: {args.log}")
+        sys.exit(1)
+
+    configure_logging()
+    asyncio.run(replay(args))
+
+
+if __name__ == "__main__":
+    main()
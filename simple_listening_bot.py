@@ -11,14 +11,42 @@ Simple Deep Listening Bot - MVP версия
 """
 
 import os
+import sys
+import abc
+import atexit
 import logging
+import logging.handlers
 import asyncio
+import contextlib
+import contextvars
+import enum
+import gzip
+import hashlib
+import hmac
+import importlib
 import io
-from datetime import datetime, time, timedelta
-from typing import Optional
+import multiprocessing
+import queue
+import random
+import re
+import sqlite3
+import tempfile
+import threading
+import uuid
+import wave
+import zipfile
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from datetime import date, datetime, time, timedelta, timezone
+from time import monotonic
+from typing import Optional, Union
+from urllib.parse import quote
 
+import numpy as np
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
-from telegram.ext import Application, CommandHandler, MessageHandler, CallbackQueryHandler, ContextTypes, filters
+from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter, TelegramError
+from telegram.ext import Application, CommandHandler, MessageHandler, CallbackQueryHandler, TypeHandler, ContextTypes, filters
 from dotenv import load_dotenv
 from openai import OpenAI
 import requests
@@ -27,15 +55,1334 @@ import json
 # Загружаем переменные окружения
 load_dotenv()
 
-# Настройка логирования
-logging.basicConfig(
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    level=logging.INFO
-)
+# ===== Логирование =====
+# Идентификатор текущего апдейта Telegram: попадает в каждую строку лога, пока апдейт обрабатывается
+correlation_id: contextvars.ContextVar = contextvars.ContextVar('correlation_id', default='-')
+
+# Частые события об успехе пишем выборочно (доля от 0 до 1); ошибки не сэмплируются никогда
+DEFAULT_LOG_SAMPLE_RATES = {
+    'user_registered': 0.1,
+    'voice_answer_saved': 0.1,
+    'transcription_saved': 0.1,
+    'text_answer_saved': 0.1,
+    'photo_answer_saved': 0.1,
+    'environment_audio_saved': 0.1,
+    'audio_metadata_saved': 0.1,
+    'route_timing': 0.01,
+    'file_id_cache': 0.01,
+}
+
+
+class CorrelationIdFilter(logging.Filter):
+    """Добавляем correlation_id в запись (вызывается в потоке, который пишет лог)."""
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        record.correlation_id = correlation_id.get()
+        return True
+
+
+class SamplingFilter(logging.Filter):
+    """Пропускаем только часть записей с extra={'event': ...} уровня INFO и ниже."""
+
+    def __init__(self, rates: dict):
+        super().__init__()
+        self.rates = rates
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        rate = self.rates.get(getattr(record, 'event', None), 1.0)
+        return record.levelno > logging.INFO or rate >= 1.0 or random.random() < rate
+
+
+class JsonFormatter(logging.Formatter):
+    """Одна JSON-строка на запись: время, уровень, логгер, сообщение, событие, correlation_id и extra-поля."""
+
+    RESERVED = set(vars(logging.LogRecord('', 0, '', 0, '', None, None))) | {'message', 'asctime', 'correlation_id', 'event'}
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            'ts': datetime.fromtimestamp(record.created, timezone.utc).isoformat(),
+            'level': record.levelname,
+            'logger': record.name,
+            'msg': record.getMessage(),
+            'correlation_id': getattr(record, 'correlation_id', '-'),
+        }
+        if getattr(record, 'event', None):
+            entry['event'] = record.event
+        for key, value in vars(record).items():
+            if key not in self.RESERVED:
+                entry[key] = value
+        if record.exc_info:
+            entry['exc'] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler без форматирования в вызывающем потоке: сообщение собирается уже в потоке QueueListener."""
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+
+def parse_sample_rates(spec: str) -> dict:
+    """'event=0.1,other=0.5' → {'event': 0.1, 'other': 0.5}"""
+    rates = {}
+    for item in filter(None, (part.strip() for part in spec.split(','))):
+        event, _, rate = item.partition('=')
+        rates[event.strip()] = float(rate)
+    return rates
+
+
+def configure_logging():
+    """Логи через очередь: код бота только кладет запись в очередь, запись в stderr идет в отдельном потоке."""
+    stream_handler = logging.StreamHandler(sys.stderr)
+    if os.getenv('LOG_FORMAT', 'json') == 'json':
+        stream_handler.setFormatter(JsonFormatter())
+    else:
+        stream_handler.setFormatter(logging.Formatter(
+            '%(asctime)s - %(name)s - %(levelname)s - [%(correlation_id)s] %(message)s'
+        ))
+
+    log_queue = queue.SimpleQueue()
+    queue_handler = DeferredQueueHandler(log_queue)
+    queue_handler.addFilter(CorrelationIdFilter())
+
+    root = logging.getLogger()
+    root.handlers[:] = [queue_handler]
+    root.setLevel(os.getenv('LOG_LEVEL', 'INFO').upper())
+
+    rates = {**DEFAULT_LOG_SAMPLE_RATES, **parse_sample_rates(os.getenv('LOG_SAMPLE_RATES', ''))}
+    logger.addFilter(SamplingFilter(rates))
+
+    listener = logging.handlers.QueueListener(log_queue, stream_handler, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+
+
 logger = logging.getLogger(__name__)
 
+# Заглушки, которые сохраняются вместо текста, если транскрипция не получилась
+TRANSCRIPTION_UNAVAILABLE = "[Голосовое сообщение — транскрипция недоступна]"
+TRANSCRIPTION_FAILED = "[Не удалось распознать аудио]"
+TRANSCRIPTION_EMPTY = "[распознавание завершилось без текста]"
+TRANSCRIPTION_PENDING = "[Длинная запись — транскрипция в процессе]"
+TRANSCRIPTION_TOO_LARGE = "[Запись слишком большая для транскрипции]"
+
+
+def parse_timestamp(value: str) -> datetime:
+    """ISO-время из PostgREST → datetime (Python 3.9 понимает только 3 или 6 знаков дробной части)."""
+    value = value.replace("Z", "+00:00")
+    match = re.match(r'^(.*T\d{2}:\d{2}:\d{2})\.(\d+)(.*)$', value)
+    if match:
+        value = f"{match.group(1)}.{match.group(2)[:6].ljust(6, '0')}{match.group(3)}"
+    return datetime.fromisoformat(value)
+
+
+def practice_day(value: str) -> date:
+    """День практики по UTC: так же считается «сегодня» в графиках и дайджесте, при любом смещении в ответе PostgREST."""
+    moment = parse_timestamp(value)
+    if moment.tzinfo is None:
+        return moment.date()
+    return moment.astimezone(timezone.utc).date()
+
+
+# ===== Агрегаты практик =====
+AGGREGATE_KEYWORDS_LIMIT = 30
+ANSWER_TYPE_COLUMNS = {'text': 'text_answers', 'voice': 'voice_answers', 'photo': 'photo_answers'}
+
+
+def empty_aggregate(user_id: int, period_column: str, period: str) -> dict:
+    """Пустая строка дневного / недельного агрегата."""
+    return {
+        'user_id': user_id,
+        period_column: period,
+        'sessions_count': 0,
+        'listening_seconds': 0,
+        'text_answers': 0,
+        'voice_answers': 0,
+        'photo_answers': 0,
+        'keyword_counts': {},
+        'last_completed_at': None,
+        'last_ingested_at': None,
+        'last_session_id': None,
+        'last_text_ingested_at': None,
+        'last_text_session_id': None,
+    }
+
+
+def _add_keywords(row: dict, keywords: list):
+    """Прибавляем ключевые слова к строке агрегата, оставляя AGGREGATE_KEYWORDS_LIMIT самых частых."""
+    counts = dict(row.get('keyword_counts') or {})
+    for word in keywords:
+        counts[word] = counts.get(word, 0) + 1
+    if len(counts) > AGGREGATE_KEYWORDS_LIMIT:
+        counts = dict(sorted(counts.items(), key=lambda kv: -kv[1])[:AGGREGATE_KEYWORDS_LIMIT])
+    row['keyword_counts'] = counts
+
+
+def merge_session_into_aggregate(row: dict, session: dict, keywords: list) -> bool:
+    """Добавляем завершенную сессию в строку агрегата. False — сессия уже была учтена.
+
+    Сессии приходят в порядке (completed_ingested_at, id) — времени, когда их увидела база.
+    """
+    position = (parse_timestamp(session['completed_ingested_at']), session['id'])
+    if row.get('last_ingested_at') and position <= (parse_timestamp(row['last_ingested_at']), row['last_session_id']):
+        return False
+
+    row['sessions_count'] += 1
+    row['listening_seconds'] += int(session.get('session_duration_seconds') or 0)
+    column = ANSWER_TYPE_COLUMNS.get(session.get('answer_type'))
+    if column:
+        row[column] += 1
+    _add_keywords(row, keywords)
+
+    row['last_completed_at'] = session['completed_at']
+    row['last_ingested_at'] = session['completed_ingested_at']
+    row['last_session_id'] = session['id']
+    return True
+
+
+def merge_transcript_into_aggregate(row: dict, session: dict, keywords: list) -> bool:
+    """Добавляем ключевые слова транскрипции, пришедшей после завершения сессии. False — уже учтена.
+
+    Сессии приходят в порядке (text_ingested_at, id); счетчики сессий не меняются — их учла
+    merge_session_into_aggregate, когда вместо текста еще стояла заглушка.
+    """
+    position = (parse_timestamp(session['text_ingested_at']), session['id'])
+    if row.get('last_text_ingested_at') and position <= (parse_timestamp(row['last_text_ingested_at']), row['last_text_session_id']):
+        return False
+
+    _add_keywords(row, keywords)
+    row['last_text_ingested_at'] = session['text_ingested_at']
+    row['last_text_session_id'] = session['id']
+    return True
+
+
+# ===== Графики прогресса =====
+CHART_WINDOW_DAYS = 91  # 13 полных недель: 30/90 дней и календарь
+
+
+def bucket_daily_activity(days: list, seconds: list, sessions: list, today: str) -> tuple:
+    """Раскладываем дневные агрегаты по последним CHART_WINDOW_DAYS дням (индекс 0 — самый старый день).
+
+    Возвращаем (минуты по дням, число практик по дням) как массивы NumPy.
+    """
+    minutes = np.zeros(CHART_WINDOW_DAYS)
+    counts = np.zeros(CHART_WINDOW_DAYS, dtype=np.int64)
+    if days:
+        age = (np.datetime64(today, 'D') - np.array(days, dtype='datetime64[D]')).astype(np.int64)
+        mask = (age >= 0) & (age < CHART_WINDOW_DAYS)
+        index = CHART_WINDOW_DAYS - 1 - age[mask]
+        np.add.at(minutes, index, np.asarray(seconds, dtype=float)[mask] / 60)
+        np.add.at(counts, index, np.asarray(sessions, dtype=np.int64)[mask])
+    return minutes, counts
+
+
+def current_streak(counts: np.ndarray) -> int:
+    """Сколько дней подряд была практика (сегодняшний день без практики серию не обрывает)."""
+    practiced = (counts > 0)[::-1]
+    if not practiced[0]:
+        practiced = practiced[1:]
+    return int(len(practiced) if practiced.all() else np.argmin(practiced))
+
+
+def render_progress_chart(days: list, seconds: list, sessions: list, today: str) -> bytes:
+    """Рисуем PNG: минуты за 30 дней, минуты по неделям за 90 дней и календарь практик.
+
+    Выполняется в пуле процессов, поэтому использует только Figure API без pyplot.
+    """
+    from matplotlib.figure import Figure
+
+    minutes, counts = bucket_daily_activity(days, seconds, sessions, today)
+    weekly_minutes = minutes.reshape(-1, 7).sum(axis=1)
+    calendar = (counts > 0).astype(int).reshape(-1, 7).T
+
+    fig = Figure(figsize=(8, 7), dpi=100)
+    ax_month, ax_quarter, ax_calendar = fig.subplots(3, 1, gridspec_kw={'height_ratios': [3, 3, 2]})
+
+    ax_month.bar(np.arange(30), minutes[-30:], color='#4C9AFF')
+    ax_month.set_title("Минуты слушания — последние 30 дней")
+    ax_month.set_xticks([0, 29])
+    ax_month.set_xticklabels(["30 дней назад", "сегодня"])
+
+    ax_quarter.bar(np.arange(len(weekly_minutes)), weekly_minutes, color='#36B37E')
+    ax_quarter.set_title("Минуты по неделям — последние 90 дней")
+    ax_quarter.set_xticks([])
+
+    ax_calendar.imshow(calendar, cmap='Greens', vmin=0, vmax=1, aspect='equal')
+    ax_calendar.set_title(f"Календарь практик · серия: {current_streak(counts)} дн.")
+    ax_calendar.set_axis_off()
+
+    fig.tight_layout()
+    buf = io.BytesIO()
+    fig.savefig(buf, format='png')
+    return buf.getvalue()
+
+
+# ===== Еженедельный дайджест =====
+DIGEST_TOP_SOUNDS = 3
+WEEKDAY_NAMES = ('понедельник', 'вторник', 'среда', 'четверг', 'пятница', 'суббота', 'воскресенье')
+
+
+def summarize_week(user_ids, day_offsets, seconds, sessions, kw_users, kw_words, kw_counts) -> dict:
+    """Итоги недели для пачки пользователей по дневным агрегатам (только векторные операции).
+
+    user_ids / day_offsets (0 — понедельник) / seconds / sessions — по элементу на строку (пользователь, день);
+    kw_users / kw_words / kw_counts — по элементу на (пользователь, день, слово), слова заменены на id.
+    Повторяющиеся звуки — слова, встретившиеся за неделю хотя бы дважды (не больше DIGEST_TOP_SOUNDS).
+    """
+    users, inverse = np.unique(np.asarray(user_ids, dtype=np.int64), return_inverse=True)
+    count = len(users)
+    day_offsets = np.asarray(day_offsets, dtype=np.int64)
+    seconds = np.asarray(seconds, dtype=np.int64)
+    sessions = np.asarray(sessions, dtype=np.int64)
+
+    total_sessions = np.bincount(inverse, weights=sessions, minlength=count).astype(np.int64)
+    total_seconds = np.bincount(inverse, weights=seconds, minlength=count).astype(np.int64)
+    active_days = np.bincount(inverse, weights=sessions > 0, minlength=count).astype(np.int64)
+
+    # Самый долгий день: сортируем по (пользователь, секунды) и берем последний элемент каждой группы
+    order = np.lexsort((seconds, inverse))
+    grouped = inverse[order]
+    last = np.r_[grouped[1:] != grouped[:-1], True] if len(grouped) else np.zeros(0, dtype=bool)
+    best_day = np.zeros(count, dtype=np.int64)
+    best_day[grouped[last]] = day_offsets[order][last]
+
+    # Суммы по (пользователь, слово) через один int64-ключ, затем top-k внутри каждого пользователя
+    kw_index = np.searchsorted(users, np.asarray(kw_users, dtype=np.int64))
+    kw_words = np.asarray(kw_words, dtype=np.int64)
+    vocabulary_size = int(kw_words.max()) + 1 if len(kw_words) else 1
+    keys, key_inverse = np.unique(kw_index * vocabulary_size + kw_words, return_inverse=True)
+    totals = np.bincount(key_inverse, weights=np.asarray(kw_counts, dtype=np.int64), minlength=len(keys)).astype(np.int64)
+    recurring = totals >= 2
+    keys, totals = keys[recurring], totals[recurring]
+    owners = keys // vocabulary_size
+    order = np.lexsort((-totals, owners))
+    keys, owners = keys[order], owners[order]
+    starts = np.flatnonzero(np.r_[True, owners[1:] != owners[:-1]]) if len(owners) else np.zeros(0, dtype=np.int64)
+    rank = np.arange(len(owners)) - np.repeat(starts, np.diff(np.r_[starts, len(owners)]))
+    top = rank < DIGEST_TOP_SOUNDS
+
+    return {
+        'users': users,
+        'sessions': total_sessions,
+        'seconds': total_seconds,
+        'active_days': active_days,
+        'best_day': best_day,
+        'sound_users': users[owners[top]],
+        'sound_words': keys[top] % vocabulary_size,
+    }
+
+
+def format_weekly_digest(week_start, sessions: int, seconds: int, active_days: int, best_day: int,
+                         sounds: list, has_highlight: bool) -> str:
+    week_end = week_start + timedelta(days=6)
+    lines = [
+        f"🗓 Твоя неделя слушания ({week_start:%d.%m} – {week_end:%d.%m})",
+        "",
+        f"🎧 Практик: {sessions}",
+        f"⏱ Минут слушания: {round(seconds / 60)}",
+        f"📅 Дней с практикой: {active_days} из 7",
+        f"⭐ Самый долгий день: {WEEKDAY_NAMES[best_day]}",
+    ]
+    if sounds:
+        lines.append(f"🔁 Звуки недели: {', '.join(sounds)}")
+    if has_highlight:
+        lines += ["", "🔊 Это самая долгая запись недели — послушай ее еще раз"]
+    return "\n".join(lines)
+
+
+# ===== Похожие звуковые ландшафты =====
+AUDIO_EMBEDDING_RATE = 16000
+AUDIO_EMBEDDING_FFT = 1024
+AUDIO_EMBEDDING_BANDS = 32
+AUDIO_EMBEDDING_DIM = 2 * AUDIO_EMBEDDING_BANDS
+
+
+def decode_audio_mono(audio: bytes, sample_rate: int = AUDIO_EMBEDDING_RATE) -> np.ndarray:
+    """Декодируем OGG/Opus из Telegram в моно float32 с заданной частотой (нужен PyAV)."""
+    import av
+
+    container = av.open(io.BytesIO(audio))
+    resampler = av.AudioResampler(format='flt', layout='mono', rate=sample_rate)
+    chunks = []
+    for frame in container.decode(audio=0):
+        for out in resampler.resample(frame):
+            chunks.append(out.to_ndarray().reshape(-1))
+    for out in resampler.resample(None):
+        chunks.append(out.to_ndarray().reshape(-1))
+    container.close()
+    return np.concatenate(chunks).astype(np.float32) if chunks else np.zeros(0, dtype=np.float32)
+
+
+def compute_audio_embedding(audio: bytes) -> np.ndarray:
+    """Акустический отпечаток записи: среднее и разброс лог-энергии в лог-шкальных полосах частот.
+
+    Вектор нормирован (L2), поэтому косинусная близость — это просто скалярное произведение.
+    """
+    samples = decode_audio_mono(audio)
+    if len(samples) < AUDIO_EMBEDDING_FFT:
+        samples = np.pad(samples, (0, AUDIO_EMBEDDING_FFT - len(samples)))
+
+    frames = np.lib.stride_tricks.sliding_window_view(samples, AUDIO_EMBEDDING_FFT)[::AUDIO_EMBEDDING_FFT // 2]
+    spectrum = np.abs(np.fft.rfft(frames * np.hanning(AUDIO_EMBEDDING_FFT), axis=1)) ** 2
+
+    n_bins = spectrum.shape[1]
+    edges = np.round(np.geomspace(1, n_bins, AUDIO_EMBEDDING_BANDS + 1)).astype(int)
+    edges = np.maximum(edges, np.arange(1, AUDIO_EMBEDDING_BANDS + 2))[:-1]
+    bands = np.log10(np.add.reduceat(spectrum, edges, axis=1) + 1e-10)
+
+    means = bands.mean(axis=0)
+    vector = np.concatenate([means - means.mean(), bands.std(axis=0)]).astype(np.float32)
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm else vector
+
+
+class AudioSimilarityIndex:
+    """Индекс эмбеддингов звуков окружения в memory-mapped файлах.
+
+    vectors.f32 — матрица N × dim (нормированные float32), rows.bin — (session_id, user_id)
+    для каждой строки. Файлы только дописываются, поэтому индекс строится инкрементально.
+
+    Чтение файлов и дозапись идут под блокировкой index.lock, поэтому бот и
+    scripts/build_audio_index.py могут писать в один индекс одновременно: перед
+    дозаписью каждый процесс подхватывает строки, дописанные другим. Недописанный
+    хвост (падение между записью векторов и строк) обрезается до последней полной записи.
+    """
+
+    ROW_DTYPE = np.dtype([('session_id', 'S36'), ('user_id', '<i8')])
+
+    def __init__(self, directory: str, dim: int = AUDIO_EMBEDDING_DIM):
+        os.makedirs(directory, exist_ok=True)
+        self.dim = dim
+        self.vectors_path = os.path.join(directory, 'vectors.f32')
+        self.rows_path = os.path.join(directory, 'rows.bin')
+        self.lock_path = os.path.join(directory, 'index.lock')
+        self._load()
+
+    @contextlib.contextmanager
+    def _locked(self):
+        """Эксклюзивная блокировка индекса между процессами (flock; без fcntl — без блокировки)"""
+        with open(self.lock_path, 'a') as lock_file:
+            try:
+                import fcntl
+            except ImportError:
+                yield
+                return
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _complete_count(self) -> int:
+        """Число полных записей: минимум по двум файлам; лишний хвост обрезаем (вызывать под блокировкой)"""
+        vector_size = self.dim * np.dtype(np.float32).itemsize
+        sizes = [os.path.getsize(path) if os.path.exists(path) else 0 for path in (self.vectors_path, self.rows_path)]
+        count = min(sizes[0] // vector_size, sizes[1] // self.ROW_DTYPE.itemsize)
+        for path, size, item_size in ((self.vectors_path, sizes[0], vector_size),
+                                      (self.rows_path, sizes[1], self.ROW_DTYPE.itemsize)):
+            if size > count * item_size:
+                logger.warning("Индекс похожих: обрезаю недописанный хвост %s до %s записей", path, count, extra={'event': 'similar_index_truncated'})
+                os.truncate(path, count * item_size)
+        return count
+
+    def _load(self):
+        """Открываем файлы через memmap и группируем строки по пользователям"""
+        with self._locked():
+            count = self._complete_count()
+        self._remap(count)
+
+        self.by_user = {}
+        self._group_by_user(np.asarray(self.rows['user_id']), np.arange(count))
+
+    def _group_by_user(self, user_ids: np.ndarray, indices: np.ndarray):
+        """Добавляем номера строк в списки по пользователям (векторно, без цикла по строкам)"""
+        if not len(indices):
+            return
+        order = np.argsort(user_ids, kind='stable')
+        users, starts = np.unique(user_ids[order], return_index=True)
+        for user_id, user_indices in zip(users, np.split(indices[order], starts[1:])):
+            existing = self.by_user.get(int(user_id))
+            self.by_user[int(user_id)] = user_indices if existing is None else np.concatenate([existing, user_indices])
+
+    def _remap(self, count: int):
+        if count:
+            self.vectors = np.memmap(self.vectors_path, dtype=np.float32, mode='r', shape=(count, self.dim))
+            self.rows = np.memmap(self.rows_path, dtype=self.ROW_DTYPE, mode='r', shape=(count,))
+        else:
+            self.vectors = np.zeros((0, self.dim), dtype=np.float32)
+            self.rows = np.zeros(0, dtype=self.ROW_DTYPE)
+
+    def _sync(self, count: int):
+        """Подхватываем строки, которые дописал другой процесс"""
+        known = len(self)
+        self._remap(count)
+        if count > known:
+            self._group_by_user(np.asarray(self.rows['user_id'][known:]), np.arange(known, count))
+
+    def __len__(self) -> int:
+        return len(self.rows)
+
+    def add_many(self, session_ids: list, user_ids: list, vectors: np.ndarray):
+        """Дописываем пачку векторов в конец индекса (записи, уже добавленные другим процессом, пропускаем)"""
+        vectors = np.asarray(vectors, dtype=np.float32).reshape(-1, self.dim)
+        with self._locked():
+            self._sync(self._complete_count())
+            keep = [i for i, (sid, uid) in enumerate(zip(session_ids, user_ids)) if not self.contains(uid, sid)]
+            if not keep:
+                return
+            rows = np.zeros(len(keep), dtype=self.ROW_DTYPE)
+            rows['session_id'] = [session_ids[i].encode() for i in keep]
+            rows['user_id'] = [user_ids[i] for i in keep]
+
+            start = len(self)
+            with open(self.vectors_path, 'ab') as f:
+                f.write(vectors[keep].tobytes())
+            with open(self.rows_path, 'ab') as f:
+                f.write(rows.tobytes())
+            self._remap(start + len(rows))
+        self._group_by_user(rows['user_id'], np.arange(start, start + len(rows)))
+
+    def add(self, session_id: str, user_id: int, vector: np.ndarray):
+        self.add_many([session_id], [user_id], vector)
+
+    def _row_of(self, user_id: int, session_id: str) -> Optional[int]:
+        indices = self.by_user.get(user_id)
+        if indices is None:
+            return None
+        found = indices[self.rows['session_id'][indices] == session_id.encode()]
+        return int(found[0]) if len(found) else None
+
+    def contains(self, user_id: int, session_id: str) -> bool:
+        return self._row_of(user_id, session_id) is not None
+
+    def query_vector(self, vector: np.ndarray, k: int = 5, candidates: Optional[np.ndarray] = None) -> list:
+        """Top-k по косинусной близости: [(session_id, score), ...]"""
+        if candidates is None:
+            candidates = np.arange(len(self))
+        if not len(candidates):
+            return []
+        scores = self.vectors[candidates] @ vector if len(candidates) < len(self) else self.vectors @ vector
+        k = min(k, len(candidates))
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return [(self.rows['session_id'][candidates[i]].decode(), float(scores[i])) for i in top]
+
+    def similar_sessions(self, user_id: int, session_id: str, k: int = 5) -> list:
+        """Самые похожие прошлые записи того же пользователя"""
+        row = self._row_of(user_id, session_id)
+        if row is None:
+            return []
+        candidates = self.by_user[user_id]
+        return self.query_vector(self.vectors[row], k, candidates[candidates != row])
+
+
+def download_telegram_file(bot_token: str, file_id: str) -> tuple[bytes, str]:
+    """Скачиваем файл из Telegram по file_id. Возвращаем (содержимое, имя файла)."""
+    get_file_url = f"https://api.telegram.org/bot{bot_token}/getFile"
+    r = requests.get(get_file_url, params={"file_id": file_id}, timeout=30)
+    r.raise_for_status()
+    file_path = r.json()["result"]["file_path"]
+
+    file_url = f"https://api.telegram.org/file/bot{bot_token}/{file_path}"
+    audio_resp = requests.get(file_url, timeout=60)
+    audio_resp.raise_for_status()
+    return audio_resp.content, os.path.basename(file_path) or "voice.ogg"
+
+
+# Bot API не отдает через getFile файлы больше 20 МБ
+TELEGRAM_DOWNLOAD_LIMIT = 20 * 1024 * 1024
+VOICE_CHUNK_SAMPLE_RATE = 16000
+
+
+def split_audio_chunks(audio: bytes, chunk_seconds: int) -> list:
+    """Режем запись на куски по chunk_seconds: каждый кусок — отдельный WAV 16 кГц моно (подходит любому движку)."""
+    samples = decode_audio_mono(audio, VOICE_CHUNK_SAMPLE_RATE)
+    pcm = (np.clip(samples, -1.0, 1.0) * 32767).astype('<i2')
+    step = chunk_seconds * VOICE_CHUNK_SAMPLE_RATE
+    chunks = []
+    for start in range(0, max(len(pcm), 1), step):
+        buffer = io.BytesIO()
+        with wave.open(buffer, 'wb') as w:
+            w.setnchannels(1)
+            w.setsampwidth(2)
+            w.setframerate(VOICE_CHUNK_SAMPLE_RATE)
+            w.writeframes(pcm[start:start + step].tobytes())
+        chunks.append(buffer.getvalue())
+    return chunks
+
+
+class TranscriptionBackend(abc.ABC):
+    """Интерфейс движка распознавания речи."""
+
+    name = 'base'
+    # Сколько распознаваний бот запускает одновременно
+    max_concurrency = 4
+
+    def warm_up(self):
+        """Подготовка движка при старте бота (загрузка модели и т.п.)."""
+
+    @abc.abstractmethod
+    def transcribe(self, audio: bytes, filename: str) -> str:
+        """Распознаем одну запись и возвращаем текст."""
+
+    def close(self):
+        """Освобождаем ресурсы движка (процессы, модели) при остановке бота."""
+
+    def transcribe_batch(self, items: list) -> list:
+        """Распознаем пачку [(audio, filename), ...]. Движки могут переопределить для пакетной обработки."""
+        return [self.transcribe(audio, filename) for audio, filename in items]
+
+
+class OpenAIWhisperBackend(TranscriptionBackend):
+    """Распознавание через OpenAI whisper-1."""
+
+    name = 'openai'
+
+    def __init__(self, client: Optional[OpenAI] = None):
+        self.client = client or OpenAI()
+
+    def transcribe(self, audio: bytes, filename: str) -> str:
+        audio_bytes = io.BytesIO(audio)
+        audio_bytes.name = filename
+        res = self.client.audio.transcriptions.create(
+            model="whisper-1",
+            file=audio_bytes,
+            response_format="text"
+        )
+        return res if isinstance(res, str) else getattr(res, "text", "").strip()
+
+
+# ===== Локальное распознавание (faster-whisper) в пуле процессов =====
+LOCAL_STT_SAMPLE_RATE = 16000
+
+# Модель живет в каждом процессе-воркере и загружается один раз при его старте
+_local_stt_model = None
+
+
+def _local_stt_init(model_size: str, compute_type: str):
+    global _local_stt_model
+    from faster_whisper import WhisperModel
+    _local_stt_model = WhisperModel(model_size, device='cpu', compute_type=compute_type, cpu_threads=1)
+
+
+def _local_stt_ping() -> bool:
+    return _local_stt_model is not None
+
+
+def _local_stt_transcribe_chunk(samples, language: Optional[str]) -> str:
+    segments, _ = _local_stt_model.transcribe(samples, language=language, beam_size=1)
+    return " ".join(segment.text.strip() for segment in segments).strip()
+
+
+class LocalWhisperBackend(TranscriptionBackend):
+    """Локальное распознавание на CPU (faster-whisper) в пуле процессов.
+
+    Длинное аудио режется на куски по chunk_seconds, куски распознаются
+    параллельно и склеиваются в исходном порядке.
+    """
+
+    name = 'local'
+
+    def __init__(self, model_size: Optional[str] = None, workers: Optional[int] = None,
+                 chunk_seconds: Optional[int] = None, language: Optional[str] = None):
+        try:
+            import faster_whisper  # noqa: F401
+        except ImportError:
+            raise RuntimeError("Для локального распознавания установите пакет faster-whisper")
+
+        self.model_size = model_size or os.getenv('LOCAL_STT_MODEL', 'base')
+        self.workers = workers or int(os.getenv('LOCAL_STT_WORKERS') or max(1, (os.cpu_count() or 2) - 1))
+        self.chunk_seconds = chunk_seconds or int(os.getenv('LOCAL_STT_CHUNK_SECONDS', '30'))
+        self.language = language or os.getenv('LOCAL_STT_LANGUAGE', 'ru') or None
+        self.max_concurrency = self.workers
+
+        # spawn: не копируем в воркеры потоки и сокеты бота
+        self.pool = ProcessPoolExecutor(
+            max_workers=self.workers,
+            mp_context=multiprocessing.get_context('spawn'),
+            initializer=_local_stt_init,
+            initargs=(self.model_size, os.getenv('LOCAL_STT_COMPUTE_TYPE', 'int8'))
+        )
+
+    def warm_up(self):
+        """Поднимаем все воркеры и дожидаемся загрузки модели в каждом."""
+        for future in [self.pool.submit(_local_stt_ping) for _ in range(self.workers)]:
+            future.result()
+        logger.info("Локальная модель распознавания '%s' загружена в %s процесс(ах)", self.model_size, self.workers)
+
+    def close(self):
+        self.pool.shutdown(wait=False, cancel_futures=True)
+
+    def split(self, audio: bytes) -> list:
+        """Декодируем аудио в 16 кГц моно и режем на куски по chunk_seconds."""
+        from faster_whisper import decode_audio
+        samples = decode_audio(io.BytesIO(audio), sampling_rate=LOCAL_STT_SAMPLE_RATE)
+        step = self.chunk_seconds * LOCAL_STT_SAMPLE_RATE
+        return [samples[i:i + step] for i in range(0, len(samples), step)] or [samples]
+
+    def transcribe(self, audio: bytes, filename: str) -> str:
+        return self.transcribe_batch([(audio, filename)])[0]
+
+    def transcribe_batch(self, items: list) -> list:
+        # Все куски всех файлов сразу отдаем в пул, затем собираем по порядку
+        futures = [
+            [self.pool.submit(_local_stt_transcribe_chunk, chunk, self.language) for chunk in self.split(audio)]
+            for audio, _ in items
+        ]
+        return [" ".join(text for text in (f.result() for f in chunk_futures) if text).strip()
+                for chunk_futures in futures]
+
+
+def load_transcription_backend(spec: str) -> TranscriptionBackend:
+    """Создаем движок по имени: 'openai', 'local' или 'package.module:ClassName' для подключаемого."""
+    if spec == OpenAIWhisperBackend.name:
+        return OpenAIWhisperBackend()
+    if spec == LocalWhisperBackend.name:
+        return LocalWhisperBackend()
+    module_name, _, class_name = spec.partition(':')
+    if not class_name:
+        raise ValueError(f"Неизвестный движок транскрипции: {spec}")
+    backend_cls = getattr(importlib.import_module(module_name), class_name)
+    return backend_cls()
+
+
+class RateLimiter:
+    """Асинхронный token bucket: не больше rate операций в секунду, с запасом burst."""
+
+    def __init__(self, rate: float, burst: int = 1):
+        self.rate = rate
+        self.capacity = burst
+        self.tokens = float(burst)
+        self.updated = monotonic()
+        self._lock: Optional[asyncio.Lock] = None
+
+    async def acquire(self):
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        async with self._lock:
+            while True:
+                now = monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+class RateLimitedSender:
+    """Параллельная отправка сообщений в Telegram с общим лимитом скорости.
+
+    Не больше rate отправок в секунду (token bucket) и не больше concurrency одновременно.
+    RetryAfter от Telegram приостанавливает всех отправителей на указанное время,
+    сетевые ошибки повторяются, заблокировавшие бота пользователи помечаются как blocked.
+    """
+
+    def __init__(self, rate: float = 25.0, concurrency: int = 20, max_retries: int = 3):
+        self.limiter = RateLimiter(rate, burst=max(1, int(rate)))
+        self.concurrency = concurrency
+        self.max_retries = max_retries
+        self.paused_until = 0.0
+        self.sent = 0
+        self.failed = 0
+        self.started = monotonic()
+
+    @property
+    def throughput(self) -> float:
+        """Доставлено сообщений в секунду с момента создания"""
+        return self.sent / max(monotonic() - self.started, 1e-9)
+
+    async def _send_one(self, key, send, semaphore: asyncio.Semaphore) -> tuple:
+        async with semaphore:
+            error = None
+            for attempt in range(self.max_retries + 1):
+                delay = self.paused_until - monotonic()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                await self.limiter.acquire()
+                try:
+                    await send()
+                    self.sent += 1
+                    return key, 'sent', None
+                except RetryAfter as e:
+                    retry_after = e.retry_after
+                    retry_after = retry_after.total_seconds() if isinstance(retry_after, timedelta) else float(retry_after)
+                    self.paused_until = max(self.paused_until, monotonic() + retry_after)
+                    error = str(e)
+                except Forbidden as e:
+                    self.failed += 1
+                    return key, 'blocked', str(e)
+                except BadRequest as e:
+                    self.failed += 1
+                    return key, 'failed', str(e)
+                except NetworkError as e:
+                    error = str(e)
+                    await asyncio.sleep(random.uniform(0, 2 ** attempt))
+                except TelegramError as e:
+                    self.failed += 1
+                    return key, 'failed', str(e)
+            self.failed += 1
+            return key, 'failed', error
+
+    async def send_all(self, jobs: list, on_results=None, chunk_size: int = 20) -> list:
+        """jobs — [(key, send)], где send() возвращает новую корутину отправки (для повторов).
+
+        Результат — [(key, status, error)] в том же порядке; status: sent / blocked / failed.
+        on_results — необязательный async on_results(results): получает результаты по мере
+        завершения пачками по chunk_size, чтобы статус доставки сохранялся сразу, а не
+        после всей страницы (при падении повторно уйдет не больше одной пачки).
+        """
+        semaphore = asyncio.Semaphore(self.concurrency)
+        if on_results is None:
+            return await asyncio.gather(*(self._send_one(key, send, semaphore) for key, send in jobs))
+
+        pending = []
+
+        async def send_and_record(key, send) -> tuple:
+            result = await self._send_one(key, send, semaphore)
+            pending.append(result)
+            if len(pending) >= chunk_size:
+                chunk = pending[:]
+                pending.clear()
+                await on_results(chunk)
+            return result
+
+        results = await asyncio.gather(*(send_and_record(key, send) for key, send in jobs))
+        if pending:
+            await on_results(pending[:])
+        return results
+
+
+class CircuitBreaker:
+    """Circuit breaker для запросов к Supabase: closed → open → half-open → closed."""
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, failure_threshold: int = 5, reset_timeout: float = 30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self._probe_in_flight = False
+
+    def allow_request(self) -> bool:
+        """Можно ли сейчас идти в Supabase. В half-open пропускаем один пробный запрос."""
+        if self.state == self.OPEN:
+            if monotonic() - self.opened_at < self.reset_timeout:
+                return False
+            self.state = self.HALF_OPEN
+            self._probe_in_flight = False
+        if self.state == self.HALF_OPEN:
+            if self._probe_in_flight:
+                return False
+            self._probe_in_flight = True
+        return True
+
+    def record_success(self):
+        if self.state != self.CLOSED:
+            logger.info("Supabase снова доступен — circuit breaker закрыт")
+        self.state = self.CLOSED
+        self.failures = 0
+        self._probe_in_flight = False
+
+    def record_failure(self):
+        self.failures += 1
+        self._probe_in_flight = False
+        if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+            if self.state != self.OPEN:
+                logger.warning("Supabase недоступен — circuit breaker открыт на %.0f с", self.reset_timeout, extra={'event': 'circuit_open'})
+            self.state = self.OPEN
+            self.opened_at = monotonic()
+
+    @property
+    def is_closed(self) -> bool:
+        return self.state == self.CLOSED
+
+
+class SupabaseOutbox:
+    """Локальная очередь записей (SQLite), пока Supabase недоступен. Порядок сохраняется.
+
+    Записи, которые Supabase отклонил или которые не прошли за несколько попыток,
+    переносятся в outbox_dead_letter, чтобы не держать очередь за собой.
+    """
+
+    def __init__(self, path: str):
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS outbox ("
+            " id INTEGER PRIMARY KEY AUTOINCREMENT,"
+            " method TEXT NOT NULL,"
+            " url TEXT NOT NULL,"
+            " prefer TEXT,"
+            " body TEXT,"
+            " created_at TEXT NOT NULL,"
+            " attempts INTEGER NOT NULL DEFAULT 0)"
+        )
+        # Очереди, созданные до появления счетчика попыток
+        columns = {row[1] for row in self.conn.execute("PRAGMA table_info(outbox)")}
+        if 'attempts' not in columns:
+            self.conn.execute("ALTER TABLE outbox ADD COLUMN attempts INTEGER NOT NULL DEFAULT 0")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS outbox_dead_letter ("
+            " id INTEGER PRIMARY KEY,"
+            " method TEXT NOT NULL,"
+            " url TEXT NOT NULL,"
+            " prefer TEXT,"
+            " body TEXT,"
+            " created_at TEXT NOT NULL,"
+            " attempts INTEGER NOT NULL,"
+            " reason TEXT,"
+            " failed_at TEXT NOT NULL)"
+        )
+        self.conn.commit()
+
+    def push(self, method: str, url: str, prefer: Optional[str], body: Optional[str]):
+        self.conn.execute(
+            "INSERT INTO outbox (method, url, prefer, body, created_at) VALUES (?, ?, ?, ?, ?)",
+            (method, url, prefer, body, datetime.now().isoformat())
+        )
+        self.conn.commit()
+
+    def peek(self, limit: int = 100) -> list:
+        return self.conn.execute(
+            "SELECT id, method, url, prefer, body FROM outbox ORDER BY id LIMIT ?", (limit,)
+        ).fetchall()
+
+    def remove(self, entry_id: int):
+        self.conn.execute("DELETE FROM outbox WHERE id = ?", (entry_id,))
+        self.conn.commit()
+
+    def record_attempt(self, entry_id: int) -> int:
+        """Засчитываем неудачную попытку отправки. Возвращаем число попыток."""
+        self.conn.execute("UPDATE outbox SET attempts = attempts + 1 WHERE id = ?", (entry_id,))
+        self.conn.commit()
+        return self.conn.execute("SELECT attempts FROM outbox WHERE id = ?", (entry_id,)).fetchone()[0]
+
+    def dead_letter(self, entry_id: int, reason: str):
+        """Переносим запись из очереди в outbox_dead_letter (для разбора вручную)."""
+        with self.conn:
+            self.conn.execute(
+                "INSERT INTO outbox_dead_letter (id, method, url, prefer, body, created_at, attempts, reason, failed_at)"
+                " SELECT id, method, url, prefer, body, created_at, attempts, ?, ? FROM outbox WHERE id = ?",
+                (reason, datetime.now().isoformat(), entry_id)
+            )
+            self.conn.execute("DELETE FROM outbox WHERE id = ?", (entry_id,))
+
+    def dead_letter_count(self) -> int:
+        return self.conn.execute("SELECT COUNT(*) FROM outbox_dead_letter").fetchone()[0]
+
+    def __len__(self) -> int:
+        return self.conn.execute("SELECT COUNT(*) FROM outbox").fetchone()[0]
+
+
+class KnownUsersCache:
+    """Ограниченный LRU-кэш уже зарегистрированных пользователей с сохранением в SQLite.
+
+    Позволяет не делать upsert в listening_users на каждый /start: запрос нужен
+    только для новых пользователей или при изменении username / first_name.
+    """
+
+    def __init__(self, path: str, max_size: int = 100_000):
+        self.max_size = max_size
+        self.users: OrderedDict = OrderedDict()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS known_users ("
+            " telegram_user_id INTEGER PRIMARY KEY,"
+            " username TEXT,"
+            " first_name TEXT,"
+            " seen_at TEXT NOT NULL)"
+        )
+        self.conn.commit()
+        self._warm_load()
+
+    def _warm_load(self):
+        """Загружаем последних пользователей при старте (самые свежие — в конце LRU)."""
+        rows = self.conn.execute(
+            "SELECT telegram_user_id, username, first_name FROM known_users ORDER BY seen_at DESC LIMIT ?",
+            (self.max_size,)
+        ).fetchall()
+        for user_id, username, first_name in reversed(rows):
+            self.users[user_id] = (username, first_name)
+        logger.info("Кэш пользователей загружен: %s", len(self.users))
+
+    def is_current(self, user_id: int, username: Optional[str], first_name: Optional[str]) -> bool:
+        """True, если пользователь уже зарегистрирован с теми же данными профиля."""
+        profile = self.users.get(user_id)
+        if profile is None:
+            return False
+        self.users.move_to_end(user_id)
+        return profile == (username, first_name)
+
+    def remember(self, user_id: int, username: Optional[str], first_name: Optional[str]):
+        self.users[user_id] = (username, first_name)
+        self.users.move_to_end(user_id)
+        evicted = []
+        while len(self.users) > self.max_size:
+            evicted.append(self.users.popitem(last=False)[0])
+
+        self.conn.execute(
+            "INSERT OR REPLACE INTO known_users (telegram_user_id, username, first_name, seen_at) VALUES (?, ?, ?, ?)",
+            (user_id, username, first_name, datetime.now().isoformat())
+        )
+        if evicted:
+            self.conn.executemany("DELETE FROM known_users WHERE telegram_user_id = ?", [(uid,) for uid in evicted])
+        self.conn.commit()
+
+
+class FileIdCache:
+    """Ограниченный LRU-кэш session_id → file_id записи окружения со счетчиками попаданий.
+
+    Отсутствие записи тоже кэшируется (None): у практик с текстовым ответом без
+    аудио иначе каждая страница библиотеки снова спрашивала бы о них базу.
+    """
+
+    MISSING = object()
+
+    def __init__(self, max_size: int = 50_000):
+        self.max_size = max_size
+        self.entries: OrderedDict = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, session_id: str):
+        """file_id, None (аудио точно нет) или FileIdCache.MISSING (в кэше нет)"""
+        file_id = self.entries.get(session_id, self.MISSING)
+        if file_id is self.MISSING:
+            self.misses += 1
+            return file_id
+        self.hits += 1
+        self.entries.move_to_end(session_id)
+        return file_id
+
+    def put(self, session_id: str, file_id: Optional[str]):
+        self.entries[session_id] = file_id
+        self.entries.move_to_end(session_id)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+
+# ===== Запись входящих апдейтов для офлайн-воспроизведения =====
+# Идентификаторы заменяются стабильными псевдонимами (HMAC с солью), имена и свободный текст — заглушками
+RECORDED_ID_KEYS = {'id', 'user_id', 'chat_id'}
+RECORDED_TOKEN_KEYS = {'id', 'file_id', 'file_unique_id', 'media_group_id', 'inline_message_id'}
+RECORDED_NAME_KEYS = {'first_name', 'last_name', 'username', 'title', 'bio'}
+RECORDED_TEXT_KEYS = {'text', 'caption'}
+RECORDED_DROPPED_KEYS = {'contact', 'location', 'venue', 'phone_number', 'email', 'reply_to_message'}
+# Команды, аргументы которых сохраняются как есть (режим практики, формат экспорта)
+RECORDED_COMMANDS_WITH_ARGS = {'/listen', '/export'}
+
+
+def anonymize_update(data, salt: bytes):
+    """Копия Update.to_dict() без персональных данных, пригодная для воспроизведения.
+
+    Один и тот же id с одной солью всегда дает один и тот же псевдоним, поэтому
+    сессии пользователей в журнале остаются связными. Длина текста сохраняется
+    (от нее зависят offset в entities), команды и callback_data — тоже.
+    """
+    def digest(value) -> bytes:
+        return hmac.new(salt, str(value).encode(), hashlib.sha256).digest()
+
+    def anonymize_text(text: str) -> str:
+        if text.startswith('/'):
+            command, sep, args = text.partition(' ')
+            if command.split('@')[0] in RECORDED_COMMANDS_WITH_ARGS:
+                return text
+            return command + sep + 'x' * len(args)
+        return 'x' * len(text)
+
+    def walk(value, key=None):
+        if isinstance(value, dict):
+            return {k: walk(v, k) for k, v in value.items() if k not in RECORDED_DROPPED_KEYS}
+        if isinstance(value, list):
+            return [walk(item, key) for item in value]
+        if key in RECORDED_ID_KEYS and isinstance(value, int) and not isinstance(value, bool):
+            pseudonym = int.from_bytes(digest(abs(value))[:5], 'big') or 1
+            return -pseudonym if value < 0 else pseudonym
+        if key in RECORDED_TOKEN_KEYS and isinstance(value, str):
+            return digest(value).hex()[:32]
+        if key in RECORDED_NAME_KEYS and isinstance(value, str):
+            return key
+        if key in RECORDED_TEXT_KEYS and isinstance(value, str):
+            return anonymize_text(value)
+        return value
+
+    return walk(data)
+
+
+class UpdateRecorder:
+    """Журнал входящих апдейтов: JSON Lines в gzip, одна строка {'ts', 'update'} на апдейт.
+
+    Обработчик апдейта только кладет словарь в очередь; анонимизация и сжатие
+    идут в отдельном потоке, как запись логов через QueueListener.
+    """
+
+    def __init__(self, path: str, salt: bytes):
+        self.path = path
+        self.salt = salt
+        self.queue: queue.SimpleQueue = queue.SimpleQueue()
+        self.thread = threading.Thread(target=self._write_loop, name='update-recorder', daemon=True)
+        self.thread.start()
+        atexit.register(self.close)
+
+    def record(self, update: dict):
+        self.queue.put((datetime.now(timezone.utc).timestamp(), update))
+
+    def _write_loop(self):
+        # Режим 'at' дописывает новый gzip-member: журнал можно продолжать после перезапуска
+        with gzip.open(self.path, 'at', encoding='utf-8') as f:
+            while True:
+                item = self.queue.get()
+                if item is None:
+                    break
+                ts, update = item
+                try:
+                    f.write(json.dumps({'ts': ts, 'update': anonymize_update(update, self.salt)}, ensure_ascii=False) + '\n')
+                except Exception as e:
+                    logger.error("Не удалось записать апдейт в журнал: %s", e, extra={'event': 'update_record_failed'})
+                # Сбрасываем на диск, когда очередь опустела: при падении теряется минимум
+                if self.queue.empty():
+                    f.flush()
+
+    def close(self):
+        if self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join(timeout=5)
+
+
+def read_update_log(path: str):
+    """Читаем журнал UpdateRecorder: (ts, update_dict) в порядке записи"""
+    with gzip.open(path, 'rt', encoding='utf-8') as f:
+        for line in f:
+            if line.strip():
+                entry = json.loads(line)
+                yield entry['ts'], entry['update']
+
+
+# ===== Практики с сопровождением =====
+# Вступительные и завершающие аудиоподсказки лежат в PRACTICE_ASSETS_DIR как <mode>_intro.ogg / <mode>_outro.ogg (OGG/Opus)
+PRACTICE_ASSETS_DIR = os.getenv(
+    'PRACTICE_ASSETS_DIR',
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), 'assets', 'practice')
+)
+PRACTICE_CUES = ('intro', 'outro')
+PRACTICE_MODES = {
+    'nature': {
+        'title': '🌳 Практика на природе',
+        'text': (
+            "🌳 Практика на природе\n\n"
+            "📍 Выйди туда, где слышно ветер, птиц или воду\n"
+            "🎧 Послушай вступление и нажми кнопку записи голосового сообщения\n"
+            "👂 Замечай самые далекие и самые тихие звуки\n"
+            "⏰ Слушай столько, сколько захочется"
+        ),
+    },
+    'urban': {
+        'title': '🏙️ Городская практика',
+        'text': (
+            "🏙️ Городская практика\n\n"
+            "📍 Остановись на улице, во дворе или у окна\n"
+            "🎧 Послушай вступление и нажми кнопку записи голосового сообщения\n"
+            "👂 Раздели шум города на отдельные голоса: машины, шаги, разговоры\n"
+            "⏰ Слушай столько, сколько захочется"
+        ),
+    },
+}
+
+
+def practice_asset_path(mode: str, cue: str) -> str:
+    return os.path.join(PRACTICE_ASSETS_DIR, f"{mode}_{cue}.ogg")
+
+
+class AudioAssetCache:
+    """Постоянный кэш file_id загруженных в Telegram аудиоподсказок (SQLite).
+
+    Файл загружается один раз, дальше отправляется ссылкой по file_id. Запись
+    привязана к sha1 содержимого: если файл подсказки заменили, он загрузится заново.
+    """
+
+    def __init__(self, path: str):
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS audio_assets ("
+            " name TEXT PRIMARY KEY,"
+            " digest TEXT NOT NULL,"
+            " file_id TEXT NOT NULL,"
+            " uploaded_at TEXT NOT NULL)"
+        )
+        self.conn.commit()
+        self.assets = {
+            name: (digest, file_id)
+            for name, digest, file_id in self.conn.execute("SELECT name, digest, file_id FROM audio_assets")
+        }
+
+    def get(self, name: str, digest: str) -> Optional[str]:
+        cached = self.assets.get(name)
+        if cached is None or cached[0] != digest:
+            return None
+        return cached[1]
+
+    def put(self, name: str, digest: str, file_id: str):
+        self.assets[name] = (digest, file_id)
+        self.conn.execute(
+            "INSERT OR REPLACE INTO audio_assets (name, digest, file_id, uploaded_at) VALUES (?, ?, ?, ?)",
+            (name, digest, file_id, datetime.now().isoformat())
+        )
+        self.conn.commit()
+
+    def forget(self, name: str):
+        self.assets.pop(name, None)
+        self.conn.execute("DELETE FROM audio_assets WHERE name = ?", (name,))
+        self.conn.commit()
+
+
+class PracticeState(enum.Enum):
+    LISTENING = 'listening'   # идет практика, ждем голосовое с записью окружения
+    ANSWERING = 'answering'   # запись получена, ждем ответ на "Что ты услышал?"
+    COMPLETED = 'completed'
+
+
+# Допустимые переходы между состояниями практики
+PRACTICE_TRANSITIONS = {
+    PracticeState.LISTENING: frozenset({PracticeState.ANSWERING}),
+    PracticeState.ANSWERING: frozenset({PracticeState.COMPLETED}),
+    PracticeState.COMPLETED: frozenset(),
+}
+
+
+class InvalidTransition(ValueError):
+    pass
+
+
+class PracticeSession:
+    """Состояние активной практики пользователя в памяти.
+
+    __slots__ вместо словаря: на каждую практику — один небольшой объект без __dict__,
+    время — float из monotonic() вместо datetime.
+    """
+
+    __slots__ = ('session_id', 'chat_id', 'mode', 'state', 'started_at', 'state_since',
+                 'timer_message_id', 'instruction_message_id')
+
+    def __init__(self, session_id: str, chat_id: int, mode: Optional[str] = None,
+                 timer_message_id: Optional[int] = None):
+        self.session_id = session_id
+        self.chat_id = chat_id
+        self.mode = mode
+        self.state = PracticeState.LISTENING
+        self.started_at = self.state_since = monotonic()
+        self.timer_message_id = timer_message_id
+        self.instruction_message_id: Optional[int] = None
+
+    def can_advance(self, state: PracticeState) -> bool:
+        return state in PRACTICE_TRANSITIONS[self.state]
+
+    def advance(self, state: PracticeState):
+        if state not in PRACTICE_TRANSITIONS[self.state]:
+            raise InvalidTransition(f"{self.state.value} → {state.value}")
+        self.state = state
+        self.state_since = monotonic()
+
+
+async def run_timed(name: str, awaitable, hooks: list):
+    """Выполняем корутину и сообщаем хукам ее длительность: hook(name, seconds)"""
+    started = monotonic()
+    try:
+        return await awaitable
+    finally:
+        elapsed = monotonic() - started
+        for hook in hooks:
+            try:
+                hook(name, elapsed)
+            except Exception as e:
+                logger.error("Ошибка в хуке замера времени: %s", e, extra={'event': 'route_timing_failed'})
+
+
+class CallbackRouter:
+    """Декларативная маршрутизация callback_data.
+
+    Маршрут "show_stats" — точное совпадение, маршрут с двоеточием на конце ("lib:play:") — префикс.
+    Точные маршруты и префиксы хранятся в словарях, поэтому поиск занимает один-два
+    хеш-запроса на сегмент callback_data и не зависит от числа зарегистрированных маршрутов.
+    """
+
+    def __init__(self, hooks: Optional[list] = None):
+        self.exact: dict = {}
+        self.prefixes: dict = {}
+        self.hooks = hooks if hooks is not None else []
+
+    def route(self, pattern: str, handler):
+        table = self.prefixes if pattern.endswith(':') else self.exact
+        if pattern in table:
+            raise ValueError(f"Маршрут {pattern!r} уже зарегистрирован")
+        table[pattern] = handler
+
+    def resolve(self, data: str) -> Optional[tuple]:
+        """(маршрут, обработчик) для callback_data; самый длинный префикс побеждает"""
+        handler = self.exact.get(data)
+        if handler is not None:
+            return data, handler
+        end = data.rfind(':')
+        while end != -1:
+            prefix = data[:end + 1]
+            handler = self.prefixes.get(prefix)
+            if handler is not None:
+                return prefix, handler
+            end = data.rfind(':', 0, end)
+        return None
+
+    async def dispatch(self, data: str, *args) -> bool:
+        resolved = self.resolve(data or '')
+        if resolved is None:
+            return False
+        route, handler = resolved
+        await run_timed(f"callback:{route}", handler(*args), self.hooks)
+        return True
+
+
+def after_answer_keyboard() -> InlineKeyboardMarkup:
+    """Кнопки для следующего действия после ответа (без "Мои записи")"""
+    return InlineKeyboardMarkup([
+        [InlineKeyboardButton("🎧 Что ты слышишь теперь?", callback_data="start_practice")],
+        [InlineKeyboardButton("📊 Моя статистика", callback_data="show_stats")],
+        [InlineKeyboardButton("ℹ️ Как это работает", callback_data="how_it_works")]
+    ])
+
+
+# Благодарность после ответа каждого типа
+ANSWER_THANKS = {
+    'voice': "🎙️ Спасибо за то, что ты поделился!",
+    'text': "📝 Спасибо за то, что ты поделился!",
+    'photo': "📸 Спасибо за то, что ты поделился!",
+}
+
+
+class QueuedResponse:
+    """Ответ-заглушка для записи, отложенной в локальную очередь (202 Accepted)."""
+
+    status_code = 202
+    text = 'queued'
+
+    def json(self):
+        return []
+
+
+def _is_retryable(response) -> bool:
+    """Сетевые ошибки, 5xx и 429 считаем временными."""
+    return response is None or response.status_code >= 500 or response.status_code == 429
+
+
 class SimpleListeningBot:
-    def __init__(self):
+    def __init__(self, telegram_request=None):
         # Получаем переменные окружения
         self.bot_token = os.getenv('TELEGRAM_BOT_TOKEN')
         self.supabase_url = os.getenv('SUPABASE_URL')
@@ -47,12 +1394,29 @@ class SimpleListeningBot:
 
         # OpenAI клиент (не обязателен для запуска, но логируем отсутствие)
         self.openai_client: OpenAI | None = None
+        self.transcriber: Optional[TranscriptionBackend] = None
         if self.openai_api_key:
             os.environ['OPENAI_API_KEY'] = self.openai_api_key
             try:
                 self.openai_client = OpenAI()
+                self.transcriber = OpenAIWhisperBackend(self.openai_client)
+            except Exception as e:
+                logger.error("Не удалось инициализировать OpenAI: %s", e, extra={'event': 'openai_init_failed'})
+
+        # Другой движок распознавания (например, локальная модель) вместо OpenAI
+        backend_spec = os.getenv('TRANSCRIPTION_BACKEND', OpenAIWhisperBackend.name)
+        if backend_spec != OpenAIWhisperBackend.name:
+            backend = None
+            try:
+                backend = load_transcription_backend(backend_spec)
+                backend.warm_up()
+                # Заменяем рабочий движок только после успешного прогрева
+                self.transcriber = backend
             except Exception as e:
-                logger.error(f"Не удалось инициализировать OpenAI: {e}")
+                logger.error("Не удалось инициализировать движок транскрипции '%s': %s", backend_spec, e, extra={'event': 'transcription_backend_init_failed'})
+                if backend is not None:
+                    backend.close()
+        self._transcription_semaphore: Optional[asyncio.Semaphore] = None
         
         # Настраиваем заголовки для Supabase API
         self.headers = {
@@ -61,9 +1425,58 @@ class SimpleListeningBot:
             'Content-Type': 'application/json',
             'Prefer': 'return=minimal'
         }
+
+        # Устойчивость к сбоям Supabase: таймауты, повторы, circuit breaker и локальная очередь записей
+        self.supabase_timeout = float(os.getenv('SUPABASE_TIMEOUT', '5'))
+        self.supabase_retries = int(os.getenv('SUPABASE_RETRIES', '3'))
+        # Пока пользователь ждет ответа бота — одна короткая попытка: записи уходят в очередь, чтения сразу сообщают об ошибке
+        self.supabase_user_timeout = float(os.getenv('SUPABASE_USER_TIMEOUT', '1.5'))
+        self.supabase_backoff = float(os.getenv('SUPABASE_BACKOFF', '0.2'))
+        self.breaker = CircuitBreaker(
+            failure_threshold=int(os.getenv('SUPABASE_BREAKER_THRESHOLD', '5')),
+            reset_timeout=float(os.getenv('SUPABASE_BREAKER_RESET', '30'))
+        )
+        self.outbox = SupabaseOutbox(os.getenv('SUPABASE_OUTBOX_PATH', 'supabase_outbox.sqlite3'))
+        # После стольких неудачных переотправок запись уходит в dead letter и не держит очередь
+        self.outbox_max_attempts = int(os.getenv('SUPABASE_OUTBOX_MAX_ATTEMPTS', '3'))
+
+        # Кэш уже зарегистрированных пользователей, чтобы не делать upsert на каждый /start
+        self.known_users = KnownUsersCache(
+            os.getenv('KNOWN_USERS_PATH', 'known_users.sqlite3'),
+            max_size=int(os.getenv('KNOWN_USERS_MAX', '100000'))
+        )
+        
+        # Аудиоподсказки практик с сопровождением: file_id кэшируются, загрузка — один раз
+        self.audio_assets = AudioAssetCache(os.getenv('PRACTICE_ASSETS_CACHE_PATH', 'audio_assets.sqlite3'))
+        self.assets_chat_id = os.getenv('PRACTICE_ASSETS_CHAT_ID')
+        self._asset_digests: dict = {}
+        
+        # Активные практики: telegram_user_id → PracticeSession
+        self.practices: dict = {}
+        
+        # Замеры времени маршрутов и шагов сохранения ответа: hook(name, seconds)
+        self.timing_hooks: list = [self._log_timing]
+        self.router = CallbackRouter(self.timing_hooks)
+
+        # Шаги сохранения ответа по типу (выполняются по порядку, дополняются через register_answer_step)
+        self.answer_steps = {
+            'voice': [self._persist_voice_answer],
+            'text': [self._persist_text_answer],
+            'photo': [self._persist_photo_answer],
+        }
         
-        # Создаем приложение бота с JobQueue
-        self.application = Application.builder().token(self.bot_token).build()
+        # Необязательный журнал входящих апдейтов (для офлайн-воспроизведения, см. scripts/replay_updates.py)
+        self.update_recorder: Optional[UpdateRecorder] = None
+        update_log_path = os.getenv('UPDATE_LOG_PATH')
+        if update_log_path:
+            salt = os.getenv('UPDATE_LOG_SALT', '').encode() or os.urandom(16)
+            self.update_recorder = UpdateRecorder(update_log_path, salt)
+
+        # Создаем приложение бота с JobQueue; telegram_request подменяет HTTP-слой Bot API (локальная заглушка при воспроизведении)
+        builder = Application.builder().token(self.bot_token).post_init(self._post_init).post_shutdown(self._post_shutdown)
+        if telegram_request is not None:
+            builder = builder.request(telegram_request)
+        self.application = builder.build()
         
         # Инициализируем JobQueue для таймеров
         from telegram.ext import JobQueue
@@ -71,18 +1484,112 @@ class SimpleListeningBot:
             self.application.job_queue = JobQueue()
             self.application.job_queue.set_application(self.application)
         
+        # Переотправка отложенных записей, когда Supabase снова доступен
+        self.application.job_queue.run_repeating(
+            self.flush_outbox,
+            interval=int(os.getenv('SUPABASE_OUTBOX_FLUSH_INTERVAL', '10')),
+            first=5,
+            name="supabase_outbox"
+        )
+        
+        # Инкрементальная агрегация завершенных практик в дневные и недельные таблицы
+        self.aggregates_max_rows = int(os.getenv('AGGREGATES_MAX_ROWS', '5000'))
+        self.aggregates_settle = int(os.getenv('AGGREGATES_SETTLE_SECONDS', '60'))
+
+        # file_id записей окружения для библиотеки: заполняется пачкой на каждую страницу и при сохранении записи
+        self.environment_file_ids = FileIdCache(int(os.getenv('ENVIRONMENT_FILE_ID_CACHE_SIZE', '50000')))
+
+        # Графики прогресса: file_id последней картинки пользователя и пул процессов для рендера
+        self.chart_cache: OrderedDict = OrderedDict()
+        self.chart_cache_size = int(os.getenv('CHART_CACHE_SIZE', '10000'))
+        self.chart_workers = int(os.getenv('CHART_WORKERS', '1'))
+        self._chart_pool: Optional[ProcessPoolExecutor] = None
+
+        # Индекс похожих звуковых ландшафтов (эмбеддинги записей окружения)
+        self.audio_index: Optional[AudioSimilarityIndex] = None
+        try:
+            self.audio_index = AudioSimilarityIndex(os.getenv('AUDIO_INDEX_DIR', 'audio_index'))
+        except Exception as e:
+            logger.error("Не удалось открыть индекс похожих записей: %s", e, extra={'event': 'similar_index_open_failed'})
+        self._embedding_pool: Optional[ProcessPoolExecutor] = None
+
+        # Рассылки: администраторы, скорость (сообщений в секунду), параллельность и размер страницы получателей
+        self.admin_ids = {int(uid) for uid in os.getenv('ADMIN_USER_IDS', '').split(',') if uid.strip()}
+        self.broadcast_rate = float(os.getenv('BROADCAST_RATE', '25'))
+        self.broadcast_concurrency = int(os.getenv('BROADCAST_CONCURRENCY', '20'))
+        self.broadcast_page_size = int(os.getenv('BROADCAST_PAGE_SIZE', '500'))
+        # Прерванную рассылку повторяем с контрольной точки: пауза удваивается до максимума
+        self.broadcast_retry_delay = float(os.getenv('BROADCAST_RETRY_DELAY', '30'))
+        self.broadcast_retry_max_delay = float(os.getenv('BROADCAST_RETRY_MAX_DELAY', '1800'))
+
+        # Голосовые ответы по длительности и размеру: короткие распознаем целиком сразу, длинные — кусками
+        # параллельно, очень длинные — в фоновой очереди с сообщением о прогрессе
+        self.voice_inline_max_seconds = int(os.getenv('VOICE_INLINE_MAX_SECONDS', '60'))
+        self.voice_inline_max_bytes = int(os.getenv('VOICE_INLINE_MAX_BYTES', str(1024 * 1024)))
+        self.voice_chunked_max_seconds = int(os.getenv('VOICE_CHUNKED_MAX_SECONDS', '600'))
+        self.voice_chunk_seconds = int(os.getenv('VOICE_CHUNK_SECONDS', '60'))
+        self.voice_chunk_parallelism = int(os.getenv('VOICE_CHUNK_PARALLELISM', '2'))
+        self.voice_background_workers = int(os.getenv('VOICE_BACKGROUND_WORKERS', '1'))
+        self._voice_queue: deque = deque()
+        self._voice_workers_active = 0
+
+        # Сколько ждать остальные фото альбома (media group), прежде чем сохранить ответ
+        self.media_group_window = float(os.getenv('MEDIA_GROUP_WINDOW', '1.5'))
+
+        # Брошенные практики: сколько можно слушать и сколько ждать ответа, прежде чем закрыть сессию
+        self.max_listen = timedelta(minutes=int(os.getenv('PRACTICE_MAX_LISTEN_MINUTES', '60')))
+        self.max_answer = timedelta(minutes=int(os.getenv('PRACTICE_MAX_ANSWER_MINUTES', '360')))
+        self.session_sweep_interval = int(os.getenv('SESSION_SWEEP_INTERVAL', '60'))
+        self.application.job_queue.run_repeating(
+            self.sweep_sessions,
+            interval=self.session_sweep_interval,
+            first=60,
+            name="session_sweeper"
+        )
+        # Сессии, брошенные до перезапуска: при старте и дальше изредка
+        self.application.job_queue.run_repeating(
+            self.close_orphaned_sessions,
+            interval=int(os.getenv('ORPHANED_SESSIONS_INTERVAL', '21600')),
+            first=90,
+            name="orphaned_sessions"
+        )
+        # Еженедельный дайджест: час отправки по понедельникам (UTC) и процессы для расчета итогов
+        self.digest_hour = int(os.getenv('DIGEST_HOUR', '9'))
+        self.digest_workers = int(os.getenv('DIGEST_WORKERS', '2'))
+        self._digest_pool: Optional[ProcessPoolExecutor] = None
+        self.application.job_queue.run_repeating(
+            self.send_weekly_digests,
+            interval=int(os.getenv('DIGEST_CHECK_INTERVAL', '3600')),
+            first=120,
+            name="weekly_digest"
+        )
+        self.application.job_queue.run_repeating(
+            self.refresh_aggregates,
+            interval=int(os.getenv('AGGREGATES_INTERVAL', '300')),
+            first=30,
+            name="practice_aggregates"
+        )
+        
         # Добавляем обработчики
         self.setup_handlers()
     
     def setup_handlers(self):
         """Настраиваем обработчики сообщений"""
+        # Раньше всех остальных: привязываем correlation_id к апдейту
+        self.application.add_handler(TypeHandler(Update, self._bind_correlation_id), group=-1)
+        if self.update_recorder:
+            self.application.add_handler(TypeHandler(Update, self._record_update), group=-2)
+        
         # Команды
         self.application.add_handler(CommandHandler("start", self.start_command))
         self.application.add_handler(CommandHandler("listen", self.start_listening))
         self.application.add_handler(CommandHandler("stats", self.show_stats))
         self.application.add_handler(CommandHandler("library", self.show_library))
+        self.application.add_handler(CommandHandler("export", self.export_command))
+        self.application.add_handler(CommandHandler("broadcast", self.broadcast_command))
         
         # Callback кнопки
+        self.setup_callback_routes()
         self.application.add_handler(CallbackQueryHandler(self.button_handler))
         
         # Голосовые сообщения
@@ -93,6 +1600,233 @@ class SimpleListeningBot:
         
         # Текстовые сообщения
         self.application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, self.handle_text))
+
+    def setup_callback_routes(self):
+        """Таблица маршрутов callback-кнопок"""
+        self.router.route("start_practice", self.start_listening_from_callback)
+        self.router.route("choose_mode", self.show_practice_modes)
+        self.router.route("mode:", self.start_mode_from_callback)
+        self.router.route("show_stats", self.show_stats_from_callback)
+        self.router.route("how_it_works", self.show_how_it_works)
+        self.router.route("open_library", self.open_library_from_callback)
+        self.router.route("lib:play:", self.library_play_audio)
+        self.router.route("lib:page:", self.show_library_from_callback)
+        self.router.route("lib:similar:", self.library_similar)
+        self.router.route("bc:send:", self.broadcast_send_from_callback)
+        self.router.route("bc:cancel:", self.broadcast_cancel_from_callback)
+
+    def _log_timing(self, name: str, elapsed: float):
+        logger.info("%s: %.1f мс", name, elapsed * 1000,
+                    extra={'event': 'route_timing', 'route': name, 'duration_ms': round(elapsed * 1000, 1)})
+
+    async def _bind_correlation_id(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Все логи, записанные при обработке этого апдейта, получат его update_id"""
+        correlation_id.set(str(update.update_id))
+
+    async def _record_update(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        self.update_recorder.record(update.to_dict())
+
+    # ===== Аудиоподсказки практик =====
+    async def _post_init(self, application: Application):
+        """После запуска заранее загружаем подсказки, которых еще нет в кэше, и продолжаем прерванные рассылки"""
+        if self.assets_chat_id:
+            await self.preload_practice_assets(application.bot)
+        await self.resume_broadcasts(application)
+
+    async def _post_shutdown(self, application: Application):
+        """При остановке гасим движок распознавания и пулы процессов, чтобы не оставлять воркеры"""
+        if self.transcriber is not None:
+            self.transcriber.close()
+        for pool in (self._chart_pool, self._embedding_pool, self._digest_pool):
+            if pool is not None:
+                pool.shutdown(wait=False, cancel_futures=True)
+
+    async def preload_practice_assets(self, bot):
+        """Параллельно загружаем в служебный чат все подсказки без актуального file_id"""
+        pending = []
+        for mode in PRACTICE_MODES:
+            for cue in PRACTICE_CUES:
+                path = practice_asset_path(mode, cue)
+                if not os.path.exists(path):
+                    continue
+                if self.audio_assets.get(os.path.basename(path), self._asset_digest(path)) is None:
+                    pending.append((mode, cue))
+        if not pending:
+            return
+
+        results = await asyncio.gather(
+            *(self._upload_practice_asset(bot, self.assets_chat_id, mode, cue) for mode, cue in pending),
+            return_exceptions=True
+        )
+        failed = [f"{mode}_{cue}" for (mode, cue), result in zip(pending, results) if isinstance(result, Exception)]
+        if failed:
+            logger.error("Не удалось загрузить аудиоподсказки: %s", ', '.join(failed), extra={'event': 'practice_cues_load_failed'})
+        logger.info("Аудиоподсказок загружено: %s", len(pending) - len(failed))
+
+    def _asset_digest(self, path: str) -> str:
+        """sha1 содержимого файла; пересчитываем, только если файл изменился"""
+        mtime = os.stat(path).st_mtime_ns
+        cached = self._asset_digests.get(path)
+        if cached and cached[0] == mtime:
+            return cached[1]
+        with open(path, 'rb') as f:
+            digest = hashlib.sha1(f.read()).hexdigest()
+        self._asset_digests[path] = (mtime, digest)
+        return digest
+
+    async def _upload_practice_asset(self, bot, chat_id, mode: str, cue: str):
+        """Загружаем файл подсказки в чат и запоминаем выданный Telegram file_id"""
+        path = practice_asset_path(mode, cue)
+        digest = self._asset_digest(path)
+        with open(path, 'rb') as f:
+            message = await bot.send_voice(chat_id=chat_id, voice=f, disable_notification=True)
+        self.audio_assets.put(os.path.basename(path), digest, message.voice.file_id)
+        return message
+
+    async def send_practice_cue(self, chat_id: int, mode: Optional[str], cue: str, context: ContextTypes.DEFAULT_TYPE) -> bool:
+        """Отправляем вступление или завершение практики ссылкой на file_id (без загрузки файла)"""
+        if mode not in PRACTICE_MODES:
+            return False
+        path = practice_asset_path(mode, cue)
+        if not os.path.exists(path):
+            return False
+        name = os.path.basename(path)
+
+        try:
+            file_id = self.audio_assets.get(name, self._asset_digest(path))
+            if file_id:
+                try:
+                    await context.bot.send_voice(chat_id=chat_id, voice=file_id)
+                    return True
+                except BadRequest as e:
+                    # file_id больше не действует (например, бот пересоздан) — загружаем файл заново
+                    logger.warning("Кэшированный file_id подсказки %s устарел: %s", name, e, extra={'event': 'practice_cue_file_id_stale'})
+                    self.audio_assets.forget(name)
+            await self._upload_practice_asset(context.bot, chat_id, mode, cue)
+            return True
+        except Exception as e:
+            logger.error("Не удалось отправить аудиоподсказку %s: %s", name, e, extra={'event': 'practice_cue_send_failed'})
+            return False
+
+    # ===== Supabase (PostgREST) =====
+    async def _supabase_request(self, method: str, url: str, headers: Optional[dict] = None, data: Optional[str] = None,
+                                fail_fast: bool = False):
+        """Запрос к PostgREST с таймаутом, повторами с джиттером и circuit breaker.
+
+        fail_fast — для запросов, которых ждет пользователь: одна попытка с SUPABASE_USER_TIMEOUT,
+        чтобы при деградации Supabase не ждать retries × timeout, пока откроется breaker.
+        Возвращает Response или None, если Supabase недоступен (breaker открыт или все попытки неудачны).
+        """
+        if not self.breaker.allow_request():
+            return None
+
+        attempts = 1 if fail_fast else self.supabase_retries
+        timeout = self.supabase_user_timeout if fail_fast else self.supabase_timeout
+        response = None
+        for attempt in range(1, attempts + 1):
+            try:
+                response = await asyncio.to_thread(
+                    requests.request, method, url,
+                    headers=headers or self.headers, data=data, timeout=timeout
+                )
+            except requests.RequestException as e:
+                logger.warning("Supabase %s не удался (попытка %s): %s", method, attempt, e, extra={'event': 'supabase_retry'})
+                response = None
+
+            if not _is_retryable(response):
+                self.breaker.record_success()
+                return response
+
+            if attempt < attempts:
+                # Full jitter: случайная пауза до base * 2^attempt
+                await asyncio.sleep(random.uniform(0, self.supabase_backoff * (2 ** attempt)))
+
+        self.breaker.record_failure()
+        return None
+
+    async def _supabase_write(self, method: str, url: str, data: Union[dict, list], prefer: str = 'return=minimal'):
+        """Запись в Supabase. Если Supabase недоступен — кладем запись в локальную очередь.
+
+        Повторы с полными таймаутами делает flush_outbox в фоне, поэтому здесь — одна быстрая попытка.
+        """
+        body = json.dumps(data)
+
+        # Пока очередь не пуста, новые записи тоже идут в нее, чтобы сохранить порядок
+        if len(self.outbox) == 0:
+            response = await self._supabase_request(method, url, {**self.headers, 'Prefer': prefer}, body, fail_fast=True)
+            if response is not None:
+                return response
+
+        self.outbox.push(method, url, prefer, body)
+        logger.warning("Supabase недоступен — запись %s поставлена в очередь", method, extra={'event': 'supabase_write_queued'})
+        return QueuedResponse()
+
+    async def _iter_keyset_pages(self, url: str, page_size: int = 500, key: str = 'created_at',
+                                 after: Optional[dict] = None, tiebreak: Optional[str] = 'id'):
+        """Постраничное чтение по ключу (key, tiebreak) без OFFSET — память не зависит от объема истории.
+
+        after — строка, после которой начинать (например, сохраненный водяной знак).
+        tiebreak=None — key уникален (например, telegram_user_id), сравниваем только по нему.
+        """
+        order = f"{key}.asc,{tiebreak}.asc" if tiebreak else f"{key}.asc"
+        last = after
+        while True:
+            page_url = f"{url}&order={order}&limit={page_size}"
+            if last and tiebreak:
+                # Внутри or=(...) значения с ":" и "." нужно брать в кавычки
+                value = quote(f'"{last[key]}"', safe='')
+                page_url += f"&or=({key}.gt.{value},and({key}.eq.{value},{tiebreak}.gt.{last[tiebreak]}))"
+            elif last:
+                page_url += f"&{key}=gt.{quote(str(last[key]), safe='')}"
+            resp = await self._supabase_request('GET', page_url)
+            if resp is None or resp.status_code != 200:
+                status = resp.status_code if resp is not None else 'нет ответа'
+                raise RuntimeError(f"Не удалось прочитать страницу из Supabase: {status}")
+            rows = resp.json() or []
+            if rows:
+                yield rows
+            if len(rows) < page_size:
+                return
+            last = rows[-1]
+
+    async def _iter_keyset(self, url: str, page_size: int = 500, key: str = 'created_at', after: Optional[dict] = None):
+        """То же построчно"""
+        async for rows in self._iter_keyset_pages(url, page_size, key, after):
+            for row in rows:
+                yield row
+
+    async def flush_outbox(self, context: ContextTypes.DEFAULT_TYPE):
+        """Переотправляем отложенные записи по порядку, когда breaker снова пропускает запросы.
+
+        Отклоненные (4xx) записи и записи, не прошедшие за outbox_max_attempts попыток при
+        закрытом breaker, переносятся в dead letter, чтобы одна запись не держала всю очередь.
+        """
+        while True:
+            entries = self.outbox.peek()
+            if not entries:
+                return
+            for entry_id, method, url, prefer, body in entries:
+                # Попытки считаем, только пока Supabase в целом отвечает: во время сбоя очередь просто ждет
+                healthy = self.breaker.is_closed
+                response = await self._supabase_request(method, url, {**self.headers, 'Prefer': prefer}, body)
+                if response is None:
+                    if not healthy:
+                        return
+                    attempts = self.outbox.record_attempt(entry_id)
+                    if attempts < self.outbox_max_attempts:
+                        # Попробуем в следующий раз, не нарушая порядок
+                        return
+                    logger.error("Отложенная запись %s %s не прошла за %s попыток — перенесена в dead letter",
+                                 method, url, attempts, extra={'event': 'outbox_dead_letter'})
+                    self.outbox.dead_letter(entry_id, f"нет ответа после {attempts} попыток")
+                    continue
+                if response.status_code >= 400:
+                    logger.error("Отложенная запись %s %s отклонена Supabase: %s - %s — перенесена в dead letter",
+                                 method, url, response.status_code, response.text, extra={'event': 'outbox_dead_letter'})
+                    self.outbox.dead_letter(entry_id, f"{response.status_code}: {response.text}")
+                    continue
+                self.outbox.remove(entry_id)
+            logger.info("Отложенные записи переотправлены в Supabase")
     
     async def start_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Обработчик команды /start"""
@@ -113,6 +1847,7 @@ class SimpleListeningBot:
         
         keyboard = InlineKeyboardMarkup([
             [InlineKeyboardButton("🎧 Что ты слышишь теперь?", callback_data="start_practice")],
+            [InlineKeyboardButton("🧭 Практика с сопровождением", callback_data="choose_mode")],
             [InlineKeyboardButton("📊 Моя статистика", callback_data="show_stats")],
             [InlineKeyboardButton("ℹ️ Как это работает", callback_data="how_it_works")],
             [InlineKeyboardButton("📚 Мои записи", callback_data="open_library")]
@@ -121,7 +1856,10 @@ class SimpleListeningBot:
         await update.message.reply_text(welcome_text, reply_markup=keyboard)
     
     async def register_user(self, user_id: int, username: str, first_name: str):
-        """Регистрируем нового пользователя"""
+        """Регистрируем нового пользователя (upsert только для новых или при изменении профиля)"""
+        if self.known_users.is_current(user_id, username, first_name):
+            return
+
         user_data = {
             'telegram_user_id': user_id,
             'username': username,
@@ -133,26 +1871,28 @@ class SimpleListeningBot:
         
         # Используем upsert для избежания дублирования
         api_url = f"{self.supabase_url}/rest/v1/listening_users"
-        headers = {**self.headers, 'Prefer': 'resolution=merge-duplicates'}
         
         try:
-            response = requests.post(api_url, headers=headers, data=json.dumps(user_data))
-            if response.status_code in [200, 201]:
-                logger.info(f"Пользователь {user_id} зарегистрирован")
+            response = await self._supabase_write('POST', api_url, user_data, prefer='resolution=merge-duplicates')
+            if response.status_code in [200, 201, 202]:
+                self.known_users.remember(user_id, username, first_name)
+                logger.info("Пользователь %s зарегистрирован", user_id, extra={'event': 'user_registered', 'user_id': user_id})
             else:
-                logger.error(f"Ошибка регистрации пользователя: {response.status_code} - {response.text}")
+                logger.error("Ошибка регистрации пользователя: %s - %s", response.status_code, response.text, extra={'event': 'user_register_failed'})
         except Exception as e:
-            logger.error(f"Ошибка при регистрации пользователя: {e}")
+            logger.error("Ошибка при регистрации пользователя: %s", e, extra={'event': 'user_register_failed'})
     
     async def start_listening(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Начинаем сессию прослушивания"""
         user_id = update.effective_user.id
+        # /listen nature, /listen urban — практика с сопровождением
+        mode = context.args[0].lower() if context.args else None
+        if mode not in PRACTICE_MODES:
+            mode = None
         
         # Создаем новую сессию
-        session_id = await self.create_listening_session(user_id)
+        session_id = await self.create_listening_session(user_id, mode)
         if session_id:
-            context.user_data['current_session'] = session_id
-            
             text = """
 🎧 Начинаем практику глубокого слушания!
 
@@ -161,8 +1901,11 @@ class SimpleListeningBot:
 👂 Расслабься, сделай 3 глубоких вдоха и прикрой глаза
 ⏰ Слушай все звуки вокруг столько, сколько захочется
             """
+            if mode:
+                text = PRACTICE_MODES[mode]['text']
             
             msg = await update.message.reply_text(text)
+            await self.send_practice_cue(update.effective_chat.id, mode, 'intro', context)
             
             # Создаем фейковый query для start_timer
             class FakeQuery:
@@ -171,32 +1914,39 @@ class SimpleListeningBot:
                     self.from_user = user
             
             fake_query = FakeQuery(msg, update.effective_user)
-            await self.start_timer(fake_query, context)
+            await self.start_timer(fake_query, context, session_id, mode)
         else:
             await update.message.reply_text("Произошла ошибка. Попробуйте еще раз.")
     
-    async def create_listening_session(self, user_id: int) -> Optional[str]:
+    async def create_listening_session(self, user_id: int, mode: Optional[str] = None) -> Optional[str]:
         """Создаем новую сессию прослушивания"""
+        # id генерируем сами, чтобы практика продолжалась, даже если запись ушла в очередь
+        new_session_id = str(uuid.uuid4())
         session_data = {
+            'id': new_session_id,
             'user_id': user_id,
             'session_date': datetime.now().date().isoformat(),
             'session_time': datetime.now().time().isoformat(),
             'status': 'started'
         }
+        if mode:
+            session_data['practice_mode'] = mode
         
         api_url = f"{self.supabase_url}/rest/v1/listening_sessions"
-        headers = {**self.headers, 'Prefer': 'return=representation'}
         
         try:
-            response = requests.post(api_url, headers=headers, data=json.dumps(session_data))
+            response = await self._supabase_write('POST', api_url, session_data, prefer='return=representation')
             if response.status_code in [200, 201]:
                 result = response.json()
                 if result and len(result) > 0:
                     return result[0]['id']
+                return new_session_id
+            elif response.status_code == 202:
+                return new_session_id
             else:
-                logger.error(f"Ошибка создания сессии: {response.status_code} - {response.text}")
+                logger.error("Ошибка создания сессии: %s - %s", response.status_code, response.text, extra={'event': 'session_create_failed'})
         except Exception as e:
-            logger.error(f"Ошибка при создании сессии: {e}")
+            logger.error("Ошибка при создании сессии: %s", e, extra={'event': 'session_create_failed'})
         
         return None
     
@@ -208,34 +1958,34 @@ class SimpleListeningBot:
         except Exception:
             pass
         
-        if query.data == "start_practice":
-            await self.start_listening_from_callback(query, context)
-        elif query.data == "show_stats":
-            await self.show_stats_from_callback(query, context)
-        elif query.data == "how_it_works":
-            await self.show_how_it_works(query, context)
-        elif query.data == "open_library":
-            await self._render_library(
-                chat_id=query.message.chat_id,
-                user_id=query.from_user.id,
-                page=1,
-                edit_message_id=query.message.message_id,
-                context=context,
-            )
-        elif query.data.startswith("lib:play:"):
-            await self.library_play_audio(query, context)
-        elif query.data.startswith("lib:page:"):
-            await self.show_library_from_callback(query, context)
+        if not await self.router.dispatch(query.data, query, context):
+            logger.warning("Неизвестная callback-кнопка: %s", query.data, extra={'event': 'unknown_callback'})
+    
+    async def start_mode_from_callback(self, query, context):
+        """Кнопка mode:<mode> — практика с сопровождением"""
+        await self.start_listening_from_callback(query, context, mode=query.data.split(":", 1)[1])
+    
+    async def show_practice_modes(self, query, context):
+        """Выбор практики с сопровождением"""
+        keyboard = InlineKeyboardMarkup(
+            [[InlineKeyboardButton(mode['title'], callback_data=f"mode:{key}")] for key, mode in PRACTICE_MODES.items()]
+            + [[InlineKeyboardButton("🎧 Свободная практика", callback_data="start_practice")]]
+        )
+        await query.edit_message_text(
+            "🧭 Выбери практику\n\n"
+            "В начале и в конце я пришлю короткую аудиоподсказку.",
+            reply_markup=keyboard
+        )
     
-    async def start_listening_from_callback(self, query, context):
+    async def start_listening_from_callback(self, query, context, mode: Optional[str] = None):
         """Начинаем прослушивание из callback"""
         user_id = query.from_user.id
+        if mode not in PRACTICE_MODES:
+            mode = None
         
         # Создаем новую сессию
-        session_id = await self.create_listening_session(user_id)
+        session_id = await self.create_listening_session(user_id, mode)
         if session_id:
-            context.user_data['current_session'] = session_id
-            
             text = """
 🎧 Начинаем практику глубокого слушания!
 
@@ -244,13 +1994,16 @@ class SimpleListeningBot:
 👂 Расслабься, сделай 3 глубоких вдоха и прикрой глаза
 ⏰ Слушай все звуки вокруг столько, сколько захочется
             """
+            if mode:
+                text = PRACTICE_MODES[mode]['text']
             
             await query.edit_message_text(text)
+            await self.send_practice_cue(query.message.chat_id, mode, 'intro', context)
             
             # Сразу запускаем таймер
-            await self.start_timer(query, context)
+            await self.start_timer(query, context, session_id, mode)
     
-    async def start_timer(self, query, context):
+    async def start_timer(self, query, context, session_id: str, mode: Optional[str] = None):
         """Начинаем практику с пользовательским контролем времени"""
         timer_msg = await context.bot.send_message(
             chat_id=query.message.chat_id,
@@ -260,20 +2013,8 @@ class SimpleListeningBot:
         )
         
         # Отмечаем, что пользователь должен записывать
-        if 'user_sessions' not in context.bot_data:
-            context.bot_data['user_sessions'] = {}
-        
         user_id = query.from_user.id
-        if user_id not in context.bot_data['user_sessions']:
-            context.bot_data['user_sessions'][user_id] = {}
-        
-        context.bot_data['user_sessions'][user_id].update({
-            'should_be_recording': True,
-            'session_id': context.user_data.get('current_session'),
-            'start_time': datetime.now(),
-            'timer_message_id': timer_msg.message_id,
-            'instruction_message_id': None
-        })
+        self.practices[user_id] = PracticeSession(session_id, query.message.chat_id, mode, timer_msg.message_id)
         
         # Запускаем визуальный таймер (обновляется каждые 15 секунд)
         context.job_queue.run_repeating(
@@ -282,7 +2023,7 @@ class SimpleListeningBot:
             first=15,
             chat_id=query.message.chat_id,
             user_id=query.from_user.id,
-            data={'session_id': context.user_data.get('current_session')},
+            data={'session_id': session_id},
             name=f"timer_{user_id}"
         )
     
@@ -291,24 +2032,20 @@ class SimpleListeningBot:
         chat_id = context.job.chat_id
         user_id = context.job.user_id
         
-        user_session = context.bot_data.get('user_sessions', {}).get(user_id, {})
+        practice = self.practices.get(user_id)
         
         # Если пользователь больше не записывает, останавливаем таймер
-        if not user_session.get('should_be_recording'):
+        if practice is None or practice.state is not PracticeState.LISTENING:
             context.job.schedule_removal()
             return
             
-        start_time = user_session.get('start_time')
-        if not start_time:
-            return
-            
         # Вычисляем прошедшее время
-        elapsed = datetime.now() - start_time
-        minutes = int(elapsed.total_seconds() // 60)
-        seconds = int(elapsed.total_seconds() % 60)
+        elapsed = monotonic() - practice.started_at
+        minutes = int(elapsed // 60)
+        seconds = int(elapsed % 60)
         
         # Обновляем сообщение с таймером
-        timer_message_id = user_session.get('timer_message_id')
+        timer_message_id = practice.timer_message_id
         if timer_message_id:
             try:
                 await context.bot.edit_message_text(
@@ -322,6 +2059,70 @@ class SimpleListeningBot:
                 # Если не удалось обновить сообщение, продолжаем
                 pass
 
+    async def sweep_sessions(self, context: ContextTypes.DEFAULT_TYPE):
+        """Периодическая очистка: закрываем брошенные практики, останавливаем их таймеры
+        и одним запросом помечаем сессии как abandoned"""
+        now = monotonic()
+        limits = {
+            PracticeState.LISTENING: self.max_listen.total_seconds(),
+            PracticeState.ANSWERING: self.max_answer.total_seconds(),
+        }
+        expired = []
+        
+        for user_id, practice in list(self.practices.items()):
+            limit = limits.get(practice.state)
+            if limit is None:
+                # Практика завершена — состояние в памяти больше не нужно
+                self.practices.pop(user_id, None)
+            elif now - practice.state_since > limit:
+                expired.append((user_id, self.practices.pop(user_id)))
+        
+        for user_id, practice in expired:
+            for job in context.job_queue.get_jobs_by_name(f"timer_{user_id}"):
+                job.schedule_removal()
+            
+            if practice.timer_message_id and practice.state is PracticeState.LISTENING:
+                try:
+                    await context.bot.edit_message_text(
+                        chat_id=practice.chat_id,
+                        message_id=practice.timer_message_id,
+                        text="⏸ Практика остановлена.\n\n🎧 Начни новую, когда будешь готов."
+                    )
+                except Exception:
+                    pass
+        
+        await self.mark_sessions_abandoned([p.session_id for _, p in expired if p.session_id])
+    
+    async def mark_sessions_abandoned(self, session_ids: list):
+        """Одним PATCH помечаем abandoned истекшие сессии (только переданные id)"""
+        if not session_ids:
+            return
+        api_url = f"{self.supabase_url}/rest/v1/listening_sessions?status=eq.started&id=in.({','.join(session_ids)})"
+        await self._patch_abandoned(api_url, len(session_ids))
+    
+    async def close_orphaned_sessions(self, context: ContextTypes.DEFAULT_TYPE):
+        """Редкая задача (и при старте): закрываем давно незавершенные сессии, которых нет в памяти,
+        например брошенные до перезапуска бота.
+
+        Практика живет в памяти не дольше max_listen + max_answer (плюс период очистки),
+        поэтому сессии старше этого срока точно не активны.
+        """
+        age = self.max_listen + self.max_answer + 2 * timedelta(seconds=self.session_sweep_interval)
+        cutoff = (datetime.now(timezone.utc) - age).isoformat()
+        api_url = f"{self.supabase_url}/rest/v1/listening_sessions?status=eq.started&created_at=lt.{quote(cutoff, safe='')}"
+        await self._patch_abandoned(api_url)
+    
+    async def _patch_abandoned(self, api_url: str, expected: Optional[int] = None):
+        try:
+            response = await self._supabase_write('PATCH', api_url, {'status': 'abandoned'})
+            if response.status_code in [202, 204]:
+                if expected:
+                    logger.info("Брошенных практик закрыто: %s", expected)
+            else:
+                logger.error("Ошибка при закрытии брошенных практик: %s", response.status_code, extra={'event': 'orphaned_sessions_failed'})
+        except Exception as e:
+            logger.error("Ошибка при закрытии брошенных практик: %s", e, extra={'event': 'orphaned_sessions_failed'})
+    
     async def recording_finished(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Пользователь закончил запись - переходим к вопросу"""
         user_id = update.effective_user.id
@@ -332,36 +2133,33 @@ class SimpleListeningBot:
         for job in current_jobs:
             job.schedule_removal()
         
-        # Обновляем финальное время
-        user_session = context.bot_data.get('user_sessions', {}).get(user_id, {})
-        start_time = user_session.get('start_time')
-        if start_time:
-            elapsed = datetime.now() - start_time
-            minutes = int(elapsed.total_seconds() // 60)
-            seconds = int(elapsed.total_seconds() % 60)
-            
-            # Обновляем сообщение с финальным временем
-            timer_message_id = user_session.get('timer_message_id')
-            if timer_message_id:
-                try:
-                    await context.bot.edit_message_text(
-                        chat_id=chat_id,
-                        message_id=timer_message_id,
-                        text=f"✅ Практика завершена!\n\n"
-                             f"👂 Ты слушал: {minutes:02d}:{seconds:02d}\n"
-                             f"🎙️ Аудио получено!"
-                    )
-                except Exception:
-                    pass
+        # Обновляем сообщение с финальным временем
+        practice = self.practices.get(user_id)
+        if practice is not None and practice.timer_message_id:
+            elapsed = monotonic() - practice.started_at
+            minutes = int(elapsed // 60)
+            seconds = int(elapsed % 60)
+            try:
+                await context.bot.edit_message_text(
+                    chat_id=chat_id,
+                    message_id=practice.timer_message_id,
+                    text=f"✅ Практика завершена!\n\n"
+                         f"👂 Ты слушал: {minutes:02d}:{seconds:02d}\n"
+                         f"🎙️ Аудио получено!"
+                )
+            except Exception:
+                pass
         
         # Убираем инструкцию
-        instruction_message_id = user_session.get('instruction_message_id')
-        if instruction_message_id:
+        if practice is not None and practice.instruction_message_id:
             try:
-                await context.bot.delete_message(chat_id=chat_id, message_id=instruction_message_id)
+                await context.bot.delete_message(chat_id=chat_id, message_id=practice.instruction_message_id)
             except Exception:
                 pass
         
+        # Завершающая подсказка практики с сопровождением
+        await self.send_practice_cue(chat_id, practice.mode if practice else None, 'outro', context)
+        
         # Переходим к вопросу
         await asyncio.sleep(1)  # Небольшая пауза для плавности
         
@@ -382,53 +2180,26 @@ class SimpleListeningBot:
         user_id = update.effective_user.id
         file_id = update.message.voice.file_id
         duration = update.message.voice.duration
+        file_size = update.message.voice.file_size
         
-        user_session = context.bot_data.get('user_sessions', {}).get(user_id, {})
+        practice = self.practices.get(user_id)
+        state = practice.state if practice is not None else None
         
         # Проверяем, что именно мы ждем от пользователя
-        if user_session.get('should_be_recording') and not user_session.get('waiting_for_answer'):
+        if state is PracticeState.LISTENING:
             # Это аудио окружения во время практики - пользователь закончил слушать
-            session_id = user_session['session_id']
             message_id = update.message.message_id
-            await self.save_environment_audio(session_id, file_id, duration, message_id)
+            await self.save_environment_audio(practice.session_id, file_id, duration, message_id, user_id=user_id)
             
-            # Отмечаем, что получили аудио окружения и практика закончена
-            context.bot_data['user_sessions'][user_id].update({
-                'received_environment_audio': True,
-                'should_be_recording': False,
-                'waiting_for_answer': True
-            })
+            # Практика закончена — ждем ответ
+            practice.advance(PracticeState.ANSWERING)
             
             # Вызываем метод завершения записи
             await self.recording_finished(update, context)
             
-        elif user_session.get('waiting_for_answer'):
-            # Сохраняем голосовую рефлексию
-            session_id = user_session['session_id']
-            
-            # Транскрибируем аудио
-            transcription = await self.transcribe_audio(file_id)
-            
-            # Сохраняем голосовой ответ с транскрипцией
-            await self.save_voice_answer_with_transcription(session_id, file_id, transcription)
-            
-            # Завершаем сессию
-            await self.complete_session(session_id)
-            
-            # Убираем из ожидания
-            context.bot_data['user_sessions'][user_id]['waiting_for_answer'] = False
-            
-            # Показываем кнопки для следующего действия (без "Мои записи")
-            keyboard = InlineKeyboardMarkup([
-                [InlineKeyboardButton("🎧 Что ты слышишь теперь?", callback_data="start_practice")],
-                [InlineKeyboardButton("📊 Моя статистика", callback_data="show_stats")],
-                [InlineKeyboardButton("ℹ️ Как это работает", callback_data="how_it_works")]
-            ])
-            
-            await update.message.reply_text(
-                "🎙️ Спасибо за то, что ты поделился!",
-                reply_markup=keyboard
-            )
+        elif state is PracticeState.ANSWERING:
+            answer = {'file_id': file_id, 'duration': duration, 'file_size': file_size, 'chat_id': update.effective_chat.id}
+            await self.complete_answer(update.effective_chat.id, user_id, practice.session_id, 'voice', answer, context)
         else:
             await update.message.reply_text(
                 "Сначала начни практику командой /listen или нажми 🎧 Что ты слышишь теперь?"
@@ -439,29 +2210,10 @@ class SimpleListeningBot:
         user_id = update.effective_user.id
         
         # Проверяем, ждем ли мы ответ от этого пользователя
-        if (context.bot_data.get('user_sessions', {}).get(user_id, {}).get('waiting_for_answer')):
-            session_id = context.bot_data['user_sessions'][user_id]['session_id']
-            text_answer = update.message.text
-            
-            # Сохраняем текстовый ответ
-            await self.save_text_answer(session_id, text_answer)
-            
-            # Завершаем сессию
-            await self.complete_session(session_id)
-            
-            # Убираем из ожидания
-            context.bot_data['user_sessions'][user_id]['waiting_for_answer'] = False
-            
-            # Показываем кнопки для следующего действия (без "Мои записи")
-            keyboard = InlineKeyboardMarkup([
-                [InlineKeyboardButton("🎧 Что ты слышишь теперь?", callback_data="start_practice")],
-                [InlineKeyboardButton("📊 Моя статистика", callback_data="show_stats")],
-                [InlineKeyboardButton("ℹ️ Как это работает", callback_data="how_it_works")]
-            ])
-            
-            await update.message.reply_text(
-                "📝 Спасибо за то, что ты поделился!",
-                reply_markup=keyboard
+        practice = self.practices.get(user_id)
+        if practice is not None and practice.state is PracticeState.ANSWERING:
+            await self.complete_answer(
+                update.effective_chat.id, user_id, practice.session_id, 'text', {'text': update.message.text}, context
             )
         else:
             await update.message.reply_text(
@@ -469,49 +2221,191 @@ class SimpleListeningBot:
             )
     
     async def handle_photo(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
-        """Обработчик фотографий"""
+        """Обработчик фотографий (в том числе альбомов из нескольких фото)"""
         user_id = update.effective_user.id
+        message = update.message
+        
+        # Храним только file_id и размер самой большой версии фото, а не все PhotoSize
+        photo = message.photo[-1]
+        attachment = (photo.file_id, photo.file_size)
+        
+        # Остальные фото уже открытого альбома просто добавляем в буфер
+        media_groups = context.bot_data.setdefault('media_groups', {})
+        group = media_groups.get(message.media_group_id) if message.media_group_id else None
+        if group is not None:
+            if group['session_id']:
+                group['photos'].append(attachment)
+                if message.caption and not group['caption']:
+                    group['caption'] = message.caption
+            return
         
-        # Проверяем, ждем ли мы ответ от этого пользователя
-        if (context.bot_data.get('user_sessions', {}).get(user_id, {}).get('waiting_for_answer')):
-            session_id = context.bot_data['user_sessions'][user_id]['session_id']
-            
-            # Получаем file_id самой большой версии фото
-            photo = update.message.photo[-1]
-            photo_file_id = photo.file_id
-            
-            # Получаем подпись к фото, если есть
-            caption = update.message.caption or ""
-            
-            # Сохраняем фото и подпись
-            await self.save_photo_answer(session_id, photo_file_id, caption)
-            
-            # Завершаем сессию
-            await self.complete_session(session_id)
-            
-            # Убираем из ожидания
-            context.bot_data['user_sessions'][user_id]['waiting_for_answer'] = False
-            
-            # Показываем кнопки для следующего действия (без "Мои записи")
-            keyboard = InlineKeyboardMarkup([
-                [InlineKeyboardButton("🎧 Что ты слышишь теперь?", callback_data="start_practice")],
-                [InlineKeyboardButton("📊 Моя статистика", callback_data="show_stats")],
-                [InlineKeyboardButton("ℹ️ Как это работает", callback_data="how_it_works")]
-            ])
-            
-            await update.message.reply_text(
-                "📸 Спасибо за то, что ты поделился!",
-                reply_markup=keyboard
-            )
+        practice = self.practices.get(user_id)
+        session_id = practice.session_id if practice is not None and practice.state is PracticeState.ANSWERING else None
+        
+        if session_id:
+            # Сразу закрываем практику, чтобы остальные фото альбома не засчитались отдельным ответом
+            self._finish_practice(user_id, session_id)
         else:
-            await update.message.reply_text(
+            await message.reply_text(
                 "Привет! Начни практику командой /listen или нажми 🎧 Что ты слышишь теперь?"
             )
+        
+        group = {
+            'chat_id': message.chat_id,
+            'user_id': user_id,
+            'session_id': session_id,
+            'photos': [attachment],
+            'caption': message.caption or ""
+        }
+        
+        if message.media_group_id:
+            # Ждем остальные фото альбома; вне практики буфер только глушит повторные подсказки
+            media_groups[message.media_group_id] = group
+            context.job_queue.run_once(
+                self._flush_media_group,
+                when=self.media_group_window,
+                data=message.media_group_id,
+                name=f"media_group_{message.media_group_id}"
+            )
+        elif session_id:
+            await self._complete_photo_answer(group, context)
+    
+    async def _flush_media_group(self, context: ContextTypes.DEFAULT_TYPE):
+        """Окно альбома закрылось — сохраняем все фото одним ответом"""
+        group = context.bot_data.get('media_groups', {}).pop(context.job.data, None)
+        if group and group['session_id']:
+            await self._complete_photo_answer(group, context)
+    
+    async def _complete_photo_answer(self, group: dict, context: ContextTypes.DEFAULT_TYPE):
+        """Сохраняем фото ответа (все фото альбома сразу) и завершаем сессию"""
+        await self.complete_answer(
+            group['chat_id'], group['user_id'], group['session_id'], 'photo',
+            {'photos': group['photos'], 'caption': group['caption']}, context
+        )
+    
+    # ===== Завершение ответа =====
+    def register_answer_step(self, answer_type: str, step):
+        """Добавляем шаг сохранения ответа: async step(session_id, answer)"""
+        self.answer_steps.setdefault(answer_type, []).append(step)
+    
+    async def complete_answer(self, chat_id: int, user_id: int, session_id: str, answer_type: str, answer: dict,
+                              context: ContextTypes.DEFAULT_TYPE):
+        """Общий конвейер для ответа любого типа: шаги сохранения, завершение сессии, благодарность"""
+        # Сразу закрываем практику, чтобы ответ не засчитался дважды
+        self._finish_practice(user_id, session_id)
+        
+        for step in self.answer_steps.get(answer_type, []):
+            await run_timed(f"answer:{answer_type}:{step.__name__}", step(session_id, answer), self.timing_hooks)
+        
+        await self.complete_session(session_id)
+        
+        await context.bot.send_message(
+            chat_id=chat_id,
+            text=ANSWER_THANKS.get(answer_type, "Спасибо за то, что ты поделился!"),
+            reply_markup=after_answer_keyboard()
+        )
+    
+    def _finish_practice(self, user_id: int, session_id: str):
+        """Переводим практику в COMPLETED и убираем ее из памяти (если пользователь не начал новую)"""
+        practice = self.practices.get(user_id)
+        if practice is None or practice.session_id != session_id:
+            return
+        if practice.can_advance(PracticeState.COMPLETED):
+            practice.advance(PracticeState.COMPLETED)
+        del self.practices[user_id]
+    
+    def _voice_tier(self, duration: Optional[int], file_size: Optional[int]) -> str:
+        """Как обрабатывать голосовой ответ: inline, chunked, background или too_large"""
+        duration, file_size = duration or 0, file_size or 0
+        if file_size > TELEGRAM_DOWNLOAD_LIMIT:
+            return 'too_large'
+        if duration <= self.voice_inline_max_seconds and file_size <= self.voice_inline_max_bytes:
+            return 'inline'
+        if duration <= self.voice_chunked_max_seconds:
+            return 'chunked'
+        return 'background'
+    
+    async def _persist_voice_answer(self, session_id: str, answer: dict):
+        file_id = answer['file_id']
+        tier = self._voice_tier(answer.get('duration'), answer.get('file_size'))
+        if tier == 'inline':
+            transcription = await self.transcribe_audio(file_id)
+        elif tier == 'chunked':
+            # Апдейты обрабатываются по одному: длинную запись распознаем вне обработчика,
+            # сессию закрываем сразу с заглушкой и дописываем текст, когда он будет готов
+            await self.save_voice_answer_with_transcription(session_id, file_id, TRANSCRIPTION_PENDING)
+            self.application.create_task(self._transcribe_deferred(session_id, file_id))
+            return
+        elif tier == 'background':
+            # То же, но через очередь с сообщением о прогрессе
+            await self.save_voice_answer_with_transcription(session_id, file_id, TRANSCRIPTION_PENDING)
+            await self._enqueue_voice_transcription(session_id, file_id, answer)
+            return
+        else:
+            transcription = TRANSCRIPTION_TOO_LARGE
+        await self.save_voice_answer_with_transcription(session_id, file_id, transcription)
+    
+    async def _transcribe_deferred(self, session_id: str, file_id: str, progress=None) -> bool:
+        """Распознаем запись по частям и дописываем текст в сессию. False — текст получить не удалось.
+
+        Заглушку неудачи тоже сохраняем: такие сессии потом подберет scripts/backfill_transcriptions.py.
+        """
+        text = await self.transcribe_audio_chunked(file_id, progress=progress)
+        await self.save_transcription(session_id, text)
+        return text not in (TRANSCRIPTION_FAILED, TRANSCRIPTION_UNAVAILABLE)
+    
+    async def _enqueue_voice_transcription(self, session_id: str, file_id: str, answer: dict):
+        """Ставим длинную запись в фоновую очередь и показываем сообщение, которое будет обновляться"""
+        minutes = max(1, round((answer.get('duration') or 0) / 60))
+        position = len(self._voice_queue) + self._voice_workers_active
+        text = f"🕐 Запись длинная (~{minutes} мин) — расшифрую ее в фоне и сообщу, когда текст будет готов"
+        if position:
+            text += f"\nПеред ней в очереди: {position}"
+        progress_message = await self.application.bot.send_message(chat_id=answer['chat_id'], text=text)
+        
+        self._voice_queue.append((session_id, file_id, answer['chat_id'], progress_message.message_id))
+        # Воркеры живут, пока очередь не опустеет: при остановке бот дожидается только текущих записей
+        if self._voice_workers_active < self.voice_background_workers:
+            self._voice_workers_active += 1
+            self.application.create_task(self._voice_transcription_worker())
+    
+    async def _voice_transcription_worker(self):
+        """Фоновый воркер: распознает длинные записи по одной, обновляя сообщение о прогрессе"""
+        try:
+            while self._voice_queue:
+                session_id, file_id, chat_id, message_id = self._voice_queue.popleft()
+                
+                async def report(done: int, total: int):
+                    try:
+                        await self.application.bot.edit_message_text(
+                            chat_id=chat_id, message_id=message_id,
+                            text=f"⏳ Расшифровываю запись: {done} из {total} фрагментов"
+                        )
+                    except TelegramError:
+                        pass
+                
+                try:
+                    if await self._transcribe_deferred(session_id, file_id, progress=report):
+                        text = "📝 Запись расшифрована — текст сохранен в твоей библиотеке"
+                    else:
+                        text = "⚠️ Не удалось расшифровать запись. Голосовое сохранено, текст попробуем получить позже"
+                    await self.application.bot.edit_message_text(chat_id=chat_id, message_id=message_id, text=text)
+                except Exception as e:
+                    logger.error("Ошибка фоновой транскрипции для сессии %s: %s", session_id, e, extra={'event': 'background_transcription_failed'})
+        finally:
+            self._voice_workers_active -= 1
+    
+    async def _persist_text_answer(self, session_id: str, answer: dict):
+        await self.save_text_answer(session_id, answer['text'])
+    
+    async def _persist_photo_answer(self, session_id: str, answer: dict):
+        await self.save_photo_answer(session_id, answer['photos'], answer['caption'])
     
     async def save_voice_answer(self, session_id: str, file_id: str):
         """Сохраняем голосовой ответ"""
         update_data = {
             'what_heard_audio_file_id': file_id,
+            'answer_type': 'voice',
             'status': 'completed',
             'completed_at': datetime.now().isoformat()
         }
@@ -519,19 +2413,20 @@ class SimpleListeningBot:
         api_url = f"{self.supabase_url}/rest/v1/listening_sessions?id=eq.{session_id}"
         
         try:
-            response = requests.patch(api_url, headers=self.headers, data=json.dumps(update_data))
-            if response.status_code == 204:
-                logger.info(f"Голосовой ответ сохранен для сессии {session_id}")
+            response = await self._supabase_write('PATCH', api_url, update_data)
+            if response.status_code in [202, 204]:
+                logger.info("Голосовой ответ сохранен для сессии %s", session_id, extra={'event': 'voice_answer_saved', 'session_id': session_id})
             else:
-                logger.error(f"Ошибка сохранения голосового ответа: {response.status_code}")
+                logger.error("Ошибка сохранения голосового ответа: %s", response.status_code, extra={'event': 'voice_answer_failed'})
         except Exception as e:
-            logger.error(f"Ошибка при сохранении голосового ответа: {e}")
+            logger.error("Ошибка при сохранении голосового ответа: %s", e, extra={'event': 'voice_answer_failed'})
     
     async def save_voice_answer_with_transcription(self, session_id: str, file_id: str, transcription: str):
         """Сохраняем голосовой ответ и текст в существующие поля сессии."""
         # Пишем только в гарантированно существующие поля
         update_data = {
             'what_heard_text': transcription,
+            'answer_type': 'voice',
             'status': 'completed',
             'completed_at': datetime.now().isoformat()
         }
@@ -539,21 +2434,22 @@ class SimpleListeningBot:
         api_url = f"{self.supabase_url}/rest/v1/listening_sessions?id=eq.{session_id}"
         
         try:
-            response = requests.patch(api_url, headers=self.headers, data=json.dumps(update_data))
-            if response.status_code == 204:
-                logger.info(f"Текст транскрипции сохранен для сессии {session_id}")
+            response = await self._supabase_write('PATCH', api_url, update_data)
+            if response.status_code in [202, 204]:
+                logger.info("Текст транскрипции сохранен для сессии %s", session_id, extra={'event': 'transcription_saved', 'session_id': session_id})
 
                 # Также сохраняем метаданные аудио-ответа отдельно
                 await self.save_audio_metadata(session_id, file_id, 'reflection')
             else:
-                logger.error(f"Ошибка сохранения транскрипции: {response.status_code}")
+                logger.error("Ошибка сохранения транскрипции: %s", response.status_code, extra={'event': 'transcription_save_failed'})
         except Exception as e:
-            logger.error(f"Ошибка при сохранении транскрипции: {e}")
+            logger.error("Ошибка при сохранении транскрипции: %s", e, extra={'event': 'transcription_save_failed'})
     
     async def save_text_answer(self, session_id: str, text: str):
         """Сохраняем текстовый ответ"""
         update_data = {
             'what_heard_text': text,
+            'answer_type': 'text',
             'status': 'completed',
             'completed_at': datetime.now().isoformat()
         }
@@ -561,19 +2457,20 @@ class SimpleListeningBot:
         api_url = f"{self.supabase_url}/rest/v1/listening_sessions?id=eq.{session_id}"
         
         try:
-            response = requests.patch(api_url, headers=self.headers, data=json.dumps(update_data))
-            if response.status_code == 204:
-                logger.info(f"Текстовый ответ сохранен для сессии {session_id}")
+            response = await self._supabase_write('PATCH', api_url, update_data)
+            if response.status_code in [202, 204]:
+                logger.info("Текстовый ответ сохранен для сессии %s", session_id, extra={'event': 'text_answer_saved', 'session_id': session_id})
             else:
-                logger.error(f"Ошибка сохранения текстового ответа: {response.status_code}")
+                logger.error("Ошибка сохранения текстового ответа: %s", response.status_code, extra={'event': 'text_answer_failed'})
         except Exception as e:
-            logger.error(f"Ошибка при сохранении текстового ответа: {e}")
+            logger.error("Ошибка при сохранении текстового ответа: %s", e, extra={'event': 'text_answer_failed'})
     
-    async def save_photo_answer(self, session_id: str, photo_file_id: str, caption: str):
-        """Сохраняем фото с подписью"""
+    async def save_photo_answer(self, session_id: str, photos: list, caption: str):
+        """Сохраняем фото с подписью. photos — [(file_id, file_size), ...]"""
         update_data = {
-            'photo_file_id': photo_file_id,
+            'photo_file_id': photos[0][0],
             'what_heard_text': caption if caption else "[Фото без подписи]",
+            'answer_type': 'photo',
             'status': 'completed',
             'completed_at': datetime.now().isoformat()
         }
@@ -581,33 +2478,37 @@ class SimpleListeningBot:
         api_url = f"{self.supabase_url}/rest/v1/listening_sessions?id=eq.{session_id}"
         
         try:
-            response = requests.patch(api_url, headers=self.headers, data=json.dumps(update_data))
-            if response.status_code == 204:
-                logger.info(f"Фото с подписью сохранено для сессии {session_id}")
+            response = await self._supabase_write('PATCH', api_url, update_data)
+            if response.status_code in [202, 204]:
+                logger.info("Фото с подписью сохранено для сессии %s", session_id, extra={'event': 'photo_answer_saved', 'session_id': session_id})
             else:
-                logger.error(f"Ошибка сохранения фото: {response.status_code}")
+                logger.error("Ошибка сохранения фото: %s", response.status_code, extra={'event': 'photo_answer_failed'})
         except Exception as e:
-            logger.error(f"Ошибка при сохранении фото: {e}")
-    
-    async def complete_session(self, session_id: str):
-        """Завершаем сессию"""
-        # Дополнительная логика завершения сессии, если нужна
-        pass
-    
-    async def show_stats(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
-        """Показываем статистику пользователя"""
-        user_id = update.effective_user.id
-        stats = await self.get_user_stats(user_id)
+            logger.error("Ошибка при сохранении фото: %s", e, extra={'event': 'photo_answer_failed'})
         
-        text = f"""
-📊 Ваша статистика практик:
-
-🎧 Всего практик: {stats['total_sessions']}
-✅ Завершенных: {stats['completed_sessions']}
-📅 Последняя практика: {stats['last_session_date'] or 'Еще не было'}
-
-🔥 Продолжайте практиковать каждый день!
-        """
+        # Все фото альбома — одной вставкой
+        photos_data = [
+            {'session_id': session_id, 'telegram_file_id': file_id, 'file_size': file_size, 'position': position}
+            for position, (file_id, file_size) in enumerate(photos)
+        ]
+        
+        try:
+            response = await self._supabase_write('POST', f"{self.supabase_url}/rest/v1/session_photos", photos_data)
+            if response.status_code not in [200, 201, 202]:
+                logger.error("Ошибка сохранения фото альбома: %s", response.status_code, extra={'event': 'photo_album_failed'})
+        except Exception as e:
+            logger.error("Ошибка при сохранении фото альбома: %s", e, extra={'event': 'photo_album_failed'})
+    
+    async def complete_session(self, session_id: str):
+        """Завершаем сессию"""
+        # Дополнительная логика завершения сессии, если нужна
+        pass
+    
+    async def show_stats(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Показываем статистику пользователя"""
+        user_id = update.effective_user.id
+        daily_rows = await self._load_daily_aggregates(user_id)
+        text = await self._build_stats_text(user_id, daily_rows)
         
         keyboard = InlineKeyboardMarkup([
             [InlineKeyboardButton("🎧 Что ты слышишь теперь?", callback_data="start_practice")],
@@ -617,37 +2518,798 @@ class SimpleListeningBot:
         ])
         
         await update.message.reply_text(text, reply_markup=keyboard)
+        await self.send_progress_chart(update.effective_chat.id, user_id, daily_rows, context)
     
     async def show_stats_from_callback(self, query, context):
         """Показываем статистику из callback"""
         user_id = query.from_user.id
-        stats = await self.get_user_stats(user_id)
+        daily_rows = await self._load_daily_aggregates(user_id)
+        text = await self._build_stats_text(user_id, daily_rows)
+        
+        keyboard = InlineKeyboardMarkup([
+            [InlineKeyboardButton("🎧 Что ты слышишь теперь?", callback_data="start_practice")],
+            [InlineKeyboardButton("📊 Моя статистика", callback_data="show_stats")],
+            [InlineKeyboardButton("ℹ️ Как это работает", callback_data="how_it_works")],
+            [InlineKeyboardButton("📚 Мои записи", callback_data="open_library")]
+        ])
         
+        await query.edit_message_text(text, reply_markup=keyboard)
+        await self.send_progress_chart(query.message.chat_id, user_id, daily_rows, context)
+
+    async def _build_stats_text(self, user_id: int, daily_rows: Optional[list]) -> str:
+        """Текст статистики: общие счетчики + сводка из агрегатов за 7 и 30 дней"""
+        stats = await self.get_user_stats(user_id)
+        insights = self.get_practice_insights(daily_rows) if daily_rows else None
+
         text = f"""
 📊 Ваша статистика практик:
 
 🎧 Всего практик: {stats['total_sessions']}
 ✅ Завершенных: {stats['completed_sessions']}
 📅 Последняя практика: {stats['last_session_date'] or 'Еще не было'}
+"""
+        if insights and insights['month_sessions']:
+            text += f"""
+📈 За 7 дней: {insights['week_sessions']} практик, {insights['week_minutes']} мин
+🗓 За 30 дней: {insights['month_sessions']} практик, {insights['month_minutes']} мин
+"""
+            if insights['favorite_answer']:
+                text += f"💬 Чаще всего отвечаешь: {insights['favorite_answer']}\n"
+            if insights['top_keywords']:
+                text += f"🔊 Частые звуки: {', '.join(insights['top_keywords'])}\n"
 
+        text += """
 🔥 Продолжайте практиковать каждый день!
         """
+        return text
+
+    # ===== Aggregates (агрегаты практик) =====
+    AGGREGATES_BATCH_SIZE = 500
+    AGGREGATES_WATERMARK = 'practice_stats'
+    TRANSCRIPTS_WATERMARK = 'practice_stats_transcripts'
+    ANSWER_TYPE_LABELS = {'text_answers': 'текстом', 'voice_answers': 'голосом', 'photo_answers': 'фото'}
+
+    async def refresh_aggregates(self, context: ContextTypes.DEFAULT_TYPE):
+        """Периодическая задача: сворачиваем новые завершенные сессии в дневные и недельные агрегаты.
+
+        Водяной знак идет по completed_ingested_at — времени, когда база получила завершение
+        (ставит триггер), а не по completed_at клиента: записи, доехавшие из outbox позже,
+        тоже попадут в агрегаты. Самые свежие aggregates_settle секунд не читаем, чтобы не
+        обогнать еще не закоммиченные транзакции. За один запуск — не больше aggregates_max_rows.
+
+        Ключевые слова голосовых ответов, текст которых пришел после завершения, добавляет
+        второй проход по text_ingested_at (см. _refresh_transcript_keywords).
+        """
+        settled = (datetime.now(timezone.utc) - timedelta(seconds=self.aggregates_settle)).isoformat()
+        sessions_url = (
+            f"{self.supabase_url}/rest/v1/listening_sessions"
+            f"?completed_ingested_at=lt.{quote(settled, safe='')}"
+            f"&select=id,user_id,created_at,completed_at,completed_ingested_at,text_ingested_at,"
+            f"session_duration_seconds,answer_type,what_heard_text"
+        )
+        processed = 0
+        batch = []
+        try:
+            watermark = await self._get_watermark(self.AGGREGATES_WATERMARK)
+            async for session in self._iter_keyset(sessions_url, page_size=self.AGGREGATES_BATCH_SIZE,
+                                                   key='completed_ingested_at', after=watermark):
+                batch.append(session)
+                if len(batch) >= self.AGGREGATES_BATCH_SIZE:
+                    await self._merge_aggregates(batch)
+                    processed += len(batch)
+                    batch = []
+                    if processed >= self.aggregates_max_rows:
+                        break
+            if batch:
+                await self._merge_aggregates(batch)
+                processed += len(batch)
+            await self._refresh_transcript_keywords(settled)
+        except Exception as e:
+            logger.error("Ошибка при обновлении агрегатов: %s", e, extra={'event': 'aggregates_failed'})
+
+        if processed:
+            logger.info("Агрегаты обновлены: %s сессий", processed)
+
+    async def _refresh_transcript_keywords(self, settled: str):
+        """Второй проход: ключевые слова транскрипций, заменивших заглушку уже после завершения сессии"""
+        sessions_url = (
+            f"{self.supabase_url}/rest/v1/listening_sessions"
+            f"?text_ingested_at=lt.{quote(settled, safe='')}"
+            f"&select=id,user_id,created_at,text_ingested_at,what_heard_text"
+        )
+        watermark = await self._get_watermark(self.TRANSCRIPTS_WATERMARK, key='text_ingested_at')
+        async for sessions in self._iter_keyset_pages(sessions_url, page_size=self.AGGREGATES_BATCH_SIZE,
+                                                      key='text_ingested_at', after=watermark):
+            periods = []
+            for session in sessions:
+                day = practice_day(session['created_at'])
+                periods.append((day.isoformat(), (day - timedelta(days=day.weekday())).isoformat()))
+
+            user_ids = {session['user_id'] for session in sessions}
+            daily = await self._load_aggregates('practice_daily_stats', 'day', user_ids, {d for d, _ in periods})
+            weekly = await self._load_aggregates('practice_weekly_stats', 'week_start', user_ids, {w for _, w in periods})
+
+            touched_daily, touched_weekly = {}, {}
+            for session, (day, week_start) in zip(sessions, periods):
+                keywords = self._extract_keywords(session.get('what_heard_text') or "", max_words=10)
+                daily_key = (session['user_id'], day)
+                daily_row = daily.setdefault(daily_key, empty_aggregate(session['user_id'], 'day', day))
+                if merge_transcript_into_aggregate(daily_row, session, keywords):
+                    touched_daily[daily_key] = daily_row
+                weekly_key = (session['user_id'], week_start)
+                weekly_row = weekly.setdefault(weekly_key, empty_aggregate(session['user_id'], 'week_start', week_start))
+                if merge_transcript_into_aggregate(weekly_row, session, keywords):
+                    touched_weekly[weekly_key] = weekly_row
+
+            now = datetime.now().isoformat()
+            await self._upsert_rows('practice_daily_stats', [{**row, 'updated_at': now} for row in touched_daily.values()])
+            await self._upsert_rows('practice_weekly_stats', [{**row, 'updated_at': now} for row in touched_weekly.values()])
+
+            last = sessions[-1]
+            await self._upsert_rows('aggregation_watermarks', [{
+                'name': self.TRANSCRIPTS_WATERMARK,
+                'last_completed_at': last['text_ingested_at'],
+                'last_ingested_at': last['text_ingested_at'],
+                'last_session_id': last['id'],
+                'updated_at': now
+            }])
+            logger.info("Ключевые слова поздних транскрипций добавлены в агрегаты: %s сессий", len(sessions),
+                        extra={'event': 'aggregates_transcripts'})
+
+    async def _get_watermark(self, name: str, key: str = 'completed_ingested_at') -> Optional[dict]:
+        """Последняя учтенная сессия в формате строки listening_sessions ({completed_at, <key>, id}).
+
+        key — столбец сессии, по которому идет водяной знак (хранится в last_ingested_at).
+        """
+        url = (
+            f"{self.supabase_url}/rest/v1/aggregation_watermarks"
+            f"?name=eq.{name}&select=last_completed_at,last_ingested_at,last_session_id"
+        )
+        resp = await self._supabase_request('GET', url)
+        if resp is None or resp.status_code != 200:
+            raise RuntimeError("Не удалось прочитать водяной знак агрегатов")
+        rows = resp.json() or []
+        if not rows or not rows[0].get('last_completed_at'):
+            return None
+        return {
+            'completed_at': rows[0]['last_completed_at'],
+            key: rows[0].get('last_ingested_at'),
+            'id': rows[0]['last_session_id'],
+        }
+
+    async def _merge_aggregates(self, sessions: list):
+        """Добавляем пачку сессий в агрегаты и сдвигаем водяной знак"""
+        periods = []
+        for session in sessions:
+            day = practice_day(session['created_at'])
+            week_start = day - timedelta(days=day.weekday())
+            periods.append((day.isoformat(), week_start.isoformat()))
+
+        user_ids = {session['user_id'] for session in sessions}
+        daily = await self._load_aggregates('practice_daily_stats', 'day', user_ids, {d for d, _ in periods})
+        weekly = await self._load_aggregates('practice_weekly_stats', 'week_start', user_ids, {w for _, w in periods})
+
+        touched_daily, touched_weekly = {}, {}
+        for session, (day, week_start) in zip(sessions, periods):
+            text = session.get('what_heard_text') or ""
+            # Заглушки вида "[Фото без подписи]" не считаем звуками. Текст, заменивший заглушку
+            # после завершения (text_ingested_at), учтет _refresh_transcript_keywords, даже если
+            # он уже успел прийти к этому проходу
+            if text.startswith("[") or session.get('text_ingested_at'):
+                keywords = []
+            else:
+                keywords = self._extract_keywords(text, max_words=10)
+
+            daily_key = (session['user_id'], day)
+            daily_row = daily.setdefault(daily_key, empty_aggregate(session['user_id'], 'day', day))
+            if merge_session_into_aggregate(daily_row, session, keywords):
+                touched_daily[daily_key] = daily_row
+
+            weekly_key = (session['user_id'], week_start)
+            weekly_row = weekly.setdefault(weekly_key, empty_aggregate(session['user_id'], 'week_start', week_start))
+            if merge_session_into_aggregate(weekly_row, session, keywords):
+                touched_weekly[weekly_key] = weekly_row
+
+        now = datetime.now().isoformat()
+        await self._upsert_rows('practice_daily_stats', [{**row, 'updated_at': now} for row in touched_daily.values()])
+        await self._upsert_rows('practice_weekly_stats', [{**row, 'updated_at': now} for row in touched_weekly.values()])
+
+        last = sessions[-1]
+        await self._upsert_rows('aggregation_watermarks', [{
+            'name': self.AGGREGATES_WATERMARK,
+            'last_completed_at': last['completed_at'],
+            'last_ingested_at': last['completed_ingested_at'],
+            'last_session_id': last['id'],
+            'updated_at': now
+        }])
+
+    async def _load_aggregates(self, table: str, period_column: str, user_ids: set, periods: set) -> dict:
+        """Существующие строки агрегатов для пачки одним запросом: {(user_id, period): row}"""
+        users = ",".join(str(uid) for uid in user_ids)
+        values = ",".join(sorted(periods))
+        url = f"{self.supabase_url}/rest/v1/{table}?user_id=in.({users})&{period_column}=in.({values})&select=*"
+        resp = await self._supabase_request('GET', url)
+        if resp is None or resp.status_code != 200:
+            raise RuntimeError(f"Не удалось прочитать {table}")
+
+        rows = {}
+        for row in resp.json() or []:
+            row.pop('updated_at', None)
+            rows[(row['user_id'], row[period_column])] = row
+        return rows
+
+    async def _upsert_rows(self, table: str, rows: list):
+        """Массовый upsert одним запросом (без локальной очереди — агрегаты пересчитаются в следующий запуск)"""
+        if not rows:
+            return
+        url = f"{self.supabase_url}/rest/v1/{table}"
+        headers = {**self.headers, 'Prefer': 'resolution=merge-duplicates'}
+        resp = await self._supabase_request('POST', url, headers, json.dumps(rows))
+        if resp is None or resp.status_code >= 400:
+            status = resp.status_code if resp is not None else 'нет ответа'
+            raise RuntimeError(f"Не удалось сохранить {table}: {status}")
+
+    # ===== Еженедельный дайджест =====
+    DIGEST_WATERMARK = 'weekly_digest'
+    DIGEST_PAGE_SIZE = 1000
+
+    async def send_weekly_digests(self, context: ContextTypes.DEFAULT_TYPE):
+        """Периодическая задача: в понедельник после digest_hour (UTC) рассылаем итоги прошлой недели.
+
+        Водяной знак отмечает уже разосланную неделю, поэтому после перезапуска
+        задача продолжит рассылку, а после завершения больше ничего не делает.
+        """
+        now = datetime.now(timezone.utc)
+        this_monday = now.date() - timedelta(days=now.weekday())
+        week_start = this_monday - timedelta(days=7)
+        if now.date() == this_monday and now.hour < self.digest_hour:
+            return
+
+        try:
+            done = await self._get_watermark(self.DIGEST_WATERMARK)
+            if done and parse_timestamp(done['completed_at']).date() >= week_start:
+                return
+            # Сначала досчитываем агрегаты по последним практикам недели
+            await self.refresh_aggregates(context)
+            await self.run_weekly_digest(week_start, context.bot)
+        except Exception as e:
+            logger.error("Ошибка еженедельного дайджеста: %s", e, extra={'event': 'weekly_digest_failed'})
+
+    async def run_weekly_digest(self, week_start, bot):
+        """Пакетный расчет и рассылка дайджеста за неделю, начинающуюся с week_start.
+
+        Данные читаются двумя keyset-обходами за одну неделю (дневные агрегаты и записи окружения),
+        без запросов по истории отдельных пользователей. Итоги считаются векторно в пуле процессов
+        (пользователи разбиты на шарды по user_id), доставка — через RateLimitedSender.
+        """
+        started = monotonic()
+        week_end = week_start + timedelta(days=7)
+
+        # 1. Дневные агрегаты недели всех пользователей
+        user_ids, day_offsets, seconds, sessions = [], [], [], []
+        kw_users, kw_words, kw_counts = [], [], []
+        vocabulary: dict = {}
+        daily_url = (
+            f"{self.supabase_url}/rest/v1/practice_daily_stats"
+            f"?day=gte.{week_start.isoformat()}&day=lt.{week_end.isoformat()}"
+            f"&select=user_id,day,sessions_count,listening_seconds,keyword_counts"
+        )
+        # Порядок строк не важен (итоги считаются по всей неделе): страницы по индексу (day, user_id)
+        async for page in self._iter_keyset_pages(daily_url, self.DIGEST_PAGE_SIZE, key='day', tiebreak='user_id'):
+            for row in page:
+                user_ids.append(row['user_id'])
+                day_offsets.append((datetime.fromisoformat(row['day']).date() - week_start).days)
+                seconds.append(row['listening_seconds'])
+                sessions.append(row['sessions_count'])
+                for word, word_count in (row.get('keyword_counts') or {}).items():
+                    kw_users.append(row['user_id'])
+                    kw_words.append(vocabulary.setdefault(word, len(vocabulary)))
+                    kw_counts.append(word_count)
+        if not user_ids:
+            await self._mark_digest_done(week_start)
+            return
+
+        # 2. Самая долгая запись окружения за неделю у каждого пользователя
+        highlights = {}
+        sessions_url = (
+            f"{self.supabase_url}/rest/v1/listening_sessions"
+            f"?completed_at=gte.{week_start.isoformat()}&completed_at=lt.{week_end.isoformat()}"
+            f"&environment_audio_file_id=not.is.null"
+            f"&select=id,user_id,completed_at,session_duration_seconds,environment_audio_file_id"
+        )
+        async for page in self._iter_keyset_pages(sessions_url, self.DIGEST_PAGE_SIZE, key='completed_at'):
+            for row in page:
+                duration = int(row.get('session_duration_seconds') or 0)
+                best = highlights.get(row['user_id'])
+                if best is None or duration > best[0]:
+                    highlights[row['user_id']] = (duration, row['environment_audio_file_id'])
+        loaded = monotonic()
+
+        # 3. Итоги по шардам пользователей в пуле процессов
+        if self._digest_pool is None:
+            self._digest_pool = ProcessPoolExecutor(
+                max_workers=self.digest_workers,
+                mp_context=multiprocessing.get_context('spawn')
+            )
+        user_array, kw_user_array = np.asarray(user_ids, dtype=np.int64), np.asarray(kw_users, dtype=np.int64)
+        day_array, seconds_array, sessions_array = np.asarray(day_offsets), np.asarray(seconds), np.asarray(sessions)
+        kw_word_array, kw_count_array = np.asarray(kw_words, dtype=np.int64), np.asarray(kw_counts, dtype=np.int64)
+        loop = asyncio.get_running_loop()
+        shards = []
+        for shard in range(self.digest_workers):
+            rows = user_array % self.digest_workers == shard
+            kw_rows = kw_user_array % self.digest_workers == shard
+            shards.append(loop.run_in_executor(
+                self._digest_pool, summarize_week,
+                user_array[rows], day_array[rows], seconds_array[rows], sessions_array[rows],
+                kw_user_array[kw_rows], kw_word_array[kw_rows], kw_count_array[kw_rows]
+            ))
+        summaries = await asyncio.gather(*shards)
+        words = list(vocabulary)
+        computed = monotonic()
+
+        # 4. Доставка страницами: уже получившие дайджест (после перезапуска) пропускаются
+        sender = RateLimitedSender(self.broadcast_rate, self.broadcast_concurrency)
+        total = sum(len(summary['users']) for summary in summaries)
+        for summary in summaries:
+            sounds: dict = {}
+            for uid, word in zip(summary['sound_users'].tolist(), summary['sound_words'].tolist()):
+                sounds.setdefault(uid, []).append(words[word])
+
+            users = summary['users'].tolist()
+            for offset in range(0, len(users), self.DIGEST_PAGE_SIZE):
+                page = range(offset, min(offset + self.DIGEST_PAGE_SIZE, len(users)))
+                delivered = await self._delivered_digests(week_start, [users[i] for i in page])
+                jobs = []
+                for i in page:
+                    uid = users[i]
+                    if uid in delivered or not summary['sessions'][i]:
+                        continue
+                    highlight = highlights.get(uid)
+                    text = format_weekly_digest(
+                        week_start, int(summary['sessions'][i]), int(summary['seconds'][i]),
+                        int(summary['active_days'][i]), int(summary['best_day'][i]),
+                        sounds.get(uid, []), highlight is not None
+                    )
+                    if highlight:
+                        jobs.append((uid, partial(bot.send_voice, chat_id=uid, voice=highlight[1], caption=text)))
+                    else:
+                        jobs.append((uid, partial(bot.send_message, chat_id=uid, text=text)))
+
+                # Статус доставки пишем пачками по мере отправки: после падения повторно уйдет не больше пачки
+                await sender.send_all(jobs, on_results=partial(self._record_digest_deliveries, week_start))
+
+        await self._mark_digest_done(week_start)
+        logger.info(
+            f"Дайджест за неделю {week_start}: {total} пользователей, доставлено {sender.sent}, "
+            f"не доставлено {sender.failed}; чтение {loaded - started:.1f} с, расчет {computed - loaded:.1f} с, "
+            f"отправка {monotonic() - computed:.1f} с ({sender.throughput:.1f} сообщений/с)"
+        )
+
+    async def _record_digest_deliveries(self, week_start, results: list):
+        await self._supabase_write('POST', f"{self.supabase_url}/rest/v1/weekly_digest_deliveries", [
+            {'user_id': uid, 'week_start': week_start.isoformat(), 'status': status, 'error': error}
+            for uid, status, error in results
+        ], prefer='resolution=merge-duplicates')
+
+    async def _delivered_digests(self, week_start, user_ids: list) -> set:
+        """Кому из страницы дайджест за эту неделю уже отправлялся (одним запросом)"""
+        if not user_ids:
+            return set()
+        url = (
+            f"{self.supabase_url}/rest/v1/weekly_digest_deliveries?week_start=eq.{week_start.isoformat()}"
+            f"&user_id=in.({','.join(map(str, user_ids))})&select=user_id"
+        )
+        response = await self._supabase_request('GET', url)
+        if response is None or response.status_code != 200:
+            raise RuntimeError("не удалось проверить уже отправленные дайджесты")
+        return {row['user_id'] for row in response.json() or []}
+
+    async def _mark_digest_done(self, week_start):
+        await self._upsert_rows('aggregation_watermarks', [{
+            'name': self.DIGEST_WATERMARK,
+            'last_completed_at': week_start.isoformat(),
+            'last_session_id': None,
+            'updated_at': datetime.now().isoformat()
+        }])
+
+    async def _load_daily_aggregates(self, user_id: int) -> Optional[list]:
+        """Дневные агрегаты пользователя за CHART_WINDOW_DAYS дней (не больше 91 строки)"""
+        since = (datetime.utcnow().date() - timedelta(days=CHART_WINDOW_DAYS - 1)).isoformat()
+        url = (
+            f"{self.supabase_url}/rest/v1/practice_daily_stats"
+            f"?user_id=eq.{user_id}&day=gte.{since}&order=day.asc"
+            f"&select=day,sessions_count,listening_seconds,text_answers,voice_answers,photo_answers,keyword_counts,updated_at"
+        )
+        try:
+            resp = await self._supabase_request('GET', url, fail_fast=True)
+            if resp is None or resp.status_code != 200:
+                return None
+            return resp.json() or []
+        except Exception as e:
+            logger.error("Ошибка при получении агрегатов: %s", e, extra={'event': 'aggregates_fetch_failed'})
+            return None
+
+    def get_practice_insights(self, daily_rows: list) -> dict:
+        """Сводка за 7 и 30 дней из дневных агрегатов (без чтения сырых сессий)"""
+        today = datetime.utcnow().date()
+        month_start = (today - timedelta(days=29)).isoformat()
+        week_start = (today - timedelta(days=6)).isoformat()
+        rows = [row for row in daily_rows if row['day'] >= month_start]
+
+        week_rows = [row for row in rows if row['day'] >= week_start]
+        answers = {column: sum(row[column] for row in rows) for column in self.ANSWER_TYPE_LABELS}
+        keyword_counts = {}
+        for row in rows:
+            for word, count in (row.get('keyword_counts') or {}).items():
+                keyword_counts[word] = keyword_counts.get(word, 0) + count
+
+        favorite = max(answers, key=answers.get) if any(answers.values()) else None
+        return {
+            'week_sessions': sum(row['sessions_count'] for row in week_rows),
+            'week_minutes': sum(row['listening_seconds'] for row in week_rows) // 60,
+            'month_sessions': sum(row['sessions_count'] for row in rows),
+            'month_minutes': sum(row['listening_seconds'] for row in rows) // 60,
+            'favorite_answer': self.ANSWER_TYPE_LABELS[favorite] if favorite else None,
+            'top_keywords': [w for w, _ in sorted(keyword_counts.items(), key=lambda kv: -kv[1])[:5]],
+        }
+
+    async def send_progress_chart(self, chat_id: int, user_id: int, daily_rows: Optional[list], context: ContextTypes.DEFAULT_TYPE):
+        """Отправляем график прогресса. Пока данные не менялись — повторно отправляем тот же file_id."""
+        if not daily_rows:
+            return
+
+        today = datetime.utcnow().date().isoformat()
+        version = f"{today}:{len(daily_rows)}:{max(row.get('updated_at') or '' for row in daily_rows)}"
+
+        cached = self.chart_cache.get(user_id)
+        if cached and cached[0] == version:
+            self.chart_cache.move_to_end(user_id)
+            try:
+                await context.bot.send_photo(chat_id=chat_id, photo=cached[1])
+                return
+            except Exception:
+                # file_id устарел — перерисуем
+                self.chart_cache.pop(user_id, None)
+
+        if self._chart_pool is None:
+            self._chart_pool = ProcessPoolExecutor(
+                max_workers=self.chart_workers,
+                mp_context=multiprocessing.get_context('spawn')
+            )
+
+        try:
+            image = await asyncio.get_running_loop().run_in_executor(
+                self._chart_pool,
+                render_progress_chart,
+                [row['day'] for row in daily_rows],
+                [row['listening_seconds'] for row in daily_rows],
+                [row['sessions_count'] for row in daily_rows],
+                today
+            )
+            message = await context.bot.send_photo(chat_id=chat_id, photo=image)
+        except Exception as e:
+            logger.error("Ошибка при отправке графика прогресса: %s", e, extra={'event': 'progress_chart_failed'})
+            return
+
+        self.chart_cache[user_id] = (version, message.photo[-1].file_id)
+        self.chart_cache.move_to_end(user_id)
+        while len(self.chart_cache) > self.chart_cache_size:
+            self.chart_cache.popitem(last=False)
+
+    # ===== Export (архив практик) =====
+    EXPORT_MAX_BYTES = 50 * 1024 * 1024  # лимит Bot API на отправку документов
+
+    async def export_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Обработчик команды /export [audio] — собираем архив практик в фоне"""
+        user_id = update.effective_user.id
+        include_audio = bool(context.args) and context.args[0].lower() in ('audio', 'аудио')
+
+        exports = context.bot_data.setdefault('exports_in_progress', set())
+        if user_id in exports:
+            await update.message.reply_text("📦 Архив уже готовится, подожди немного.")
+            return
+        exports.add(user_id)
+
+        await update.message.reply_text("📦 Готовлю архив твоих практик. Пришлю его, как только он будет готов.")
+        context.application.create_task(
+            self._export_worker(update.effective_chat.id, user_id, include_audio, context),
+            update=update
+        )
+
+    async def _export_worker(self, chat_id: int, user_id: int, include_audio: bool, context: ContextTypes.DEFAULT_TYPE):
+        """Фоновая сборка архива: строки пишутся в zip по мере чтения страниц."""
+        path = None
+        try:
+            fd, path = tempfile.mkstemp(prefix=f"export_{user_id}_", suffix=".zip")
+            os.close(fd)
+
+            sessions_url = f"{self.supabase_url}/rest/v1/listening_sessions?user_id=eq.{user_id}&select=*"
+            audio_url = (
+                f"{self.supabase_url}/rest/v1/audio_files"
+                f"?select=id,session_id,file_type,telegram_file_id,duration_seconds,created_at,listening_sessions!inner(user_id)"
+                f"&listening_sessions.user_id=eq.{user_id}"
+            )
+            photos_url = (
+                f"{self.supabase_url}/rest/v1/session_photos"
+                f"?select=id,session_id,telegram_file_id,file_size,position,created_at,listening_sessions!inner(user_id)"
+                f"&listening_sessions.user_id=eq.{user_id}"
+            )
+
+            with zipfile.ZipFile(path, 'w', compression=zipfile.ZIP_DEFLATED) as zf:
+                sessions_count = await self._write_jsonl_entry(zf, 'listening_sessions.jsonl', sessions_url)
+                audio_count = await self._write_jsonl_entry(zf, 'audio_files.jsonl', audio_url)
+                await self._write_jsonl_entry(zf, 'session_photos.jsonl', photos_url)
+                if include_audio:
+                    await self._write_audio_entries(zf, audio_url, context)
+
+            if os.path.getsize(path) > self.EXPORT_MAX_BYTES:
+                await context.bot.send_message(
+                    chat_id=chat_id,
+                    text="Архив получился больше 50 МБ — Telegram не позволяет его отправить. Попробуй /export без аудио."
+                )
+                return
+
+            with open(path, 'rb') as f:
+                await context.bot.send_document(
+                    chat_id=chat_id,
+                    document=f,
+                    filename=f"deep_listening_{datetime.now().strftime('%Y%m%d')}.zip",
+                    caption=f"📦 Твой архив: практик — {sessions_count}, аудио — {audio_count}"
+                )
+        except Exception as e:
+            logger.error("Ошибка при экспорте архива пользователя %s: %s", user_id, e, extra={'event': 'export_failed'})
+            try:
+                await context.bot.send_message(chat_id=chat_id, text="Не удалось собрать архив. Попробуйте позже.")
+            except Exception:
+                pass
+        finally:
+            context.bot_data.get('exports_in_progress', set()).discard(user_id)
+            if path and os.path.exists(path):
+                os.remove(path)
+
+    async def _write_jsonl_entry(self, zf: zipfile.ZipFile, name: str, url: str) -> int:
+        """Пишем строки таблицы в файл архива (JSON Lines), не держа их в памяти."""
+        count = 0
+        with zf.open(name, 'w', force_zip64=True) as entry:
+            async for row in self._iter_keyset(url):
+                row.pop('listening_sessions', None)
+                entry.write((json.dumps(row, ensure_ascii=False) + "\n").encode('utf-8'))
+                count += 1
+        return count
+
+    async def _write_audio_entries(self, zf: zipfile.ZipFile, audio_url: str, context: ContextTypes.DEFAULT_TYPE):
+        """Скачиваем голосовые файлы из Telegram прямо в архив (без повторного сжатия)."""
+        async for row in self._iter_keyset(audio_url):
+            file_id = row.get('telegram_file_id')
+            if not file_id:
+                continue
+            try:
+                tg_file = await context.bot.get_file(file_id)
+                ext = os.path.splitext(tg_file.file_path or '')[1] or '.ogg'
+                info = zipfile.ZipInfo(f"audio/{row['session_id']}_{row['file_type']}{ext}", date_time=datetime.now().timetuple()[:6])
+                info.compress_type = zipfile.ZIP_STORED
+                with zf.open(info, 'w', force_zip64=True) as entry:
+                    await tg_file.download_to_memory(out=entry)
+            except Exception as e:
+                logger.warning("Не удалось добавить аудио %s в архив: %s", file_id, e, extra={'event': 'export_audio_failed'})
+
+    # ===== Рассылки =====
+    async def broadcast_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """/broadcast <текст> — черновик рассылки всем пользователям (только для администраторов)"""
+        user_id = update.effective_user.id
+        if user_id not in self.admin_ids:
+            await update.message.reply_text("Команда доступна только администраторам.")
+            return
         
-        keyboard = InlineKeyboardMarkup([
-            [InlineKeyboardButton("🎧 Что ты слышишь теперь?", callback_data="start_practice")],
-            [InlineKeyboardButton("📊 Моя статистика", callback_data="show_stats")],
-            [InlineKeyboardButton("ℹ️ Как это работает", callback_data="how_it_works")],
-            [InlineKeyboardButton("📚 Мои записи", callback_data="open_library")]
-        ])
+        text = update.message.text.partition(' ')[2].strip()
+        if not text:
+            await update.message.reply_text("Использование: /broadcast <текст сообщения>")
+            return
         
-        await query.edit_message_text(text, reply_markup=keyboard)
+        broadcast_id = str(uuid.uuid4())
+        broadcast_data = {'id': broadcast_id, 'text': text, 'created_by': user_id, 'status': 'draft'}
+        
+        try:
+            response = await self._supabase_write('POST', f"{self.supabase_url}/rest/v1/broadcasts", broadcast_data)
+            if response.status_code not in [201, 202]:
+                logger.error("Ошибка создания рассылки: %s - %s", response.status_code, response.text, extra={'event': 'broadcast_create_failed'})
+                await update.message.reply_text("Не удалось создать рассылку. Попробуйте еще раз.")
+                return
+        except Exception as e:
+            logger.error("Ошибка при создании рассылки: %s", e, extra={'event': 'broadcast_create_failed'})
+            await update.message.reply_text("Не удалось создать рассылку. Попробуйте еще раз.")
+            return
+        
+        keyboard = InlineKeyboardMarkup([[
+            InlineKeyboardButton("✅ Отправить всем", callback_data=f"bc:send:{broadcast_id}"),
+            InlineKeyboardButton("✖️ Отмена", callback_data=f"bc:cancel:{broadcast_id}")
+        ]])
+        await update.message.reply_text(f"📣 Предпросмотр рассылки:\n\n{text}", reply_markup=keyboard)
+    
+    async def broadcast_send_from_callback(self, query, context):
+        """Подтверждение рассылки: запускаем ее в фоне"""
+        if query.from_user.id not in self.admin_ids:
+            return
+        broadcast_id = query.data.split(":", 2)[2]
+        
+        # Черновик переводим в running условным PATCH — повторное нажатие ничего не запустит
+        api_url = f"{self.supabase_url}/rest/v1/broadcasts?id=eq.{broadcast_id}&status=eq.draft"
+        body = json.dumps({'status': 'running', 'started_at': datetime.now(timezone.utc).isoformat()})
+        response = await self._supabase_request('PATCH', api_url, {**self.headers, 'Prefer': 'return=representation'}, body)
+        rows = response.json() if response is not None and response.status_code == 200 else []
+        if not rows:
+            await query.edit_message_text("Рассылка уже запущена, отменена или Supabase недоступен.")
+            return
+        
+        await query.edit_message_text(f"{query.message.text}\n\n🚀 Рассылка запущена")
+        context.application.create_task(self.run_broadcast(rows[0], context.bot))
+    
+    async def broadcast_cancel_from_callback(self, query, context):
+        """Отмена черновика рассылки"""
+        if query.from_user.id not in self.admin_ids:
+            return
+        broadcast_id = query.data.split(":", 2)[2]
+        api_url = f"{self.supabase_url}/rest/v1/broadcasts?id=eq.{broadcast_id}&status=eq.draft"
+        await self._supabase_write('PATCH', api_url, {'status': 'cancelled'})
+        await query.edit_message_text("✖️ Рассылка отменена")
+    
+    async def resume_broadcasts(self, application: Application):
+        """Продолжаем рассылки, прерванные падением или перезапуском бота"""
+        response = await self._supabase_request('GET', f"{self.supabase_url}/rest/v1/broadcasts?status=eq.running&select=*")
+        if response is None or response.status_code != 200:
+            return
+        for broadcast in response.json() or []:
+            logger.info("Продолжаем рассылку %s после пользователя %s", broadcast['id'], broadcast.get('last_user_id'))
+            application.create_task(self.run_broadcast(broadcast, application.bot))
+    
+    async def run_broadcast(self, broadcast: dict, bot, attempt: int = 0, report_message_id: Optional[int] = None):
+        """Рассылка всем пользователям: получатели страницами по telegram_user_id (keyset),
+        отправка через RateLimitedSender, статус доставки каждому получателю — небольшими
+        пачками по мере отправки, контрольная точка (последний обработанный пользователь) —
+        после каждой страницы. При ошибке повтор с контрольной точки через job_queue.
 
+        attempt — сколько раз подряд рассылка прерывалась без продвижения (для паузы перед повтором).
+        """
+        broadcast_id = broadcast['id']
+        sender = RateLimitedSender(self.broadcast_rate, self.broadcast_concurrency)
+        sent_total = broadcast.get('sent_count') or 0
+        failed_total = broadcast.get('failed_count') or 0
+        last_user_id = broadcast.get('last_user_id')
+        after = {'telegram_user_id': last_user_id} if last_user_id is not None else None
+        
+        report_chat_id = broadcast.get('created_by')
+        if report_message_id is None:
+            report_message_id = await self._broadcast_report(bot, report_chat_id, None, "📣 Рассылка: начинаем отправку...")
+        
+        users_url = f"{self.supabase_url}/rest/v1/listening_users?select=telegram_user_id"
+        deliveries_url = f"{self.supabase_url}/rest/v1/broadcast_deliveries"
+        broadcast_url = f"{self.supabase_url}/rest/v1/broadcasts?id=eq.{broadcast_id}"
+        first_page = True
+        
+        try:
+            async for page in self._iter_keyset_pages(users_url, self.broadcast_page_size,
+                                                      key='telegram_user_id', after=after, tiebreak=None):
+                user_ids = [row['telegram_user_id'] for row in page]
+                if first_page:
+                    # Страницу после контрольной точки могли частично разослать до падения
+                    delivered = await self._delivered_recipients(broadcast_id, user_ids)
+                    user_ids = [uid for uid in user_ids if uid not in delivered]
+                    first_page = False
+                
+                async def record_deliveries(chunk: list):
+                    deliveries = [
+                        {'broadcast_id': broadcast_id, 'telegram_user_id': uid, 'status': status, 'error': error}
+                        for uid, status, error in chunk
+                    ]
+                    await self._supabase_write('POST', deliveries_url, deliveries, prefer='resolution=merge-duplicates')
+                
+                # Статус доставки пишем небольшими пачками по мере отправки, а не после всей страницы
+                results = await sender.send_all([
+                    (uid, partial(bot.send_message, chat_id=uid, text=broadcast['text'])) for uid in user_ids
+                ], on_results=record_deliveries)
+                sent = sum(1 for _, status, _ in results if status == 'sent')
+                sent_total += sent
+                failed_total += len(results) - sent
+                last_user_id = page[-1]['telegram_user_id']
+                attempt = 0
+                
+                await self._supabase_write('PATCH', broadcast_url, {
+                    'last_user_id': last_user_id,
+                    'sent_count': sent_total,
+                    'failed_count': failed_total
+                })
+                report_message_id = await self._broadcast_report(
+                    bot, report_chat_id, report_message_id,
+                    f"📣 Рассылка идет...\n\n"
+                    f"✅ Доставлено: {sent_total}\n"
+                    f"⚠️ Не доставлено: {failed_total}\n"
+                    f"⚡ {sender.throughput:.1f} сообщений/с"
+                )
+        except Exception as e:
+            attempt += 1
+            delay = min(self.broadcast_retry_max_delay, self.broadcast_retry_delay * 2 ** (attempt - 1))
+            logger.error("Рассылка %s прервана (попытка %s), повтор через %.0f с: %s",
+                         broadcast_id, attempt, delay, e, extra={'event': 'broadcast_interrupted'})
+            checkpoint = {**broadcast, 'last_user_id': last_user_id, 'sent_count': sent_total, 'failed_count': failed_total}
+            self.application.job_queue.run_once(
+                self._retry_broadcast,
+                when=delay,
+                data={'broadcast': checkpoint, 'attempt': attempt, 'report_message_id': report_message_id},
+                name=f"broadcast_{broadcast_id}"
+            )
+            await self._broadcast_report(
+                bot, report_chat_id, report_message_id,
+                f"⚠️ Рассылка прервана: {e}\nПродолжу с контрольной точки через {delay:.0f} с."
+            )
+            return
+        
+        await self._supabase_write('PATCH', broadcast_url, {
+            'status': 'completed',
+            'finished_at': datetime.now(timezone.utc).isoformat()
+        })
+        elapsed = monotonic() - sender.started
+        logger.info("Рассылка %s завершена: доставлено %s, не доставлено %s, %.1f сообщений/с",
+                    broadcast_id, sent_total, failed_total, sender.throughput)
+        await self._broadcast_report(
+            bot, report_chat_id, report_message_id,
+            f"🎉 Рассылка завершена!\n\n"
+            f"✅ Доставлено: {sent_total}\n"
+            f"⚠️ Не доставлено: {failed_total}\n"
+            f"⏱ {elapsed / 60:.1f} мин, ⚡ {sender.throughput:.1f} сообщений/с"
+        )
+    
+    async def _retry_broadcast(self, context: ContextTypes.DEFAULT_TYPE):
+        """Повтор прерванной рассылки с контрольной точки (отдельной задачей, как при старте бота)"""
+        data = context.job.data
+        context.application.create_task(
+            self.run_broadcast(data['broadcast'], context.bot, data['attempt'], data['report_message_id'])
+        )
+    
+    async def _delivered_recipients(self, broadcast_id: str, user_ids: list) -> set:
+        """Кому из страницы эта рассылка уже доставлялась (одним запросом)"""
+        if not user_ids:
+            return set()
+        url = (
+            f"{self.supabase_url}/rest/v1/broadcast_deliveries?broadcast_id=eq.{broadcast_id}"
+            f"&telegram_user_id=in.({','.join(map(str, user_ids))})&select=telegram_user_id"
+        )
+        response = await self._supabase_request('GET', url)
+        if response is None or response.status_code != 200:
+            # Без этой проверки можно отправить сообщение повторно — лучше остановиться
+            raise RuntimeError("не удалось проверить уже доставленные сообщения")
+        return {row['telegram_user_id'] for row in response.json() or []}
+    
+    async def _broadcast_report(self, bot, chat_id: Optional[int], message_id: Optional[int], text: str) -> Optional[int]:
+        """Отчет администратору: первое сообщение отправляем, дальше редактируем его"""
+        if not chat_id:
+            return None
+        try:
+            if message_id:
+                await bot.edit_message_text(chat_id=chat_id, message_id=message_id, text=text)
+                return message_id
+            message = await bot.send_message(chat_id=chat_id, text=text)
+            return message.message_id
+        except Exception as e:
+            logger.warning("Не удалось обновить отчет о рассылке: %s", e, extra={'event': 'broadcast_report_failed'})
+            return message_id
+    
     # ===== Library (список записей) =====
     async def show_library(self, update: Update, context: ContextTypes.DEFAULT_TYPE, page: int = 1):
         """Показываем список записей пользователя."""
         user_id = update.effective_user.id
         await self._render_library(chat_id=update.effective_chat.id, user_id=user_id, page=page, edit_message_id=None, context=context)
 
+    async def open_library_from_callback(self, query, context):
+        """Первая страница библиотеки вместо сообщения с кнопкой"""
+        await self._render_library(
+            chat_id=query.message.chat_id,
+            user_id=query.from_user.id,
+            page=1,
+            edit_message_id=query.message.message_id,
+            context=context,
+        )
+    
     async def show_library_from_callback(self, query, context):
         """Показываем библиотеку из callback с пагинацией."""
         user_id = query.from_user.id
@@ -675,8 +3337,8 @@ class SimpleListeningBot:
             f"&order=created_at.desc&limit={PAGE_SIZE}&offset={offset}"
         )
         try:
-            resp = requests.get(sessions_url, headers=self.headers)
-            if resp.status_code != 200:
+            resp = await self._supabase_request('GET', sessions_url, fail_fast=True)
+            if resp is None or resp.status_code != 200:
                 text = "Не удалось получить список записей. Попробуйте позже."
                 if edit_message_id:
                     await context.bot.edit_message_text(chat_id=chat_id, message_id=edit_message_id, text=text)
@@ -701,6 +3363,9 @@ class SimpleListeningBot:
             context.bot_data['lib_tokens'] = {}
         lib_tokens = context.bot_data['lib_tokens']
 
+        # file_id всех записей страницы — из кэша, недостающие одним запросом
+        file_ids = await self._get_environment_file_ids([s.get("id") for s in sessions])
+
         rows = []
         for s in sessions:
             created_at = s.get("created_at")
@@ -709,7 +3374,7 @@ class SimpleListeningBot:
             keywords = self._extract_keywords(text_answer)
 
             # Берем ТОЛЬКО звук окружения (environment)
-            file_id = await self._get_session_audio_file_id(s.get("id"), preferred_type="environment")
+            file_id = file_ids.get(s.get("id"))
 
             # Форматируем дату и длительность
             try:
@@ -729,10 +3394,12 @@ class SimpleListeningBot:
 
             if file_id:
                 # Генерируем короткий токен вместо длинного file_id (ограничение 64 байта)
-                import uuid
                 token = uuid.uuid4().hex[:32]
-                lib_tokens[token] = {"file_id": file_id, "user_id": user_id}
-                rows.append([InlineKeyboardButton(f"▶️ {label}", callback_data=f"lib:play:{token}")])
+                lib_tokens[token] = {"file_id": file_id, "user_id": user_id, "session_id": s.get("id")}
+                row = [InlineKeyboardButton(f"▶️ {label}", callback_data=f"lib:play:{token}")]
+                if self.audio_index is not None and self.audio_index.contains(user_id, s.get("id")):
+                    row.append(InlineKeyboardButton("🔊≈", callback_data=f"lib:similar:{token}"))
+                rows.append(row)
             else:
                 rows.append([InlineKeyboardButton(f"📝 {label}", callback_data=f"lib:page:{page}")])
 
@@ -786,21 +3453,79 @@ class SimpleListeningBot:
         except Exception:
             await context.bot.send_message(chat_id=query.message.chat_id, text="Не удалось воспроизвести аудио")
 
-    async def _get_session_audio_file_id(self, session_id: str, preferred_type: str) -> Optional[str]:
-        """Возвращает telegram_file_id из audio_files для указанной сессии и типа файла."""
-        url = (
-            f"{self.supabase_url}/rest/v1/audio_files"
-            f"?session_id=eq.{session_id}&file_type=eq.{preferred_type}&select=telegram_file_id&limit=1"
+    async def library_similar(self, query, context):
+        """Показываем прошлые записи, которые звучали похоже на выбранную."""
+        token = query.data.split(":")[2] if query.data.count(":") >= 2 else None
+        meta = context.bot_data.get('lib_tokens', {}).get(token)
+        if not isinstance(meta, dict) or not meta.get('session_id') or self.audio_index is None:
+            await context.bot.send_message(chat_id=query.message.chat_id, text="Ссылка устарела. Обновите список /library")
+            return
+
+        similar = self.audio_index.similar_sessions(meta['user_id'], meta['session_id'], k=5)
+        lib_tokens = context.bot_data['lib_tokens']
+        file_ids = await self._get_environment_file_ids([session_id for session_id, _ in similar])
+        rows = []
+        for session_id, score in similar:
+            file_id = file_ids.get(session_id)
+            if not file_id:
+                continue
+            new_token = uuid.uuid4().hex[:32]
+            lib_tokens[new_token] = {"file_id": file_id, "user_id": meta['user_id'], "session_id": session_id}
+            rows.append([InlineKeyboardButton(f"▶️ Похоже на {max(score, 0):.0%}", callback_data=f"lib:play:{new_token}")])
+
+        if not rows:
+            await context.bot.send_message(chat_id=query.message.chat_id, text="Пока не нашлось похожих записей")
+            return
+        await context.bot.send_message(
+            chat_id=query.message.chat_id,
+            text="🔊 Практики, которые звучали похоже:",
+            reply_markup=InlineKeyboardMarkup(rows)
         )
+
+    async def _index_environment_audio(self, session_id: str, user_id: int, file_id: str):
+        """Скачиваем запись окружения, считаем эмбеддинг в отдельном процессе и дописываем в индекс"""
+        if self._embedding_pool is None:
+            self._embedding_pool = ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn'))
         try:
-            r = requests.get(url, headers=self.headers)
-            if r.status_code == 200:
-                arr = r.json() or []
-                if arr:
-                    return arr[0].get("telegram_file_id")
-        except Exception:
-            pass
-        return None
+            audio, _ = await asyncio.to_thread(download_telegram_file, self.bot_token, file_id)
+            vector = await asyncio.get_running_loop().run_in_executor(self._embedding_pool, compute_audio_embedding, audio)
+            if not self.audio_index.contains(user_id, session_id):
+                self.audio_index.add(session_id, user_id, vector)
+        except Exception as e:
+            logger.warning("Не удалось добавить запись %s в индекс похожих: %s", session_id, e, extra={'event': 'similar_index_add_failed'})
+
+    async def _get_environment_file_ids(self, session_ids: list) -> dict:
+        """file_id записей окружения для пачки сессий: сначала кэш, недостающие — одним запросом session_id=in.(...)"""
+        cache = self.environment_file_ids
+        file_ids = {}
+        missing = []
+        for session_id in dict.fromkeys(filter(None, session_ids)):
+            file_id = cache.get(session_id)
+            if file_id is FileIdCache.MISSING:
+                missing.append(session_id)
+            elif file_id:
+                file_ids[session_id] = file_id
+
+        if missing:
+            url = (
+                f"{self.supabase_url}/rest/v1/audio_files"
+                f"?session_id=in.({','.join(missing)})&file_type=eq.environment&select=session_id,telegram_file_id"
+            )
+            try:
+                r = await self._supabase_request('GET', url, fail_fast=True)
+                if r is not None and r.status_code == 200:
+                    found = {row['session_id']: row.get('telegram_file_id') for row in r.json() or []}
+                    # Отсутствие аудио кэшируем только при успешном ответе базы
+                    for session_id in missing:
+                        cache.put(session_id, found.get(session_id))
+                    file_ids.update((sid, fid) for sid, fid in found.items() if fid)
+            except Exception as e:
+                logger.warning("Не удалось получить file_id записей окружения: %s", e, extra={'event': 'environment_file_ids_failed'})
+
+        logger.info("Кэш file_id: %.0f%% попаданий (%s из %s)", cache.hit_rate * 100, cache.hits, cache.hits + cache.misses,
+                    extra={'event': 'file_id_cache', 'hits': cache.hits, 'misses': cache.misses,
+                           'hit_rate': round(cache.hit_rate, 3), 'size': len(cache.entries)})
+        return file_ids
 
     def _extract_keywords(self, text: str, max_words: int = 5) -> list[str]:
         """Очень простое извлечение ключевых слов из текста."""
@@ -854,38 +3579,43 @@ class SimpleListeningBot:
         await query.edit_message_text(text, reply_markup=keyboard)
     
     async def get_user_stats(self, user_id: int) -> dict:
-        """Получаем статистику пользователя"""
-        api_url = f"{self.supabase_url}/rest/v1/listening_sessions?user_id=eq.{user_id}&select=*"
+        """Общие счетчики пользователя без чтения всей истории.
+
+        Всего практик и дата последней — один запрос limit=1 с Prefer: count=exact
+        (счет по индексу user_id, created_at), завершенные — сумма недельных агрегатов.
+        """
+        stats = {'total_sessions': 0, 'completed_sessions': 0, 'last_session_date': None}
+        latest_url = (
+            f"{self.supabase_url}/rest/v1/listening_sessions"
+            f"?user_id=eq.{user_id}&select=session_date&order=created_at.desc,id.desc&limit=1"
+        )
+        weekly_url = f"{self.supabase_url}/rest/v1/practice_weekly_stats?user_id=eq.{user_id}&select=sessions_count"
         
         try:
-            response = requests.get(api_url, headers=self.headers)
-            if response.status_code == 200:
-                sessions = response.json()
-                
-                total_sessions = len(sessions)
-                completed_sessions = len([s for s in sessions if s['status'] == 'completed'])
-                
-                last_session_date = None
-                if sessions:
-                    # Сортируем по дате и берем последнюю
-                    sessions.sort(key=lambda x: x['created_at'], reverse=True)
-                    last_session_date = sessions[0]['session_date']
-                
-                return {
-                    'total_sessions': total_sessions,
-                    'completed_sessions': completed_sessions,
-                    'last_session_date': last_session_date
-                }
+            latest, weekly = await asyncio.gather(
+                self._supabase_request('GET', latest_url, {**self.headers, 'Prefer': 'count=exact'}, fail_fast=True),
+                self._supabase_request('GET', weekly_url, fail_fast=True)
+            )
+            if latest is None or weekly is None:
+                logger.warning("Supabase недоступен — статистика временно недоступна")
+                return stats
+            if latest.status_code in [200, 206]:
+                # Content-Range: 0-0/57 (или */0, если практик нет)
+                total = latest.headers.get('Content-Range', '*/0').rsplit('/', 1)[-1]
+                stats['total_sessions'] = int(total) if total.isdigit() else 0
+                rows = latest.json() or []
+                if rows:
+                    stats['last_session_date'] = rows[0].get('session_date')
+            else:
+                logger.error("Ошибка получения статистики: %s", latest.status_code, extra={'event': 'user_stats_failed'})
+            if weekly.status_code == 200:
+                stats['completed_sessions'] = sum(row['sessions_count'] for row in weekly.json() or [])
             else:
-                logger.error(f"Ошибка получения статистики: {response.status_code}")
+                logger.error("Ошибка получения недельных агрегатов: %s", weekly.status_code, extra={'event': 'user_stats_failed'})
         except Exception as e:
-            logger.error(f"Ошибка при получении статистики: {e}")
+            logger.error("Ошибка при получении статистики: %s", e, extra={'event': 'user_stats_failed'})
         
-        return {
-            'total_sessions': 0,
-            'completed_sessions': 0,
-            'last_session_date': None
-        }
+        return stats
     
     async def prompt_environment_recording(self, query, context):
         """Предлагаем записать аудио окружения"""
@@ -897,24 +3627,15 @@ class SimpleListeningBot:
 Это поможет вам позже вспомнить атмосферу момента!
         """
         
+        # Голосовое, пока практика в состоянии LISTENING, и так сохраняется как запись окружения
         await query.answer()
         await context.bot.send_message(
             chat_id=query.message.chat_id,
             text=text
         )
-        
-        # Отмечаем, что ждем аудио окружения
-        if 'user_sessions' not in context.bot_data:
-            context.bot_data['user_sessions'] = {}
-        
-        user_id = query.from_user.id
-        if user_id not in context.bot_data['user_sessions']:
-            context.bot_data['user_sessions'][user_id] = {}
-        
-        context.bot_data['user_sessions'][user_id]['waiting_for_environment_audio'] = True
-        context.bot_data['user_sessions'][user_id]['session_id'] = context.user_data.get('current_session')
     
-    async def save_environment_audio(self, session_id: str, file_id: str, duration: int = None, message_id: int = None):
+    async def save_environment_audio(self, session_id: str, file_id: str, duration: int = None, message_id: int = None,
+                                     user_id: int = None):
         """Сохраняем аудио окружения"""
         update_data = {
             'environment_audio_file_id': file_id
@@ -929,16 +3650,21 @@ class SimpleListeningBot:
         api_url = f"{self.supabase_url}/rest/v1/listening_sessions?id=eq.{session_id}"
         
         try:
-            response = requests.patch(api_url, headers=self.headers, data=json.dumps(update_data))
-            if response.status_code == 204:
-                logger.info(f"Аудио окружения сохранено для сессии {session_id}")
+            response = await self._supabase_write('PATCH', api_url, update_data)
+            if response.status_code in [202, 204]:
+                logger.info("Аудио окружения сохранено для сессии %s", session_id, extra={'event': 'environment_audio_saved', 'session_id': session_id})
                 
                 # Также сохраняем в таблицу audio_files
                 await self.save_audio_metadata(session_id, file_id, 'environment', duration)
+                self.environment_file_ids.put(session_id, file_id)
+
+                # Считаем акустический отпечаток в фоне для поиска похожих записей
+                if user_id is not None and self.audio_index is not None:
+                    self.application.create_task(self._index_environment_audio(session_id, user_id, file_id))
             else:
-                logger.error(f"Ошибка сохранения аудио окружения: {response.status_code}")
+                logger.error("Ошибка сохранения аудио окружения: %s", response.status_code, extra={'event': 'environment_audio_failed'})
         except Exception as e:
-            logger.error(f"Ошибка при сохранении аудио окружения: {e}")
+            logger.error("Ошибка при сохранении аудио окружения: %s", e, extra={'event': 'environment_audio_failed'})
     
     async def save_audio_metadata(self, session_id: str, file_id: str, file_type: str, duration: int = None):
         """Сохраняем метаданные аудиофайла"""
@@ -953,50 +3679,87 @@ class SimpleListeningBot:
         api_url = f"{self.supabase_url}/rest/v1/audio_files"
         
         try:
-            response = requests.post(api_url, headers=self.headers, data=json.dumps(audio_data))
-            if response.status_code in [200, 201]:
-                logger.info(f"Метаданные аудио сохранены: {file_type} для сессии {session_id}")
+            response = await self._supabase_write('POST', api_url, audio_data)
+            if response.status_code in [200, 201, 202]:
+                logger.info("Метаданные аудио сохранены: %s для сессии %s", file_type, session_id,
+                            extra={'event': 'audio_metadata_saved', 'session_id': session_id, 'file_type': file_type})
             else:
-                logger.error(f"Ошибка сохранения метаданных аудио: {response.status_code}")
+                logger.error("Ошибка сохранения метаданных аудио: %s", response.status_code, extra={'event': 'audio_metadata_failed'})
         except Exception as e:
-            logger.error(f"Ошибка при сохранении метаданных аудио: {e}")
+            logger.error("Ошибка при сохранении метаданных аудио: %s", e, extra={'event': 'audio_metadata_failed'})
     
+    async def save_transcription(self, session_id: str, transcription: str):
+        """Дописываем текст транскрипции в уже завершенную сессию (статус и время завершения не трогаем)"""
+        api_url = f"{self.supabase_url}/rest/v1/listening_sessions?id=eq.{session_id}"
+        try:
+            response = await self._supabase_write('PATCH', api_url, {'what_heard_text': transcription})
+            if response.status_code in [202, 204]:
+                logger.info("Текст транскрипции сохранен для сессии %s", session_id, extra={'event': 'transcription_saved', 'session_id': session_id})
+            else:
+                logger.error("Ошибка сохранения транскрипции: %s", response.status_code, extra={'event': 'transcription_save_failed'})
+        except Exception as e:
+            logger.error("Ошибка при сохранении транскрипции: %s", e, extra={'event': 'transcription_save_failed'})
+
     async def transcribe_audio(self, file_id: str) -> str:
-        """Транскрибируем аудио через OpenAI Whisper. Возвращаем текст или заглушку."""
-        if not self.openai_client:
-            logger.warning("OPENAI_API_KEY не задан — возвращаю заглушку транскрипции")
-            return "[Голосовое сообщение — транскрипция недоступна]"
+        """Транскрибируем аудио выбранным движком (OpenAI Whisper или локальным). Возвращаем текст или заглушку."""
+        if not self.transcriber:
+            logger.warning("Движок транскрипции не настроен — возвращаю заглушку транскрипции", extra={'event': 'transcription_unavailable'})
+            return TRANSCRIPTION_UNAVAILABLE
+
+        # Ограничиваем число одновременных распознаваний возможностями движка
+        if self._transcription_semaphore is None:
+            self._transcription_semaphore = asyncio.Semaphore(self.transcriber.max_concurrency)
 
         try:
-            # 1) Получаем путь к файлу в Telegram
-            get_file_url = f"https://api.telegram.org/bot{self.bot_token}/getFile"
-            r = requests.get(get_file_url, params={"file_id": file_id}, timeout=30)
-            r.raise_for_status()
-            file_path = r.json()["result"]["file_path"]
-
-            # 2) Скачиваем файл
-            file_url = f"https://api.telegram.org/file/bot{self.bot_token}/{file_path}"
-            audio_resp = requests.get(file_url, timeout=60)
-            audio_resp.raise_for_status()
-
-            audio_bytes = io.BytesIO(audio_resp.content)
-            audio_bytes.name = os.path.basename(file_path) or "voice.ogg"
-
-            # 3) Отправляем в OpenAI Whisper
-            res = self.openai_client.audio.transcriptions.create(
-                model="whisper-1",
-                file=audio_bytes,
-                response_format="text"
-            )
+            # 1) Скачиваем файл из Telegram
+            audio, filename = await asyncio.to_thread(download_telegram_file, self.bot_token, file_id)
 
-            text = res if isinstance(res, str) else getattr(res, "text", "").strip()
+            # 2) Отправляем в движок распознавания
+            async with self._transcription_semaphore:
+                text = await asyncio.to_thread(self.transcriber.transcribe, audio, filename)
             if not text:
-                text = "[распознавание завершилось без текста]"
+                text = TRANSCRIPTION_EMPTY
 
             return text
         except Exception as e:
-            logger.error(f"Ошибка транскрипции через OpenAI: {e}")
-            return "[Не удалось распознать аудио]"
+            logger.error("Ошибка транскрипции (%s): %s", self.transcriber.name, e, extra={'event': 'transcription_failed'})
+            return TRANSCRIPTION_FAILED
+
+    async def transcribe_audio_chunked(self, file_id: str, progress=None) -> str:
+        """Длинная запись: режем на куски и распознаем их параллельно, текст склеиваем в исходном порядке.
+
+        Каждый кусок отдельно занимает общий семафор движка, поэтому короткие ответы
+        других пользователей встают между кусками, а не ждут всю длинную запись.
+        Одна запись занимает не больше voice_chunk_parallelism мест сразу.
+        progress — необязательный async progress(done, total) после каждого куска.
+        """
+        if not self.transcriber:
+            logger.warning("Движок транскрипции не настроен — возвращаю заглушку транскрипции", extra={'event': 'transcription_unavailable'})
+            return TRANSCRIPTION_UNAVAILABLE
+
+        if self._transcription_semaphore is None:
+            self._transcription_semaphore = asyncio.Semaphore(self.transcriber.max_concurrency)
+        note_semaphore = asyncio.Semaphore(self.voice_chunk_parallelism)
+
+        try:
+            audio, _ = await asyncio.to_thread(download_telegram_file, self.bot_token, file_id)
+            chunks = await asyncio.to_thread(split_audio_chunks, audio, self.voice_chunk_seconds)
+            done = 0
+
+            async def transcribe_chunk(index: int, chunk: bytes) -> str:
+                nonlocal done
+                async with note_semaphore, self._transcription_semaphore:
+                    text = await asyncio.to_thread(self.transcriber.transcribe, chunk, f"chunk_{index:03d}.wav")
+                done += 1
+                if progress:
+                    await progress(done, len(chunks))
+                return (text or "").strip()
+
+            texts = await asyncio.gather(*(transcribe_chunk(i, chunk) for i, chunk in enumerate(chunks)))
+            return " ".join(text for text in texts if text) or TRANSCRIPTION_EMPTY
+        except Exception as e:
+            logger.error("Ошибка транскрипции по частям (%s): %s", self.transcriber.name, e, extra={'event': 'chunked_transcription_failed'})
+            return TRANSCRIPTION_FAILED
 
     def run(self):
         """Запускаем бота"""
@@ -1012,13 +3775,14 @@ class SimpleListeningBot:
 
 def main():
     """Главная функция"""
+    configure_logging()
     try:
         bot = SimpleListeningBot()
         bot.run()
     except KeyboardInterrupt:
         logger.info("Бот остановлен пользователем")
     except Exception as e:
-        logger.error(f"Критическая ошибка: {e}")
+        logger.error("Критическая ошибка: %s", e, extra={'event': 'fatal_error'})
 
 if __name__ == '__main__':
     main()
\ No newline at end of file
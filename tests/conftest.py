@@ -0,0 +1,31 @@
+import os
+import sys
+
+import pytest
+
+# Подключаем модуль бота из корня репозитория
+CURRENT_DIR = os.path.dirname(os.path.abspath(__file__))
+PARENT_DIR = os.path.dirname(CURRENT_DIR)
+if PARENT_DIR not in sys.path:
+    sys.path.insert(0, PARENT_DIR)
+
+
+@pytest.fixture
+def bot_env(tmp_path, monkeypatch):
+    """Окружение бота без сети и без общих файлов: токены-заглушки, SQLite и индекс во временной папке"""
+    env = {
+        'TELEGRAM_BOT_TOKEN': '1:test',
+        'SUPABASE_URL': 'http://supabase.test',
+        'SUPABASE_ANON_KEY': 'test',
+        'OPENAI_API_KEY': '',
+        'TRANSCRIPTION_BACKEND': 'openai',
+        'UPDATE_LOG_PATH': '',
+        'PRACTICE_ASSETS_CHAT_ID': '',
+        'SUPABASE_OUTBOX_PATH': str(tmp_path / 'outbox.sqlite3'),
+        'KNOWN_USERS_PATH': str(tmp_path / 'known_users.sqlite3'),
+        'PRACTICE_ASSETS_CACHE_PATH': str(tmp_path / 'audio_assets.sqlite3'),
+        'AUDIO_INDEX_DIR': str(tmp_path / 'audio_index'),
+    }
+    for key, value in env.items():
+        monkeypatch.setenv(key, value)
+    return env
@@ -0,0 +1,117 @@
+import asyncio
+import json
+import os
+import sys
+from argparse import Namespace
+
+import pytest
+
+from simple_listening_bot import TranscriptionBackend, TRANSCRIPTION_FAILED, TRANSCRIPTION_PENDING
+
+SCRIPTS_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'scripts')
+if SCRIPTS_DIR not in sys.path:
+    sys.path.insert(0, SCRIPTS_DIR)
+
+import backfill_transcriptions  # noqa: E402
+
+
+class FakeBackend(TranscriptionBackend):
+    """Движок без сети: «распознает» запись в ее содержимое"""
+
+    name = 'fake'
+
+    def transcribe(self, audio, filename):
+        return audio.decode()
+
+
+class FakeStorage:
+    """Сессии и файлы в памяти вместо Supabase и Telegram"""
+
+    def __init__(self):
+        self.sessions = {
+            f's{n}': {'id': f's{n}', 'created_at': f'2024-01-0{n}T00:00:00+00:00', 'text': TRANSCRIPTION_FAILED}
+            for n in range(1, 5)
+        }
+        # У s3 нет голосового ответа
+        self.files = {'s1': 'f1', 's2': 'f2', 's4': 'f4'}
+        self.broken_files = {'f2'}
+
+    def _pending(self):
+        rows = [row for row in self.sessions.values() if row['text'] in backfill_transcriptions.PLACEHOLDERS]
+        return [{'id': row['id'], 'created_at': row['created_at']} for row in sorted(rows, key=lambda r: r['created_at'])]
+
+    def fetch_page(self, after, page_size):
+        rows = self._pending()
+        if after:
+            rows = [row for row in rows if (row['created_at'], row['id']) > (after['created_at'], after['id'])]
+        return rows[:page_size]
+
+    def fetch_sessions(self, session_ids):
+        return [row for row in self._pending() if row['id'] in session_ids]
+
+    def fetch_reflection_files(self, session_ids):
+        return {sid: self.files[sid] for sid in session_ids if sid in self.files}
+
+    def save_transcription(self, session_id, text):
+        self.sessions[session_id]['text'] = text
+
+    def download(self, bot_token, file_id):
+        if file_id in self.broken_files:
+            raise ConnectionError("Telegram недоступен")
+        return f"текст {file_id}".encode(), 'voice.ogg'
+
+
+@pytest.fixture
+def storage(monkeypatch):
+    storage = FakeStorage()
+    monkeypatch.setattr(backfill_transcriptions, 'fetch_page', storage.fetch_page)
+    monkeypatch.setattr(backfill_transcriptions, 'fetch_sessions', storage.fetch_sessions)
+    monkeypatch.setattr(backfill_transcriptions, 'fetch_reflection_files', storage.fetch_reflection_files)
+    monkeypatch.setattr(backfill_transcriptions, 'save_transcription', storage.save_transcription)
+    monkeypatch.setattr(backfill_transcriptions, 'download_telegram_file', storage.download)
+    return storage
+
+
+def backfill_args(tmp_path):
+    return Namespace(
+        backend=f'{__name__}:FakeBackend', batch_size=2, concurrency=2, rate=1000.0,
+        checkpoint=str(tmp_path / 'checkpoint.json'), limit=None, dry_run=False,
+    )
+
+
+def test_transcription_backend_requires_transcribe():
+    with pytest.raises(TypeError):
+        TranscriptionBackend()
+
+
+def read_failed(args):
+    with open(args.checkpoint, encoding='utf-8') as f:
+        return json.load(f)['failed']
+
+
+def test_failed_sessions_are_retried_on_next_run(storage, tmp_path):
+    args = backfill_args(tmp_path)
+
+    asyncio.run(backfill_transcriptions.backfill(args))
+    assert storage.sessions['s1']['text'] == 'текст f1'
+    assert storage.sessions['s4']['text'] == 'текст f4'
+    assert storage.sessions['s2']['text'] == TRANSCRIPTION_FAILED
+    assert read_failed(args) == ['s2', 's3']
+
+    # Telegram снова доступен: s2 дозаполняется при следующем запуске
+    storage.broken_files.clear()
+    asyncio.run(backfill_transcriptions.backfill(args))
+    assert storage.sessions['s2']['text'] == 'текст f2'
+    assert read_failed(args) == ['s3']
+
+
+def test_session_that_gets_placeholder_after_a_run_is_picked_up(storage, tmp_path):
+    args = backfill_args(tmp_path)
+    storage.broken_files.clear()
+    asyncio.run(backfill_transcriptions.backfill(args))
+    assert storage.sessions['s4']['text'] == 'текст f4'
+
+    # Бот перезапустился посреди фоновой транскрипции старой сессии, которую прошлый запуск уже прошел
+    storage.sessions['s1']['text'] = TRANSCRIPTION_PENDING
+    asyncio.run(backfill_transcriptions.backfill(args))
+    assert storage.sessions['s1']['text'] == 'текст f1'
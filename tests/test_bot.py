@@ -0,0 +1,742 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+import requests
+from telegram.ext import JobQueue
+
+from simple_listening_bot import (
+    SimpleListeningBot,
+    OpenAIWhisperBackend,
+    TranscriptionBackend,
+    TRANSCRIPTION_PENDING,
+)
+
+
+def test_bot_starts(bot_env):
+    bot = SimpleListeningBot()
+    for answer_type, steps in bot.answer_steps.items():
+        assert steps and all(callable(step) for step in steps), answer_type
+    assert bot.application.handlers
+
+
+def test_long_voice_answer_does_not_block_handler(bot_env):
+    bot = SimpleListeningBot()
+    saved = []
+    started = asyncio.Event()
+    release = asyncio.Event()
+
+    async def save_voice_answer_with_transcription(session_id, file_id, transcription):
+        saved.append(transcription)
+
+    async def transcribe_audio_chunked(file_id, progress=None):
+        started.set()
+        await release.wait()
+        return "птицы и ветер"
+
+    async def save_transcription(session_id, text):
+        saved.append(text)
+
+    bot.save_voice_answer_with_transcription = save_voice_answer_with_transcription
+    bot.transcribe_audio_chunked = transcribe_audio_chunked
+    bot.save_transcription = save_transcription
+
+    async def scenario():
+        answer = {'file_id': 'f', 'duration': 300, 'file_size': 2 * 1024 * 1024, 'chat_id': 1}
+        # Обработчик возвращается, не дожидаясь распознавания длинной записи
+        await asyncio.wait_for(bot._persist_voice_answer('s', answer), timeout=1)
+        assert saved == [TRANSCRIPTION_PENDING]
+        await asyncio.wait_for(started.wait(), timeout=1)
+        release.set()
+        for _ in range(10):
+            await asyncio.sleep(0)
+        assert saved == [TRANSCRIPTION_PENDING, "птицы и ветер"]
+
+    asyncio.run(scenario())
+
+
+class FakeResponse:
+    def __init__(self, payload, status_code=200, headers=None):
+        self.payload = payload
+        self.status_code = status_code
+        self.headers = headers or {}
+        self.text = ''
+
+    def json(self):
+        return self.payload
+
+
+def test_user_stats_do_not_read_history(bot_env):
+    bot = SimpleListeningBot()
+    urls = []
+
+    async def supabase_request(method, url, headers=None, data=None, fail_fast=False):
+        assert fail_fast
+        urls.append(url)
+        if 'practice_weekly_stats' in url:
+            return FakeResponse([{'sessions_count': 3}, {'sessions_count': 4}])
+        assert 'limit=1' in url and headers['Prefer'] == 'count=exact'
+        return FakeResponse([{'session_date': '2026-10-17'}], 206, {'Content-Range': '0-0/9'})
+
+    bot._supabase_request = supabase_request
+    stats = asyncio.run(bot.get_user_stats(42))
+    assert stats == {'total_sessions': 9, 'completed_sessions': 7, 'last_session_date': '2026-10-17'}
+    assert len(urls) == 2
+
+
+def test_late_outbox_session_is_aggregated():
+    from simple_listening_bot import empty_aggregate, merge_session_into_aggregate
+
+    row = empty_aggregate(42, 'day', '2026-10-17')
+    fresh = {'id': 'b', 'completed_at': '2026-10-17T10:00:00+00:00',
+             'completed_ingested_at': '2026-10-17T10:00:01+00:00', 'session_duration_seconds': 60}
+    # Завершена раньше, но доехала из outbox позже: учитывается по времени записи в базу
+    late = {'id': 'a', 'completed_at': '2026-10-17T09:00:00+00:00',
+            'completed_ingested_at': '2026-10-17T11:30:00+00:00', 'session_duration_seconds': 30}
+    assert merge_session_into_aggregate(row, fresh, [])
+    assert merge_session_into_aggregate(row, late, [])
+    assert not merge_session_into_aggregate(row, late, [])
+    assert row['sessions_count'] == 2 and row['listening_seconds'] == 90
+
+
+def test_late_transcription_adds_keywords_once(bot_env):
+    bot = SimpleListeningBot()
+    rows = {}
+
+    async def load_aggregates(table, period_column, user_ids, periods):
+        return {key: dict(row) for key, row in rows.get(table, {}).items()}
+
+    async def upsert_rows(table, upserted):
+        period_column = 'day' if table == 'practice_daily_stats' else 'week_start'
+        for row in upserted:
+            if table != 'aggregation_watermarks':
+                rows.setdefault(table, {})[(row['user_id'], row[period_column])] = row
+
+    transcribed = {
+        'id': 'a', 'user_id': 42, 'created_at': '2026-10-17T09:00:00+00:00',
+        'completed_at': '2026-10-17T09:05:00+00:00', 'completed_ingested_at': '2026-10-17T09:05:01+00:00',
+        'text_ingested_at': '2026-10-17T09:06:00+00:00', 'session_duration_seconds': 60,
+        'answer_type': 'voice', 'what_heard_text': 'дятел стучит по сосне',
+    }
+
+    async def transcript_pages(url, page_size, key, after=None, tiebreak='id'):
+        assert key == 'text_ingested_at'
+        yield [transcribed]
+
+    bot._load_aggregates = load_aggregates
+    bot._upsert_rows = upsert_rows
+    bot._iter_keyset_pages = transcript_pages
+
+    async def no_watermark(name, key='completed_ingested_at'):
+        return None
+
+    bot._get_watermark = no_watermark
+
+    # Текст пришел еще до прохода по завершенным сессиям: счетчики есть, слова оставлены второму проходу
+    asyncio.run(bot._merge_aggregates([transcribed]))
+    daily = rows['practice_daily_stats'][(42, '2026-10-17')]
+    assert daily['sessions_count'] == 1 and daily['keyword_counts'] == {}
+
+    # Второй проход добавляет слова один раз, даже если пачка обработана повторно
+    asyncio.run(bot._refresh_transcript_keywords('2026-10-18T00:00:00+00:00'))
+    asyncio.run(bot._refresh_transcript_keywords('2026-10-18T00:00:00+00:00'))
+    for table in ('practice_daily_stats', 'practice_weekly_stats'):
+        row = next(iter(rows[table].values()))
+        assert row['sessions_count'] == 1
+        assert row['keyword_counts'] and set(row['keyword_counts'].values()) == {1}
+
+
+class FailingBackend(TranscriptionBackend):
+    """Движок, который не прогревается (например, не загрузилась модель)"""
+
+    name = 'failing'
+    closed = False
+
+    def warm_up(self):
+        raise RuntimeError("модель не загрузилась")
+
+    def transcribe(self, audio, filename):
+        return ""
+
+    def close(self):
+        FailingBackend.closed = True
+
+
+def test_failed_backend_warm_up_keeps_openai(bot_env, monkeypatch):
+    monkeypatch.setenv('OPENAI_API_KEY', 'sk-test')
+    monkeypatch.setenv('TRANSCRIPTION_BACKEND', f'{__name__}:FailingBackend')
+    bot = SimpleListeningBot()
+    assert isinstance(bot.transcriber, OpenAIWhisperBackend)
+    assert FailingBackend.closed
+
+
+def test_sender_records_results_before_page_finishes():
+    from simple_listening_bot import RateLimitedSender
+
+    recorded = []
+
+    async def on_results(chunk):
+        recorded.extend(key for key, _, _ in chunk)
+
+    async def send_ok():
+        return None
+
+    async def crash():
+        # Процесс упал посреди страницы
+        await asyncio.sleep(0.05)
+        raise SystemError("crash")
+
+    async def scenario():
+        sender = RateLimitedSender(rate=1000, concurrency=5)
+        jobs = [(uid, send_ok) for uid in range(45)] + [('crash', crash)]
+        try:
+            await sender.send_all(jobs, on_results=on_results, chunk_size=20)
+        except SystemError:
+            pass
+
+    asyncio.run(scenario())
+    # Уже доставленные пачки записаны до падения
+    assert sorted(recorded) == list(range(40))
+
+
+def test_audio_index_recovers_torn_write_and_shares_writes(tmp_path):
+    import numpy as np
+    from simple_listening_bot import AudioSimilarityIndex
+
+    directory = str(tmp_path / 'index')
+    bot_index = AudioSimilarityIndex(directory, dim=4)
+    script_index = AudioSimilarityIndex(directory, dim=4)
+    eye = np.eye(4, dtype=np.float32)
+
+    bot_index.add('s1', 1, eye[0])
+    # Второй процесс пишет в тот же индекс и не затирает чужие строки
+    script_index.add_many(['s2', 's1'], [1, 1], eye[1:3])
+    bot_index.add('s3', 1, eye[3])
+
+    # Падение между записью вектора и строки
+    with open(bot_index.vectors_path, 'ab') as f:
+        f.write(eye[0].tobytes())
+
+    reopened = AudioSimilarityIndex(directory, dim=4)
+    assert len(reopened) == 3
+    sessions = [sid.decode() for sid in reopened.rows['session_id']]
+    assert sessions == ['s1', 's2', 's3']
+    for row, session_id in enumerate(sessions):
+        assert reopened.query_vector(np.asarray(reopened.vectors[row]), k=1)[0][0] == session_id
+
+
+def test_sweep_without_expired_sessions_does_not_write(bot_env):
+    bot = SimpleListeningBot()
+    writes = []
+
+    async def supabase_write(method, url, data, prefer='return=minimal'):
+        writes.append(url)
+        return FakeResponse(None, 204)
+
+    bot._supabase_write = supabase_write
+    asyncio.run(bot.mark_sessions_abandoned([]))
+    assert writes == []
+
+    asyncio.run(bot.mark_sessions_abandoned(['a', 'b']))
+    assert writes == [f"{bot_env['SUPABASE_URL']}/rest/v1/listening_sessions?status=eq.started&id=in.(a,b)"]
+
+
+def test_write_during_brownout_queues_after_one_short_attempt(bot_env, monkeypatch):
+    monkeypatch.setenv('SUPABASE_TIMEOUT', '5')
+    monkeypatch.setenv('SUPABASE_USER_TIMEOUT', '0.5')
+    bot = SimpleListeningBot()
+    timeouts = []
+
+    def slow_supabase(method, url, timeout=None, **kwargs):
+        timeouts.append(timeout)
+        raise requests.Timeout("read timed out")
+
+    monkeypatch.setattr('simple_listening_bot.requests.request', slow_supabase)
+    response = asyncio.run(bot._supabase_write('PATCH', f"{bot_env['SUPABASE_URL']}/rest/v1/listening_sessions?id=eq.a", {'status': 'completed'}))
+    assert response.status_code == 202
+    assert timeouts == [0.5]
+    assert len(bot.outbox) == 1
+
+
+def test_stuck_outbox_entry_moves_to_dead_letter(bot_env, monkeypatch):
+    monkeypatch.setenv('SUPABASE_BACKOFF', '0')
+    monkeypatch.setenv('SUPABASE_OUTBOX_MAX_ATTEMPTS', '2')
+    bot = SimpleListeningBot()
+    base = f"{bot_env['SUPABASE_URL']}/rest/v1/listening_sessions"
+    bot.outbox.push('PATCH', f"{base}?id=eq.stuck", 'return=minimal', '{}')
+    bot.outbox.push('PATCH', f"{base}?id=eq.rejected", 'return=minimal', '{}')
+    bot.outbox.push('PATCH', f"{base}?id=eq.ok", 'return=minimal', '{}')
+    sent = []
+
+    def supabase(method, url, **kwargs):
+        sent.append(url.rsplit('.', 1)[-1])
+        status = {'stuck': 500, 'rejected': 400}.get(sent[-1], 204)
+        return FakeResponse(None, status)
+
+    monkeypatch.setattr('simple_listening_bot.requests.request', supabase)
+
+    # Первая попытка: очередь ждет, порядок не нарушается
+    asyncio.run(bot.flush_outbox(None))
+    assert set(sent) == {'stuck'} and len(bot.outbox) == 3
+
+    # Вторая: застрявшая и отклоненная записи уходят в dead letter, остальные доезжают
+    sent.clear()
+    asyncio.run(bot.flush_outbox(None))
+    assert sent[-2:] == ['rejected', 'ok']
+    assert len(bot.outbox) == 0
+    assert bot.outbox.dead_letter_count() == 2
+
+
+class FakeTelegramBot:
+    """Bot API без сети: запоминает отправленные сообщения"""
+
+    def __init__(self):
+        self.sent = []
+
+    async def send_message(self, chat_id, text, **kwargs):
+        self.sent.append((chat_id, text))
+        return type('Message', (), {'message_id': len(self.sent)})()
+
+    async def edit_message_text(self, chat_id, message_id, text, **kwargs):
+        self.sent.append((chat_id, text))
+
+
+def test_interrupted_broadcast_is_retried_from_checkpoint(bot_env, monkeypatch):
+    monkeypatch.setenv('BROADCAST_RETRY_DELAY', '10')
+    bot = SimpleListeningBot()
+    telegram = FakeTelegramBot()
+    scheduled = []
+
+    async def pages(url, page_size, key, after=None, tiebreak=None):
+        if after is None:
+            yield [{'telegram_user_id': 1}, {'telegram_user_id': 2}]
+        raise RuntimeError("Не удалось прочитать страницу из Supabase: нет ответа")
+
+    async def supabase_write(method, url, data, prefer='return=minimal'):
+        return FakeResponse(None, 204)
+
+    async def delivered(broadcast_id, user_ids):
+        return set()
+
+    bot._iter_keyset_pages = pages
+    bot._supabase_write = supabase_write
+    bot._delivered_recipients = delivered
+    monkeypatch.setattr(JobQueue, 'run_once', lambda self, callback, when, data, name: scheduled.append((when, data)))
+
+    # Вторая страница падает на чтении: рассылка не ждет перезапуска, а планирует повтор
+    broadcast = {'id': 'b1', 'text': 'привет', 'created_by': 99}
+    asyncio.run(bot.run_broadcast(broadcast, telegram))
+    when, data = scheduled[-1]
+    assert when == 10 and data['attempt'] == 1
+    assert data['broadcast']['last_user_id'] == 2 and data['broadcast']['sent_count'] == 2
+
+    # Повтор без продвижения удваивает паузу
+    asyncio.run(bot.run_broadcast(data['broadcast'], telegram, data['attempt'], data['report_message_id']))
+    when, data = scheduled[-1]
+    assert when == 20 and data['attempt'] == 2
+    assert [chat_id for chat_id, _ in telegram.sent].count(1) == 1
+
+
+def test_summarize_week_totals_best_day_and_recurring_sounds():
+    from simple_listening_bot import summarize_week
+
+    # Пользователь 7: три дня, самый долгий — среда (2); пользователь 3: один день
+    user_ids = [7, 7, 3, 7]
+    day_offsets = [0, 2, 4, 5]
+    seconds = [300, 900, 120, 600]
+    sessions = [1, 2, 1, 0]
+    # Слова: 0 — «птицы» дважды в разные дни, 1 — «ветер» один раз, 2..5 — по два раза
+    kw_users = [7, 7, 7, 7, 7, 7, 7, 7, 7, 3]
+    kw_words = [0, 0, 1, 2, 3, 4, 5, 5, 5, 0]
+    kw_counts = [1, 1, 1, 2, 2, 2, 1, 1, 1, 1]
+
+    result = summarize_week(user_ids, day_offsets, seconds, sessions, kw_users, kw_words, kw_counts)
+    assert list(result['users']) == [3, 7]
+    assert list(result['sessions']) == [1, 3]
+    assert list(result['seconds']) == [120, 1800]
+    # День без практик (sessions = 0) не считается активным
+    assert list(result['active_days']) == [1, 2]
+    assert list(result['best_day']) == [4, 2]
+
+    sounds = {}
+    for user, word in zip(result['sound_users'], result['sound_words']):
+        sounds.setdefault(int(user), []).append(int(word))
+    # У пользователя 3 нет слов, встреченных дважды; у 7 — не больше трех самых частых
+    assert 3 not in sounds
+    assert sounds[7][0] == 5 and len(sounds[7]) == 3
+    assert 1 not in sounds[7]
+
+
+def test_summarize_week_empty_shard():
+    from simple_listening_bot import summarize_week
+
+    result = summarize_week([], [], [], [], [], [], [])
+    assert all(len(values) == 0 for values in result.values())
+
+
+def test_file_id_cache_evicts_least_recent_and_remembers_missing_audio():
+    from simple_listening_bot import FileIdCache
+
+    cache = FileIdCache(max_size=2)
+    cache.put('a', 'file-a')
+    cache.put('b', None)
+    assert cache.get('a') == 'file-a'
+    # Аудио у b нет — это тоже попадание, а не промах
+    assert cache.get('b') is None
+    cache.put('c', 'file-c')
+    assert cache.get('a') is FileIdCache.MISSING
+    assert (cache.hits, cache.misses) == (2, 1)
+
+
+def test_environment_file_ids_query_only_cache_misses(bot_env):
+    bot = SimpleListeningBot()
+    urls = []
+
+    async def supabase_request(method, url, headers=None, data=None, fail_fast=False):
+        urls.append(url)
+        return FakeResponse([{'session_id': 's1', 'telegram_file_id': 'f1'}])
+
+    bot._supabase_request = supabase_request
+    assert asyncio.run(bot._get_environment_file_ids(['s1', 's2', 's1'])) == {'s1': 'f1'}
+    assert len(urls) == 1 and 'session_id=in.(s1,s2)' in urls[0]
+
+    # Вторая страница с теми же сессиями (у s2 аудио нет) обходится без запроса
+    assert asyncio.run(bot._get_environment_file_ids(['s1', 's2'])) == {'s1': 'f1'}
+    assert len(urls) == 1
+
+
+def test_environment_file_ids_failed_lookup_is_not_cached(bot_env):
+    bot = SimpleListeningBot()
+    calls = []
+
+    async def supabase_request(method, url, headers=None, data=None, fail_fast=False):
+        calls.append(url)
+        return None
+
+    bot._supabase_request = supabase_request
+    assert asyncio.run(bot._get_environment_file_ids(['s1'])) == {}
+    assert asyncio.run(bot._get_environment_file_ids(['s1'])) == {}
+    assert len(calls) == 2
+
+
+def test_register_user_skips_upsert_for_unchanged_profile(bot_env):
+    bot = SimpleListeningBot()
+    writes = []
+
+    async def supabase_write(method, url, data, prefer='return=minimal'):
+        writes.append(data)
+        return FakeResponse(None, 201)
+
+    bot._supabase_write = supabase_write
+    asyncio.run(bot.register_user(42, 'listener', 'Аня'))
+    asyncio.run(bot.register_user(42, 'listener', 'Аня'))
+    assert len(writes) == 1
+
+    # Сменился username — профиль обновляется одним upsert
+    asyncio.run(bot.register_user(42, 'deep_listener', 'Аня'))
+    assert len(writes) == 2 and writes[-1]['username'] == 'deep_listener'
+
+    # Кэш переживает перезапуск бота (SQLite)
+    restarted = SimpleListeningBot()
+    restarted._supabase_write = supabase_write
+    asyncio.run(restarted.register_user(42, 'deep_listener', 'Аня'))
+    assert len(writes) == 2
+
+
+def test_register_user_retries_after_failed_upsert(bot_env):
+    bot = SimpleListeningBot()
+    statuses = [500, 201]
+
+    async def supabase_write(method, url, data, prefer='return=minimal'):
+        return FakeResponse(None, statuses.pop(0))
+
+    bot._supabase_write = supabase_write
+    asyncio.run(bot.register_user(7, None, 'Лев'))
+    asyncio.run(bot.register_user(7, None, 'Лев'))
+    assert statuses == []
+
+
+class FakeJobQueue:
+    """Запоминает отложенные задачи вместо запуска по таймеру"""
+
+    def __init__(self):
+        self.jobs = []
+
+    def run_once(self, callback, when, data=None, name=None):
+        self.jobs.append(SimpleNamespace(callback=callback, when=when, data=data, name=name))
+
+
+def photo_update(user_id, file_id, media_group_id=None, caption=None):
+    replies = []
+
+    async def reply_text(text, **kwargs):
+        replies.append(text)
+
+    message = SimpleNamespace(
+        photo=[SimpleNamespace(file_id=f'{file_id}-small', file_size=10), SimpleNamespace(file_id=file_id, file_size=100)],
+        media_group_id=media_group_id, caption=caption, chat_id=user_id, reply_text=reply_text,
+    )
+    return SimpleNamespace(effective_user=SimpleNamespace(id=user_id), message=message), replies
+
+
+def test_photo_album_completes_answer_once(bot_env):
+    from simple_listening_bot import PracticeSession, PracticeState
+
+    bot = SimpleListeningBot()
+    completed = []
+
+    async def complete_answer(chat_id, user_id, session_id, answer_type, answer, context):
+        completed.append((session_id, answer_type, answer))
+
+    bot.complete_answer = complete_answer
+    practice = PracticeSession('s1', chat_id=42)
+    practice.advance(PracticeState.ANSWERING)
+    bot.practices[42] = practice
+    context = SimpleNamespace(bot_data={}, job_queue=FakeJobQueue())
+
+    async def scenario():
+        for n, caption in enumerate([None, 'лес после дождя', 'другая подпись']):
+            update, _ = photo_update(42, f'p{n}', media_group_id='album', caption=caption)
+            await bot.handle_photo(update, context)
+        # Пока окно альбома открыто, ответ не сохранен; таймер один на весь альбом
+        assert completed == []
+        assert len(context.job_queue.jobs) == 1 and context.job_queue.jobs[0].when == bot.media_group_window
+
+        job = context.job_queue.jobs[0]
+        await job.callback(SimpleNamespace(bot_data=context.bot_data, job=job))
+        await job.callback(SimpleNamespace(bot_data=context.bot_data, job=job))
+
+    asyncio.run(scenario())
+    assert len(completed) == 1
+    session_id, answer_type, answer = completed[0]
+    assert (session_id, answer_type) == ('s1', 'photo')
+    assert answer['photos'] == [('p0', 100), ('p1', 100), ('p2', 100)]
+    assert answer['caption'] == 'лес после дождя'
+    assert 42 not in bot.practices
+
+
+def test_photo_album_outside_practice_prompts_once(bot_env):
+    bot = SimpleListeningBot()
+    context = SimpleNamespace(bot_data={}, job_queue=FakeJobQueue())
+    prompts = []
+
+    async def scenario():
+        for n in range(3):
+            update, replies = photo_update(7, f'p{n}', media_group_id='album')
+            await bot.handle_photo(update, context)
+            prompts.extend(replies)
+
+    asyncio.run(scenario())
+    assert len(prompts) == 1
+
+
+def test_callback_router_exact_and_longest_prefix():
+    from simple_listening_bot import CallbackRouter
+
+    timings = []
+    router = CallbackRouter(hooks=[lambda name, seconds: timings.append(name)])
+    calls = []
+
+    def handler(name):
+        async def handle(query):
+            calls.append((name, query))
+        return handle
+
+    router.route("show_stats", handler('stats'))
+    router.route("lib:", handler('lib'))
+    router.route("lib:play:", handler('play'))
+
+    async def scenario():
+        assert await router.dispatch("show_stats", 'q1')
+        assert await router.dispatch("lib:play:abc:def", 'q2')
+        assert await router.dispatch("lib:page:2", 'q3')
+
+    asyncio.run(scenario())
+    assert calls == [('stats', 'q1'), ('play', 'q2'), ('lib', 'q3')]
+    assert timings == ['callback:show_stats', 'callback:lib:play:', 'callback:lib:']
+
+
+def test_callback_router_rejects_unknown_data_and_duplicate_routes():
+    from simple_listening_bot import CallbackRouter
+
+    router = CallbackRouter()
+    router.route("lib:play:", lambda query: None)
+    for data in ("show_stats_extra", "lib:play", "play:lib:", "", None):
+        assert not asyncio.run(router.dispatch(data, 'q'))
+    with pytest.raises(ValueError):
+        router.route("lib:play:", lambda query: None)
+
+
+def test_unknown_button_is_logged_not_raised(bot_env, caplog):
+    bot = SimpleListeningBot()
+    answered = []
+
+    async def answer():
+        answered.append(True)
+
+    query = SimpleNamespace(data="gone:button", answer=answer)
+    update = SimpleNamespace(callback_query=query)
+    with caplog.at_level('WARNING', logger='simple_listening_bot'):
+        asyncio.run(bot.button_handler(update, SimpleNamespace()))
+    assert answered == [True]
+    assert any("gone:button" in record.getMessage() for record in caplog.records)
+
+
+def test_practice_session_rejects_illegal_transitions():
+    from simple_listening_bot import InvalidTransition, PracticeSession, PracticeState
+
+    practice = PracticeSession('s1', chat_id=1)
+    assert practice.state is PracticeState.LISTENING
+    # Ответ нельзя засчитать, пока нет записи окружения
+    assert not practice.can_advance(PracticeState.COMPLETED)
+    with pytest.raises(InvalidTransition):
+        practice.advance(PracticeState.COMPLETED)
+    assert practice.state is PracticeState.LISTENING
+
+    practice.advance(PracticeState.ANSWERING)
+    with pytest.raises(InvalidTransition):
+        practice.advance(PracticeState.LISTENING)
+    practice.advance(PracticeState.COMPLETED)
+
+    # Из завершенной практики переходов нет
+    for state in PracticeState:
+        with pytest.raises(InvalidTransition):
+            practice.advance(state)
+
+
+def test_finish_practice_ignores_stale_session(bot_env):
+    from simple_listening_bot import PracticeSession
+
+    bot = SimpleListeningBot()
+    bot.practices[1] = PracticeSession('new', chat_id=1)
+    # Ответ на старую сессию не закрывает новую практику
+    bot._finish_practice(1, 'old')
+    assert bot.practices[1].session_id == 'new'
+
+
+def test_recorded_updates_carry_no_personal_data(tmp_path):
+    import json
+    from simple_listening_bot import UpdateRecorder, read_update_log
+
+    user = {'id': 424242, 'is_bot': False, 'first_name': 'Анна', 'username': 'anna_listens'}
+    update = {
+        'update_id': 7,
+        'message': {
+            'message_id': 11,
+            'date': 1700000000,
+            'from': user,
+            'chat': {'id': 424242, 'type': 'private', 'first_name': 'Анна', 'username': 'anna_listens'},
+            'text': 'слышу соседа Петра за стеной',
+            'contact': {'phone_number': '+70000000000', 'first_name': 'Анна', 'user_id': 424242},
+        },
+    }
+    command = {
+        'update_id': 8,
+        'message': {'message_id': 12, 'date': 1700000005, 'from': user,
+                    'chat': {'id': 424242, 'type': 'private'}, 'text': '/start секретный_код'},
+    }
+
+    path = str(tmp_path / 'updates.jsonl.gz')
+    recorder = UpdateRecorder(path, b'salt')
+    recorder.record(update)
+    recorder.record(command)
+    recorder.close()
+
+    entries = list(read_update_log(path))
+    assert [entry['update_id'] for _, entry in entries] == [7, 8]
+    raw = json.dumps(entries, ensure_ascii=False)
+    for secret in ('424242', 'anna_listens', 'Анна', 'Петра', '+70000000000', 'секретный_код'):
+        assert secret not in raw
+
+    message = entries[0][1]['message']
+    # Длина текста сохраняется, один и тот же пользователь получает один псевдоним
+    assert len(message['text']) == len(update['message']['text'])
+    assert message['from']['id'] == message['chat']['id'] == entries[1][1]['message']['from']['id']
+    assert 'contact' not in message
+    assert entries[1][1]['message']['text'].startswith('/start ')
+
+
+def test_sampling_filter_drops_only_sampled_info_events(monkeypatch):
+    import logging
+    import simple_listening_bot
+    from simple_listening_bot import SamplingFilter, parse_sample_rates
+
+    rates = parse_sample_rates(' user_registered=0, route_timing = 0.5 ,,')
+    assert rates == {'user_registered': 0.0, 'route_timing': 0.5}
+    with pytest.raises(ValueError):
+        parse_sample_rates('route_timing=often')
+
+    def record(level, event=None):
+        entry = logging.LogRecord('simple_listening_bot', level, __file__, 1, "сообщение", None, None)
+        if event:
+            entry.event = event
+        return entry
+
+    sampling = SamplingFilter(rates)
+    monkeypatch.setattr(simple_listening_bot.random, 'random', lambda: 0.7)
+    assert not sampling.filter(record(logging.INFO, 'user_registered'))
+    assert not sampling.filter(record(logging.DEBUG, 'route_timing'))
+    # Без события и с неизвестным событием пишем всё
+    assert sampling.filter(record(logging.INFO))
+    assert sampling.filter(record(logging.INFO, 'aggregates_failed'))
+    # Предупреждения и ошибки не сэмплируются, даже если у события доля 0
+    assert sampling.filter(record(logging.WARNING, 'user_registered'))
+    assert sampling.filter(record(logging.ERROR, 'user_registered'))
+
+    monkeypatch.setattr(simple_listening_bot.random, 'random', lambda: 0.3)
+    assert sampling.filter(record(logging.INFO, 'route_timing'))
+
+
+def test_practice_day_is_utc_day_at_offset_boundaries():
+    from datetime import date
+    from simple_listening_bot import practice_day
+
+    assert practice_day('2024-03-10T23:59:59.999999+00:00') == date(2024, 3, 10)
+    assert practice_day('2024-03-11T00:00:00Z') == date(2024, 3, 11)
+    # Смещение в ответе не меняет день: те же моменты по UTC
+    assert practice_day('2024-03-11T01:30:00+03:00') == date(2024, 3, 10)
+    assert practice_day('2024-03-10T22:30:00-02:00') == date(2024, 3, 11)
+    assert practice_day('2024-03-10T23:30:00') == date(2024, 3, 10)
+
+
+def test_bucket_daily_activity_window_edges():
+    from simple_listening_bot import CHART_WINDOW_DAYS, bucket_daily_activity
+
+    days = ['2024-03-01', '2024-02-29', '2023-12-02', '2023-12-01', '2024-03-02', '2024-03-01']
+    minutes, counts = bucket_daily_activity(days, [600, 120, 60, 60, 60, 300], [2, 1, 1, 1, 1, 1], '2024-03-01')
+
+    assert len(minutes) == len(counts) == CHART_WINDOW_DAYS
+    # Сегодня — последний индекс, повторы одного дня складываются
+    assert minutes[-1] == 15 and counts[-1] == 3
+    # Високосный день и край окна: 90 дней назад — индекс 0, 91 день назад и будущее не попадают
+    assert counts[-2] == 1 and minutes[-2] == 2
+    assert counts[0] == 1
+    assert counts.sum() == 5
+
+    minutes, counts = bucket_daily_activity([], [], [], '2025-01-01')
+    assert not minutes.any() and not counts.any()
+
+    # Переход через год
+    _, counts = bucket_daily_activity(['2024-12-31'], [60], [1], '2025-01-01')
+    assert counts[-2] == 1 and counts.sum() == 1
+
+
+def test_current_streak_day_boundaries():
+    import numpy as np
+    from simple_listening_bot import CHART_WINDOW_DAYS, current_streak
+
+    counts = np.zeros(CHART_WINDOW_DAYS, dtype=np.int64)
+    assert current_streak(counts) == 0
+
+    counts[-3:-1] = 1
+    # Сегодня еще не практиковал — серия со вчерашнего дня не обрывается
+    assert current_streak(counts) == 2
+    counts[-1] = 1
+    assert current_streak(counts) == 3
+    counts[-2] = 0
+    assert current_streak(counts) == 1
+
+    counts[:] = 1
+    assert current_streak(counts) == CHART_WINDOW_DAYS
+    counts[-1] = 0
+    assert current_streak(counts) == CHART_WINDOW_DAYS - 1